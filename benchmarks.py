@@ -0,0 +1,1138 @@
+#!/usr/bin/env python3
+
+"""This script include a few simple benchmarks for local use only."""
+
+import argparse
+import bz2
+import gzip
+import json
+import lzma
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+from biothings.utils.dataload import dict_sweep, unlist
+
+try:                         # optional, only used by `propagate_sparse()`
+    import numpy as np
+except ImportError:
+    np = None
+
+import parser
+from parser import (
+    GO,
+    TAX_ID,
+    DOTerm,
+    GOTerm,
+    MIMdisease,
+    GeneIndex,
+    NCBIGeneClient,
+    NCBIGeneIndex,
+    TermIndex,
+    add_term_annotations,
+    build_mim_diseases_dict,
+    build_mim_gene_table,
+    create_gene_record,
+    create_geneset,
+    create_gs_abstract,
+    create_gs_id,
+    export_genesets,
+    find_duplicate_genesets,
+    find_near_duplicates,
+    iter_collapsed_genesets,
+    iter_genesets,
+    iter_release_genesets,
+    load_disease_ontology,
+    open_input,
+    PipelineMetrics,
+    iter_assembled_genesets,
+    get_term_labels,
+    load_ontology_snapshot,
+    query_mygene,
+    save_ontology_snapshot,
+    update_mim_diseases_dict,
+)
+from version import get_release
+
+# (OBO, genemap2) file pairs to run the benchmarks on.
+DATA_FILES = [
+    (
+        "./data/snapshot-for-test/2020-12-22.HumanDO.obo",
+        "./data/snapshot-for-test/2020-12-23.genemap2.txt"
+    ),
+    (
+        "./data/latest/HumanDO.obo",
+        "./data/latest/genemap2.txt"
+    ),
+]
+
+
+# Approximate size of the real HumanDO.obo and genemap2.txt, which the
+# synthetic data of the benchmark suite is scaled from.
+HUMANDO_TERMS = 11000
+GENEMAP_GENES = 5000
+
+# Results of the benchmark suite are saved in this directory, one JSON
+# file per run, to be compared between commits.
+RESULTS_DIRNAME = "./benchmark_results"
+
+# Largest ontology (in terms) to run the slower propagation engines on
+MAX_LEGACY_TERMS = 2 * HUMANDO_TERMS
+MAX_TOPOLOGICAL_TERMS = 10 * HUMANDO_TERMS
+
+
+# Propagation as it was implemented before `GO.topological_order()`:
+# every child is re-propagated from every parent that reaches it.
+def legacy_propagate(disease_ontology):
+    for head_gterm in disease_ontology.heads:
+        legacy_propagate_recurse(head_gterm)
+
+
+def legacy_propagate_recurse(gterm):
+    if not len(gterm.parent_of):
+        return
+
+    for child_term in gterm.parent_of:
+        legacy_propagate_recurse(child_term)
+        new_annotations = set()
+
+        regulates_relation = (gterm in child_term.relationship_regulates)
+        part_of_relation = (gterm in child_term.relationship_part_of)
+
+        for annotation in child_term.annotations:
+            if regulates_relation:
+                if annotation.ready_regulates_cutoff:
+                    continue
+                copied_annotation = annotation.prop_copy(
+                    ready_regulates_cutoff=True)
+            elif part_of_relation:
+                copied_annotation = annotation.prop_copy(
+                    ready_regulates_cutoff=True)
+            else:
+                copied_annotation = annotation.prop_copy()
+
+            new_annotations.add(copied_annotation)
+        gterm.annotations = gterm.annotations | new_annotations
+
+
+# genemap2 parsing as it was implemented before `iter_mim_gene_pairs()`.
+def legacy_build_mim_diseases_dict(genemap_filename):
+    mim_diseases = {}
+
+    genemap_fh = open(genemap_filename, 'r')
+    for line in genemap_fh:
+        tokens = line.strip('\n').split('\t')
+
+        try:
+            mim_geneid = tokens[5].strip()
+            entrez_id = tokens[9].strip()
+            disorders = tokens[12].strip()
+        except IndexError:
+            continue
+
+        if disorders == '':
+            continue
+
+        if entrez_id == '':
+            continue
+
+        disorders_list = disorders.split(';')
+        for disorder in disorders_list:
+            if '[' in disorder or '?' in disorder:
+                continue
+
+            mim_info = re.search('\\, [0-9]* \\([1-4]\\)', disorder)
+
+            if mim_info:
+                split_mim_info = mim_info.group(0).split(' ')
+                mim_disease_id = split_mim_info[1].strip()
+                mim_phenotype = split_mim_info[2].strip()
+
+                if mim_phenotype != '(3)':
+                    continue
+
+                if mim_disease_id not in mim_diseases:
+                    mim_diseases[mim_disease_id] = MIMdisease()
+                    mim_diseases[mim_disease_id].id = mim_disease_id
+                    mim_diseases[mim_disease_id].phenotype = mim_phenotype
+
+                if entrez_id not in mim_diseases[mim_disease_id].genes:
+                    mim_diseases[mim_disease_id].genes.append(entrez_id)
+
+    genemap_fh.close()
+    return mim_diseases
+
+
+# Geneset documents as they were built before `create_gene_record()`:
+# raw gene records, and the whole document swept by Biothings.
+def legacy_create_geneset(term_id, term, gid_list, hits, doid_omim_dict):
+    my_geneset = {}
+    my_geneset['_id'] = create_gs_id(term)
+    my_geneset['is_public'] = True
+    my_geneset['creator'] = 'disease_ontology_parser'
+    my_geneset['date'] = date.today().isoformat()
+    my_geneset['taxid'] = TAX_ID
+
+    my_geneset['genes'] = []
+    for gid in gid_list:
+        gene = hits[str(gid)]
+        my_geneset['genes'].append({
+            'source': str(gid),
+            'mygene': gene.get('_id', None),
+            'ncbigene': gene.get('entrezgene', None),
+            'ensemblgene': gene.get('ensembl', None),
+            'symbol': gene.get('symbol', None),
+            'uniprot': gene.get('uniprot', None)
+        })
+    my_geneset['disease_ontology'] = {
+        'id': term_id,
+        'abstract': create_gs_abstract(term, doid_omim_dict)
+    }
+    my_geneset = dict_sweep(my_geneset, vals=[None], remove_invalid_list=True)
+    my_geneset = unlist(my_geneset)
+    return my_geneset
+
+
+def fake_mygene_hit(gid):
+    """
+    Return a MyGene.info hit of gene `gid` whose fields, depending on
+    `gid`, are missing, None, single-element lists or lists.
+    """
+    hit = {'_id': str(gid), 'entrezgene': gid, 'symbol': 'GENE%d' % gid}
+    if gid % 7 == 0:
+        return {'query': str(gid), 'notfound': True}
+    if gid % 5 == 0:
+        hit['symbol'] = None
+    if gid % 3 == 0:
+        hit['ensembl'] = [{'gene': 'ENSG%d' % gid}, {'gene': 'ENSGB%d' % gid}]
+    elif gid % 3 == 1:
+        hit['ensembl'] = {'gene': 'ENSG%d' % gid}
+    if gid % 2:
+        hit['uniprot'] = {'Swiss-Prot': 'P%d' % gid, 'TrEMBL': ['Q%d' % gid]}
+    elif gid % 4:
+        hit['uniprot'] = {'TrEMBL': ['Q%d' % gid, 'R%d' % gid], 'Swiss-Prot': None}
+    return hit
+
+
+def load_annotated_ontology(obo_filename, genemap_filename, term_class=DOTerm):
+    """Return a freshly parsed and annotated (but not propagated) DO."""
+
+    disease_ontology, doid_omim_dict = load_disease_ontology(
+        obo_filename, term_class=term_class)
+    mim_diseases = build_mim_diseases_dict(genemap_filename)
+    add_term_annotations(doid_omim_dict, disease_ontology, mim_diseases)
+    return disease_ontology
+
+
+def propagated_annotations(disease_ontology):
+    """Map each term ID to its set of propagated annotations."""
+
+    return {
+        term_id: term.annotations
+        for term_id, term in disease_ontology.go_terms.items()
+    }
+
+
+def propagated_genes(disease_ontology, gene_index=None):
+    """
+    Map each term ID to its sorted list of propagated gene IDs, read from
+    the bitsets if `gene_index` is given and from annotations otherwise.
+    """
+
+    if gene_index is None:
+        return {
+            term_id: sorted({annotation.gid for annotation in term.annotations})
+            for term_id, term in disease_ontology.go_terms.items()
+        }
+
+    return {
+        term_id: gene_index.decode(term.gene_bits | term.cutoff_gene_bits)
+        for term_id, term in disease_ontology.go_terms.items()
+    }
+
+
+def propagate_bitsets(disease_ontology):
+    """Run `GO.propagate_bitsets()` and return the gene index it used."""
+
+    gene_index = GeneIndex({
+        annotation.gid
+        for term in disease_ontology.go_terms.values()
+        for annotation in term.annotations
+    })
+    disease_ontology.propagate_bitsets(gene_index)
+    return gene_index
+
+
+def propagate_sparse(disease_ontology):
+    """
+    Run `GO.propagate_sparse()` and return the propagated genes of each
+    term, like `propagated_genes()`.
+    """
+
+    gene_index = GeneIndex({
+        annotation.gid
+        for term in disease_ontology.go_terms.values()
+        for annotation in term.annotations
+    })
+    gene_arrays = disease_ontology.propagate_sparse(gene_index)
+    gids = np.array(gene_index.gids, dtype=np.int64)
+    return {
+        term_id: gids[gene_array].tolist()
+        for term_id, gene_array in gene_arrays.items()
+    }
+
+
+def bench_propagate(obo_filename, genemap_filename):
+    """
+    Time `legacy_propagate()`, `GO.propagate()`, `GO.propagate_bitsets()`
+    and `GO.propagate_sparse()` on the same input, including reading the
+    sorted genes of each term.
+    """
+
+    def read_genes(propagate):
+        def propagate_and_read(disease_ontology):
+            gene_index = propagate(disease_ontology)
+            return propagated_genes(disease_ontology, gene_index)
+        return propagate_and_read
+
+    timings = {}
+    results = {}
+    engines = [
+        ('legacy', read_genes(legacy_propagate)),
+        ('topological', read_genes(GO.propagate)),
+        ('bitset', read_genes(propagate_bitsets)),
+    ]
+    if parser.sparse is not None:
+        engines.append(('sparse', propagate_sparse))
+    for name, propagate in engines:
+        disease_ontology = load_annotated_ontology(obo_filename, genemap_filename)
+        start = time.perf_counter()
+        results[name] = propagate(disease_ontology)
+        timings[name] = time.perf_counter() - start
+
+    for name in results:
+        if results[name] != results['legacy']:
+            raise AssertionError(
+                'Propagation engine %s disagrees on %s' % (name, obo_filename))
+
+    for name, seconds in timings.items():
+        speedup = timings['legacy'] / seconds
+        print(f"  propagate [{name}]: {seconds:.3f}s ({speedup:.1f}x)")
+
+
+def bench_terms(obo_filename, genemap_filename):
+    """
+    Time and trace the memory of loading, annotating and propagating the
+    DO with `GOTerm` and `Annotation` objects, and with the compact
+    `DOTerm` and `DOAnnotation` objects.
+    """
+
+    timings = {}
+    peaks = {}
+    results = {}
+    for name, term_class in [('GOTerm', GOTerm), ('DOTerm', DOTerm)]:
+        start = time.perf_counter()
+        disease_ontology = load_annotated_ontology(
+            obo_filename, genemap_filename, term_class)
+        disease_ontology.propagate()
+        timings[name] = time.perf_counter() - start
+        results[name] = propagated_genes(disease_ontology)
+        del disease_ontology
+
+        # Memory is traced in a second run, as tracing slows Python down
+        tracemalloc.start()
+        disease_ontology = load_annotated_ontology(
+            obo_filename, genemap_filename, term_class)
+        disease_ontology.propagate()
+        peaks[name] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del disease_ontology
+
+    if results['DOTerm'] != results['GOTerm']:
+        raise AssertionError('Term classes disagree on %s' % obo_filename)
+
+    for name in timings:
+        speedup = timings['GOTerm'] / timings[name]
+        print(f"  terms [{name}]: {timings[name]:.3f}s ({speedup:.1f}x), "
+              f"peak {peaks[name] / 2**20:.1f} MiB")
+
+
+def bench_index(obo_filename, genemap_filename, lookups=10000):
+    """
+    Time building a `TermIndex`, and `lookups` queries of each kind on
+    it against graph walks.
+    """
+
+    disease_ontology = load_annotated_ontology(obo_filename, genemap_filename)
+    gene_index = propagate_bitsets(disease_ontology)
+
+    start = time.perf_counter()
+    term_index = TermIndex(disease_ontology)
+    term_index.index_genes(disease_ontology, gene_index)
+    print(f"  index [build]: {time.perf_counter() - start:.3f}s")
+
+    term_ids = list(disease_ontology.go_terms)
+    queries = [
+        (term_ids[idx * 7919 % len(term_ids)], term_ids[idx * 104729 % len(term_ids)])
+        for idx in range(lookups)
+    ]
+
+    def walk_ancestors(term_id):
+        found = set()
+        pending = list(disease_ontology.go_terms[term_id].child_of)
+        while pending:
+            gterm = pending.pop()
+            if gterm.go_id not in found:
+                found.add(gterm.go_id)
+                pending.extend(gterm.child_of)
+        return found
+
+    start = time.perf_counter()
+    for term_id, _ in queries:
+        walk_ancestors(term_id)
+    walk_seconds = time.perf_counter() - start
+    print(f"  index [walk ancestors]: {lookups / walk_seconds:,.0f} lookups/s")
+
+    for name, query in [
+            ('ancestors', lambda term_id, _: term_index.ancestors(term_id)),
+            ('descendants', lambda term_id, _: term_index.descendants(term_id)),
+            ('lowest common ancestors', term_index.lowest_common_ancestors),
+    ]:
+        start = time.perf_counter()
+        for term_id, other_id in queries:
+            query(term_id, other_id)
+        seconds = time.perf_counter() - start
+        print(f"  index [{name}]: {lookups / seconds:,.0f} lookups/s")
+
+    gids = gene_index.gids
+    start = time.perf_counter()
+    for idx in range(lookups):
+        term_index.terms_with_gene(gids[idx % len(gids)])
+    seconds = time.perf_counter() - start
+    print(f"  index [terms with gene]: {lookups / seconds:,.0f} lookups/s")
+
+
+def mim_genes(mim_diseases):
+    """Map each MIM disease ID to its (phenotype, list of genes)."""
+
+    return {
+        mim_id: (mim_diseases[mim_id].phenotype, mim_diseases[mim_id].genes)
+        for mim_id in mim_diseases.keys()
+    }
+
+
+def bench_genemap(genemap_filename):
+    """
+    Time `legacy_build_mim_diseases_dict()` against
+    `build_mim_diseases_dict()` and `build_mim_gene_table()`.
+    """
+
+    timings = {}
+    results = {}
+    parsers = [
+        ('legacy', legacy_build_mim_diseases_dict),
+        ('dict', build_mim_diseases_dict),
+        ('table', build_mim_gene_table),
+    ]
+    for name, parse in parsers:
+        start = time.perf_counter()
+        mim_diseases = parse(genemap_filename)
+        timings[name] = time.perf_counter() - start
+        results[name] = mim_genes(mim_diseases)
+
+    # The table leaves out empty MIM disease IDs, which no xref can match
+    results['legacy'].pop('', None)
+    results['dict'].pop('', None)
+    for name in results:
+        if results[name] != results['legacy']:
+            raise AssertionError(
+                'genemap parser %s disagrees on %s' % (name, genemap_filename))
+
+    for name, seconds in timings.items():
+        speedup = timings['legacy'] / seconds
+        print(f"  genemap [{name}]: {seconds:.3f}s ({speedup:.1f}x)")
+
+
+def bench_compression(genemap_filename):
+    """
+    Time reading and parsing (with `build_mim_diseases_dict()`) a genemap
+    file, uncompressed and compressed in each format of `open_input()`.
+    Throughput is given in MB/s of uncompressed data.
+    """
+
+    with open(genemap_filename, 'rb') as genemap_fh:
+        data = genemap_fh.read()
+    compressors = [
+        ('gzip', 'gz', gzip.compress),
+        ('bz2', 'bz2', bz2.compress),
+        ('xz', 'xz', lzma.compress),
+    ]
+    if parser.zstandard is not None:
+        compressors.append(
+            ('zstd', 'zst', parser.zstandard.ZstdCompressor().compress))
+
+    reference = mim_genes(build_mim_diseases_dict(genemap_filename))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        inputs = [('none', genemap_filename)]
+        for name, suffix, compress in compressors:
+            filename = os.path.join(tmp_dir, 'genemap2.txt.' + suffix)
+            with open(filename, 'wb') as compressed_fh:
+                compressed_fh.write(compress(data))
+            inputs.append((name, filename))
+
+        for name, filename in inputs:
+            start = time.perf_counter()
+            with open_input(filename) as input_fh:
+                for _ in input_fh:
+                    pass
+            read_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            mim_diseases = build_mim_diseases_dict(filename)
+            parse_time = time.perf_counter() - start
+            if mim_genes(mim_diseases) != reference:
+                raise AssertionError('%s input disagrees' % name)
+
+            megabytes = len(data) / 1e6
+            print(f"  genemap [{name}, {os.path.getsize(filename)} bytes]: "
+                  f"read {read_time:.3f}s ({megabytes / read_time:.0f} MB/s), "
+                  f"parse {parse_time:.3f}s ({megabytes / parse_time:.0f} MB/s)")
+
+
+def bench_documents(obo_filename, genemap_filename):
+    """
+    Time `legacy_create_geneset()` against `create_geneset()` for all
+    genesets, on fake MyGene.info hits (see `fake_mygene_hit()`).
+    """
+
+    disease_ontology, doid_omim_dict = load_disease_ontology(obo_filename)
+    mim_diseases = build_mim_diseases_dict(genemap_filename)
+    add_term_annotations(doid_omim_dict, disease_ontology, mim_diseases)
+    gene_index = propagate_bitsets(disease_ontology)
+
+    terms = [
+        (term_id, term, gene_index.decode(term.gene_bits | term.cutoff_gene_bits))
+        for term_id, term in disease_ontology.go_terms.items()
+    ]
+    terms = [(term_id, term, gid_list) for term_id, term, gid_list in terms if gid_list]
+    hits = {str(gid): fake_mygene_hit(gid) for gid in gene_index.gids}
+
+    start = time.perf_counter()
+    legacy_docs = [
+        legacy_create_geneset(term_id, term, gid_list, hits, doid_omim_dict)
+        for term_id, term, gid_list in terms
+    ]
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    genes_info = {
+        q_str: create_gene_record(q_str, hit) for q_str, hit in hits.items()
+    }
+    docs = [
+        create_geneset(term_id, term, gid_list, genes_info, doid_omim_dict)
+        for term_id, term, gid_list in terms
+    ]
+    seconds = time.perf_counter() - start
+
+    if json.dumps(docs) != json.dumps(legacy_docs):
+        raise AssertionError('Geneset documents differ on %s' % obo_filename)
+
+    print(f"  documents [legacy]: {legacy_seconds:.3f}s (1.0x)")
+    print(f"  documents [clean]: {seconds:.3f}s ({legacy_seconds / seconds:.1f}x)")
+
+
+def bench_dedup(obo_filename, genemap_filename, threshold=0.9):
+    """
+    Time the collapse of redundant genesets (see `DEDUP_MODE`), and report
+    how much smaller the JSON documents are with duplicates replaced by
+    references, on fake MyGene.info hits (see `fake_mygene_hit()`).
+    """
+
+    disease_ontology, doid_omim_dict = load_disease_ontology(obo_filename)
+    mim_diseases = build_mim_diseases_dict(genemap_filename)
+    add_term_annotations(doid_omim_dict, disease_ontology, mim_diseases)
+    gene_index = propagate_bitsets(disease_ontology)
+
+    term_labels = dict()
+    for term_id, term in disease_ontology.go_terms.items():
+        gid_list = gene_index.decode(term.gene_bits | term.cutoff_gene_bits)
+        if gid_list:
+            term_labels[term_id] = get_term_labels(term, gid_list)
+    genes_info = {
+        str(gid): create_gene_record(str(gid), fake_mygene_hit(gid))
+        for gid in gene_index.gids
+    }
+    genesets = list(iter_assembled_genesets(
+        term_labels, genes_info, doid_omim_dict, processes=1))
+    gs_ids = {gs['disease_ontology']['id']: gs['_id'] for gs in genesets}
+
+    start = time.perf_counter()
+    duplicates = find_duplicate_genesets(term_labels)
+    exact_seconds = time.perf_counter() - start
+
+    near_duplicates = None
+    if np is not None:
+        start = time.perf_counter()
+        near_duplicates = find_near_duplicates({
+            term_id: labels for term_id, labels in term_labels.items()
+            if term_id not in duplicates
+        }, threshold)
+        near_seconds = time.perf_counter() - start
+
+    collapsed = iter_collapsed_genesets(
+        [dict(gs) for gs in genesets], gs_ids, duplicates, near_duplicates,
+        reference=True
+    )
+    size = sum(len(json.dumps(gs)) for gs in genesets)
+    collapsed_size = sum(len(json.dumps(gs)) for gs in collapsed)
+
+    print(f"  dedup [exact]: {exact_seconds:.3f}s, "
+          f"{len(duplicates)} of {len(genesets)} genesets are duplicates")
+    if near_duplicates is not None:
+        pairs = sum(len(others) for others in near_duplicates.values()) // 2
+        print(f"  dedup [minhash, jaccard >= {threshold}]: {near_seconds:.3f}s, "
+              f"{pairs} near-duplicate pairs")
+    print(f"  dedup [reference]: {size} -> {collapsed_size} bytes "
+          f"({size / collapsed_size:.2f}x)")
+
+
+def generate_obo(obo_filename, n_terms=HUMANDO_TERMS, depth=12, fan_in=1.5,
+                 xref_density=0.3, relationship_rate=0.02, obsolete_rate=0.01,
+                 seed=0):
+    """
+    Write a synthetic DO OBO file.
+
+    Terms are laid out in `depth` levels of equal size under a single
+    root. Each term has a first `is_a` parent in the level right above it,
+    and extra parents from any level above it, for `fan_in` parents per
+    term on average. A `relationship_rate` fraction of the terms also has
+    a `part_of` or `regulates` parent, an `xref_density` fraction has
+    one to three OMIM xrefs, and an `obsolete_rate` fraction of the leaves
+    are obsolete (without xrefs, since obsolete terms are not parsed).
+
+    Returns:
+    The sorted list of OMIM IDs used by the xrefs.
+    """
+    rnd = random.Random(seed)
+    extra_parent_rate = (fan_in - 1) / fan_in
+    levels = [[1]]
+    omim_ids = set()
+    with open(obo_filename, 'w') as obo_fh:
+        obo_fh.write(
+            'format-version: 1.2\n'
+            'data-version: doid/releases/2021-12-15/doid-non-classified.obo\n'
+            '\n'
+        )
+        for doid in range(1, n_terms + 1):
+            level = 0 if doid == 1 else 1 + (doid - 2) * (depth - 1) // max(n_terms - 1, 1)
+            if doid > 1:
+                if level == len(levels):
+                    levels.append([])
+                levels[level].append(doid)
+
+            lines = [
+                '[Term]',
+                'id: DOID:%d' % doid,
+                'name: synthetic disease %d' % doid,
+                'def: "A synthetic disease at level %d." [url:http://example.org]' % level,
+            ]
+            is_obsolete = level == depth - 1 and rnd.random() < obsolete_rate
+            for _ in range(not is_obsolete and rnd.random() < xref_density
+                           and rnd.randint(1, 3)):
+                omim_id = 100000 + rnd.randrange(max(n_terms, 1000))
+                omim_ids.add(omim_id)
+                lines.append('xref: OMIM:%d' % omim_id)
+
+            if is_obsolete:
+                lines.append('is_obsolete: true')
+            elif doid > 1:
+                parents = {rnd.choice(levels[level - 1])}
+                while rnd.random() < extra_parent_rate:
+                    parents.add(rnd.choice(levels[rnd.randrange(level)]))
+                for parent in sorted(parents):
+                    lines.append('is_a: DOID:%d ! synthetic disease %d' % (parent, parent))
+                if rnd.random() < relationship_rate:
+                    kind = rnd.choice(['part_of', 'regulates'])
+                    parent = rnd.choice(levels[rnd.randrange(level)])
+                    lines.append('relationship: %s DOID:%d ! x' % (kind, parent))
+            obo_fh.write('\n'.join(lines) + '\n\n')
+
+    return sorted(omim_ids)
+
+
+def generate_genemap(genemap_filename, omim_ids, genes_per_disease=2.0,
+                     n_genes=GENEMAP_GENES, seed=0):
+    """
+    Write a synthetic genemap2 file, where each MIM disease ID in
+    `omim_ids` is a phenotype of `genes_per_disease` genes on average,
+    drawn from `n_genes` genes. One in ten disorders has another mapping
+    key than "(3)" or a "[", "{" or "?" prefix, like in the real file.
+    """
+    rnd = random.Random(seed)
+    extra_gene_rate = (genes_per_disease - 1) / genes_per_disease
+    gene_disorders = {}
+    for omim_id in omim_ids:
+        genes = {rnd.randint(1, n_genes)}
+        while rnd.random() < extra_gene_rate:
+            genes.add(rnd.randint(1, n_genes))
+        for gid in genes:
+            mapping_key, prefix = 3, ''
+            if rnd.random() < 0.1:
+                mapping_key, prefix = rnd.choice(
+                    [(1, ''), (2, ''), (4, ''), (3, '['), (3, '{'), (3, '?')])
+            gene_disorders.setdefault(gid, []).append(
+                '%sSynthetic disease %d, %d (%d), Autosomal recessive'
+                % (prefix, omim_id, omim_id, mapping_key)
+            )
+
+    with open(genemap_filename, 'w') as genemap_fh:
+        genemap_fh.write(
+            '# Copyright (c) 1966-2021 Johns Hopkins University.\n'
+            '# Generated: 2021-12-19\n'
+            '# Chromosome\tGenomic Position Start\tGenomic Position End\t'
+            'Cyto Location\tComputed Cyto Location\tMIM Number\t'
+            'Gene Symbols\tGene Name\tApproved Gene Symbol\t'
+            'Entrez Gene ID\tEnsembl Gene ID\tComments\tPhenotypes\t'
+            'Mouse Gene Symbol/ID\n'
+        )
+        for gid in sorted(gene_disorders):
+            genemap_fh.write('\t'.join([
+                'chr1', '0', '1', '1p36', '', str(600000 + gid),
+                'GENE%d' % gid, 'Gene %d' % gid, 'GENE%d' % gid, str(gid),
+                '', '', '; '.join(gene_disorders[gid]), '',
+            ]) + '\n')
+
+
+def generate_ncbi_genes(gene_info_filename, gene_history_filename,
+                        n_genes=GENEMAP_GENES, seed=0):
+    """
+    Write synthetic NCBI "gene_info" and "gene_history" files, with 40
+    human genes per genemap gene (like the ~190,000 human genes of NCBI)
+    and mouse genes in between. One in ten of the genes 1 to `n_genes` is
+    discontinued, and replaced by another gene or by none.
+    """
+    rnd = random.Random(seed)
+    with open(gene_info_filename, 'w') as gene_info_fh, \
+            open(gene_history_filename, 'w') as history_fh:
+        gene_info_fh.write('#tax_id\tGeneID\tSymbol\tLocusTag\tSynonyms\t'
+                           'dbXrefs\tchromosome\tmap_location\tdescription\n')
+        history_fh.write('#tax_id\tGeneID\tDiscontinued_GeneID\t'
+                         'Discontinued_Symbol\tDiscontinue_Date\n')
+        for gid in range(1, 40 * n_genes + 1):
+            if gid <= n_genes and rnd.random() < 0.1:
+                target = '-' if rnd.random() < 0.2 else str(n_genes + gid)
+                history_fh.write('%d\t%s\t%d\tOLD%d\t20200101\n'
+                                 % (TAX_ID, target, gid, gid))
+                continue
+            xrefs = 'MIM:%d|HGNC:HGNC:%d' % (600000 + gid, gid)
+            if rnd.random() < 0.7:
+                xrefs += '|Ensembl:ENSG%011d' % gid
+            gene_info_fh.write('%d\t%d\tGENE%d\t-\t-\t%s\t1\t1p36\tgene %d\n'
+                               % (TAX_ID, gid, gid, xrefs, gid))
+            if gid % 4 == 0:
+                gene_info_fh.write('10090\t%d\tMouse%d\t-\t-\t-\t1\t-\t-\n'
+                                   % (gid + 10 ** 8, gid))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for MyGene.info (`POST /v3/query`) and for the download
+    URLs of the data files (`GET /<file name>`, with Range and ETag
+    support), so that benchmarks do not depend on the network.
+    """
+
+    files = {}  # URL path -> file name
+
+    def do_GET(self):
+        with open(self.files[self.path], 'rb') as data_fh:
+            body = data_fh.read()
+        etag = '"%d"' % len(body)
+        if self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        elif self.headers.get('Range'):
+            first, last = self.headers['Range'].split('=')[1].split('-')
+            status, body = 206, body[int(first):int(last) + 1]
+        else:
+            status = 200
+        self.send_body(status, body, 'text/plain; charset=utf-8', etag)
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        params = parse_qs(self.rfile.read(length).decode())
+        hits = [
+            fake_mygene_hit(int(term.strip('"'))) | {'query': term.strip('"')}
+            for term in params['q'][0].split(',')
+        ]
+        self.send_body(200, json.dumps(hits).encode(), 'application/json')
+
+    def send_body(self, status, body, content_type, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def stub_server(files=None):
+    """
+    Run a `StubHandler` server in the background, serving `files` (a
+    dictionary of URL paths to file names), and point `parser.MYGENE_URL`
+    at it. Yields the base URL of the server.
+    """
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    StubHandler.files = files or {}
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+    mygene_url = parser.MYGENE_URL
+    parser.MYGENE_URL = base_url + '/v3'
+    try:
+        yield base_url
+    finally:
+        parser.MYGENE_URL = mygene_url
+        server.shutdown()
+        server.server_close()
+
+
+def timed(timings, name, func, *args, **kwargs):
+    """Call `func(*args, **kwargs)`, and add its wall time to `timings`."""
+
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[name] = time.perf_counter() - start
+    return result
+
+
+def bench_suite(scale, work_dir, seed=0):
+    """
+    Generate synthetic data `scale` times the size of HumanDO and genemap2,
+    and time each public stage of parser.py and `get_release()` on it.
+
+    Returns:
+    A dictionary with the generator parameters, the data sizes, the wall
+    time of each stage and the `PipelineMetrics` report of a full run.
+    """
+
+    params = {
+        'n_terms': int(HUMANDO_TERMS * scale),
+        'depth': 12,
+        'fan_in': 1.5,
+        'xref_density': 0.3,
+        'genes_per_disease': 2.0,
+        'n_genes': int(GENEMAP_GENES * scale),
+    }
+    obo_filename = os.path.join(work_dir, 'HumanDO.obo')
+    genemap_filename = os.path.join(work_dir, 'genemap2.txt')
+    omim_ids = generate_obo(
+        obo_filename, params['n_terms'], params['depth'], params['fan_in'],
+        params['xref_density'], seed=seed
+    )
+    generate_genemap(
+        genemap_filename, omim_ids, params['genes_per_disease'],
+        params['n_genes'], seed=seed
+    )
+
+    timings = {}
+    with stub_server({
+            '/HumanDO.obo': obo_filename,
+            '/genemap2.txt': genemap_filename}) as base_url:
+        dumper = SimpleNamespace(
+            SRC_URLS=[base_url + '/HumanDO.obo', base_url + '/genemap2.txt'],
+            src_root_folder=work_dir
+        )
+        timed(timings, 'get_release', get_release, dumper)
+        timed(timings, 'get_release (not modified)', get_release, dumper)
+
+        disease_ontology, doid_omim_dict = timed(
+            timings, 'load_disease_ontology', load_disease_ontology, obo_filename)
+        snapshot_filename = os.path.join(work_dir, 'HumanDO.snapshot')
+        timed(timings, 'save_ontology_snapshot', save_ontology_snapshot,
+              disease_ontology, snapshot_filename)
+        timed(timings, 'load_ontology_snapshot', load_ontology_snapshot,
+              snapshot_filename)
+
+        mim_diseases = timed(timings, 'build_mim_diseases_dict',
+                             build_mim_diseases_dict, genemap_filename)
+        timed(timings, 'build_mim_gene_table',
+              build_mim_gene_table, genemap_filename)
+        _, genemap_lines, _ = update_mim_diseases_dict(genemap_filename)
+        timed(timings, 'update_mim_diseases_dict (unchanged)',
+              update_mim_diseases_dict, genemap_filename, genemap_lines)
+
+        entrez_set = timed(timings, 'add_term_annotations', add_term_annotations,
+                           doid_omim_dict, disease_ontology, mim_diseases)
+        genes_info = timed(timings, 'query_mygene', query_mygene,
+                           entrez_set, TAX_ID)
+
+        gene_info_filename = os.path.join(work_dir, 'gene_info')
+        gene_history_filename = os.path.join(work_dir, 'gene_history')
+        generate_ncbi_genes(gene_info_filename, gene_history_filename,
+                            params['n_genes'], seed=seed)
+        timed(timings, 'NCBIGeneIndex.build', NCBIGeneIndex.load,
+              gene_info_filename, gene_history_filename).close()
+        with timed(timings, 'NCBIGeneIndex.load', NCBIGeneIndex.load,
+                   gene_info_filename, gene_history_filename) as gene_index:
+            timed(timings, 'query_mygene (NCBIGeneClient)', query_mygene,
+                  entrez_set, TAX_ID, client=NCBIGeneClient(gene_index))
+
+        # Multiple inheritance is what makes propagation slow, so all
+        # engines that can finish in reasonable time are run.
+        engines = [
+            ('propagate_bitsets', propagate_bitsets,
+             lambda do, gene_index: propagated_genes(do, gene_index)),
+        ]
+        if parser.sparse is not None:
+            engines.append(('propagate_sparse', propagate_sparse, None))
+        if params['n_terms'] <= MAX_TOPOLOGICAL_TERMS:
+            engines.append(('propagate', GO.propagate,
+                            lambda do, _: propagated_genes(do)))
+        if params['n_terms'] <= MAX_LEGACY_TERMS:
+            engines.append(('legacy_propagate', legacy_propagate,
+                            lambda do, _: propagated_genes(do)))
+        term_genes = None
+        for name, propagate, read_genes in engines:
+            engine_do = load_annotated_ontology(obo_filename, genemap_filename)
+            start = time.perf_counter()
+            result = propagate(engine_do)
+            if read_genes is not None:
+                result = read_genes(engine_do, result)
+            timings[name] = time.perf_counter() - start
+            if term_genes is None:
+                term_genes = result
+            elif result != term_genes:
+                raise AssertionError('%s disagrees at scale %s' % (name, scale))
+            del engine_do, result
+
+        timed(timings, 'TermIndex', TermIndex, disease_ontology)
+
+        term_labels = {
+            term_id: get_term_labels(disease_ontology.go_terms[term_id], gid_list)
+            for term_id, gid_list in term_genes.items() if gid_list
+        }
+        del term_genes
+        genesets = timed(
+            timings, 'iter_assembled_genesets', list,
+            iter_assembled_genesets(term_labels, genes_info, doid_omim_dict)
+        )
+        geneset_count = len(genesets)
+        del term_labels, disease_ontology
+
+        timed(timings, 'export_genesets', export_genesets,
+              genesets, os.path.join(work_dir, 'export'))
+        del genesets
+
+        # Full pipeline, with the per-stage metrics of `iter_genesets()`
+        metrics = PipelineMetrics()
+        for _ in iter_genesets(
+                obo_filename, genemap_filename, compact=True, metrics=metrics):
+            pass
+
+    return {
+        'scale': scale,
+        'params': params,
+        'sizes': {
+            'obo_bytes': os.path.getsize(obo_filename),
+            'genemap_bytes': os.path.getsize(genemap_filename),
+            'omim_ids': len(omim_ids),
+            'entrez_ids': len(entrez_set),
+            'genesets': geneset_count,
+        },
+        'timings': timings,
+        'pipeline': metrics.report(),
+    }
+
+
+def bench_batch(work_dir, n_releases=30, obo_versions=3, scale=1, seed=0):
+    """
+    Compare a backfill of `n_releases` synthetic releases built one by one
+    with `iter_genesets()` to the same backfill built by
+    `iter_release_genesets()`. The OBO file changes `obo_versions` times
+    and about 1% of the genemap lines change between releases, like in
+    daily releases.
+    """
+
+    rnd = random.Random(seed)
+    n_terms = int(HUMANDO_TERMS * scale)
+    base_genemap = os.path.join(work_dir, 'genemap2.base.txt')
+    omim_ids = set()
+    obo_filenames = []
+    for version in range(obo_versions):
+        obo_filenames.append(os.path.join(work_dir, 'HumanDO.%d.obo' % version))
+        omim_ids.update(generate_obo(obo_filenames[-1], n_terms, seed=seed + version))
+    generate_genemap(base_genemap, sorted(omim_ids),
+                     n_genes=int(GENEMAP_GENES * scale), seed=seed)
+
+    with open(base_genemap) as genemap_fh:
+        lines = genemap_fh.readlines()
+    header, gene_lines = lines[:3], lines[3:]
+    releases = []
+    for idx in range(n_releases):
+        gene_lines = [line for line in gene_lines if rnd.random() > 0.005]
+        gene_lines += rnd.sample(lines[3:], len(lines) // 200)
+        genemap_filename = os.path.join(work_dir, 'genemap2.%d.txt' % idx)
+        with open(genemap_filename, 'w') as genemap_fh:
+            genemap_fh.writelines(header + gene_lines)
+        obo_filename = obo_filenames[idx * obo_versions // n_releases]
+        releases.append((obo_filename, genemap_filename))
+
+    with stub_server():
+        start = time.perf_counter()
+        one_by_one = []
+        for release in releases:
+            one_by_one.append(sum(
+                1 for _ in iter_genesets(*release, compact=True)))
+        one_by_one_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch = []
+        for _, genesets in iter_release_genesets(releases):
+            batch.append(sum(1 for _ in genesets))
+        batch_time = time.perf_counter() - start
+
+    assert batch == one_by_one
+    print(f"  {n_releases} releases of {n_terms} terms:")
+    print(f"    iter_genesets, one by one: {one_by_one_time:.3f}s")
+    print(f"    iter_release_genesets: {batch_time:.3f}s "
+          f"({one_by_one_time / batch_time:.1f}x)")
+
+
+def get_commit():
+    """Return the current git commit of the repository, or None."""
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(scales, results_dir=RESULTS_DIRNAME, seed=0):
+    """
+    Run `bench_suite()` at each scale, print its timings, and save all
+    results to a JSON file in `results_dir` named after the current commit.
+
+    Returns:
+    The name of the saved file.
+    """
+
+    commit = get_commit()
+    results = {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'seed': seed,
+        'runs': [],
+    }
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as work_dir:
+            run = bench_suite(scale, work_dir, seed)
+        results['runs'].append(run)
+        print(f"scale {scale}x: {run['params']['n_terms']} terms, "
+              f"{run['sizes']['genesets']} genesets")
+        for name, seconds in run['timings'].items():
+            print(f"  {name}: {seconds:.3f}s")
+
+    os.makedirs(results_dir, exist_ok=True)
+    results_filename = os.path.join(
+        results_dir, '%s-%s.json' % (commit or 'unknown', time.strftime('%Y%m%d%H%M%S'))
+    )
+    with open(results_filename, 'w') as results_fh:
+        json.dump(results, results_fh, indent=2)
+    print(f"Results saved to {results_filename}")
+    return results_filename
+
+
+def compare_results(old_filename, new_filename):
+    """Print the timings of two saved suite results side by side."""
+
+    with open(old_filename) as old_fh, open(new_filename) as new_fh:
+        old_results, new_results = json.load(old_fh), json.load(new_fh)
+
+    print(f"{old_results['commit']} -> {new_results['commit']}")
+    old_runs = {run['scale']: run for run in old_results['runs']}
+    for new_run in new_results['runs']:
+        old_run = old_runs.get(new_run['scale'])
+        if old_run is None:
+            continue
+        print(f"scale {new_run['scale']}x:")
+        for name, seconds in new_run['timings'].items():
+            old_seconds = old_run['timings'].get(name)
+            if old_seconds is None:
+                print(f"  {name}: {seconds:.3f}s (new)")
+            else:
+                print(f"  {name}: {old_seconds:.3f}s -> {seconds:.3f}s "
+                      f"({old_seconds / seconds:.2f}x)")
+
+
+def bench_data_files():
+    """Run the benchmarks on the real data files of `DATA_FILES`."""
+
+    for obo_filename, genemap_filename in DATA_FILES:
+        if os.path.exists(genemap_filename):
+            print(genemap_filename)
+            bench_genemap(genemap_filename)
+            bench_compression(genemap_filename)
+
+        if not (os.path.exists(obo_filename) and os.path.exists(genemap_filename)):
+            print(f"Skipping {obo_filename}: data file(s) not found", file=sys.stderr)
+            continue
+
+        print(obo_filename)
+        bench_propagate(obo_filename, genemap_filename)
+        bench_terms(obo_filename, genemap_filename)
+        bench_index(obo_filename, genemap_filename)
+        bench_documents(obo_filename, genemap_filename)
+        bench_dedup(obo_filename, genemap_filename)
+
+
+# Benchmark harness
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = arg_parser.add_subparsers(dest='command')
+    suite_parser = subparsers.add_parser(
+        'suite', help='Benchmark all stages on synthetic data')
+    suite_parser.add_argument(
+        '--scale', type=float, nargs='+', default=[1],
+        help='Sizes of the synthetic data, relative to HumanDO (e.g. 1 10 100)')
+    suite_parser.add_argument('--seed', type=int, default=0)
+    suite_parser.add_argument('--output', default=RESULTS_DIRNAME)
+    batch_parser = subparsers.add_parser(
+        'batch', help='Benchmark a backfill of synthetic releases')
+    batch_parser.add_argument('--releases', type=int, default=30)
+    batch_parser.add_argument('--scale', type=float, default=1)
+    batch_parser.add_argument('--seed', type=int, default=0)
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare two saved suite results')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    args = arg_parser.parse_args()
+
+    if args.command == 'suite':
+        run_suite(args.scale, args.output, args.seed)
+    elif args.command == 'batch':
+        with tempfile.TemporaryDirectory() as work_dir:
+            bench_batch(work_dir, args.releases, scale=args.scale, seed=args.seed)
+    elif args.command == 'compare':
+        compare_results(args.old, args.new)
+    else:
+        bench_data_files()
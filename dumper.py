@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+
+try:                         # run as a data plugin module of Biothings SDK
+    from biothings import config
+    from biothings.hub.dataload.dumper import BaseDumper
+    logging = config.logger
+except Exception:            # run locally as a standalone script
+    import logging
+    BaseDumper = object
+
+# Files are downloaded into this directory of the dumper's root folder,
+# where partial downloads and the state of each URL (validators, release
+# and number of requests per day) are kept across runs.
+DOWNLOAD_DIRNAME = 'downloads'
+DOWNLOAD_STATE_FILENAME = 'download_state.json'
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_TIMEOUT = 60  # Seconds
+
+# OMIM caps the downloads of genemap2.txt to 10 per day (see
+# "data/README.md"), so requests to these hosts (and their subdomains) are
+# limited per UTC day, with a margin for manual downloads. The default
+# "data_url" of manifest.json downloads genemap2.txt from a GitHub mirror,
+# which has no such limit; this one applies once it points at OMIM itself
+# (e.g. "https://data.omim.org/downloads/<key>/genemap2.txt"). Limits can
+# also be set per dumper by `DiseaseOntologyDumper.DAILY_REQUEST_LIMITS`.
+DAILY_REQUEST_LIMITS = {'omim.org': 5}
+
+
+def get_daily_limit(url, daily_limits=None):
+    """
+    Return the number of requests per day allowed to `url` by
+    `daily_limits` (`DAILY_REQUEST_LIMITS` by default), or None.
+    """
+    if daily_limits is None:
+        daily_limits = DAILY_REQUEST_LIMITS
+    host = urlsplit(url).hostname or ''
+    for domain, limit in daily_limits.items():
+        if host == domain or host.endswith('.' + domain):
+            return limit
+    return None
+
+
+def get_file_release(filename):
+    """
+    Return the release date found in the header of a downloaded
+    "HumanDO.obo" or "genemap2.txt" file, the same way as
+    `version.get_release()`, or "" if there is none.
+    """
+    is_obo = filename.endswith(".obo")
+    with open(filename, 'r', errors='replace') as input_fh:
+        for line in input_fh:
+            if is_obo:
+                # "data-version: doid/releases/YYYY-MM-DD/doid-non-classified.obo"
+                if line.startswith("data-version: "):
+                    return line.strip().split(' ')[1].split('/')[2]
+                if line.startswith("[Term]"):
+                    break
+            else:
+                # "# Generated: YYYY-MM-DD"
+                if line.startswith("# Generated: "):
+                    return line.strip().split(': ')[1]
+                if line.strip() and not line.startswith("#"):
+                    break
+    return ""
+
+
+def get_release_string(releases):
+    """
+    Return the release string of the sources, in the format of
+    `version.get_release()`, from a {URL: release} dictionary.
+    """
+    obo_release = genemap2_release = ""
+    for url, release in releases.items():
+        if url.endswith("HumanDO.obo"):
+            obo_release = release
+        elif url.endswith("genemap2.txt"):
+            genemap2_release = release
+    return "obo-" + obo_release + "_" + "genemap2-" + genemap2_release
+
+
+class SourceDownloader:
+    """
+    Concurrent, resumable and change-aware downloader of source URLs.
+
+    All URLs are downloaded at the same time through one `requests.Session`,
+    so connections are reused. The ETag and Last-Modified headers of each
+    download are saved in `DOWNLOAD_STATE_FILENAME`, and sent back as
+    conditional headers, so a file that did not change is answered with
+    "304 Not Modified" and not downloaded again. A download is written to
+    a ".part" file first; if it is interrupted, the next run asks for the
+    rest of the file with a Range request, guarded by If-Range so that a
+    file that changed in the meantime is downloaded again in full.
+    Requests to the hosts of `daily_limits` (`DAILY_REQUEST_LIMITS` by
+    default) are counted per day, and not sent anymore once the limit is
+    reached.
+    """
+    def __init__(self, download_dir, session=None,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE, timeout=DOWNLOAD_TIMEOUT,
+                 daily_limits=None):
+        self.download_dir = download_dir
+        self.session = session or requests.Session()
+        self.daily_limits = daily_limits
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.state_filename = os.path.join(download_dir, DOWNLOAD_STATE_FILENAME)
+        self.state = {}
+        if os.path.exists(self.state_filename):
+            with open(self.state_filename) as state_fh:
+                self.state = json.load(state_fh)
+        self._lock = threading.Lock()
+
+    def save_state(self):
+        """Save the state of all URLs atomically."""
+        with self._lock:
+            tmp_filename = self.state_filename + '.tmp'
+            with open(tmp_filename, 'w') as state_fh:
+                json.dump(self.state, state_fh, indent=2)
+            os.replace(tmp_filename, self.state_filename)
+
+    def count_request(self, url):
+        """
+        Count a request to `url` today, and return False if it would exceed
+        its daily limit.
+        """
+        limit = get_daily_limit(url, self.daily_limits)
+        today = time.strftime('%Y-%m-%d', time.gmtime())
+        with self._lock:
+            entry = self.state.setdefault(url, {})
+            # Only today's count matters
+            requests_per_day = entry.get('requests', {})
+            entry['requests'] = {today: requests_per_day.get(today, 0)}
+            if limit is not None and entry['requests'][today] >= limit:
+                return False
+            entry['requests'][today] += 1
+        self.save_state()
+        return True
+
+    def download(self, url, force=False):
+        """
+        Download `url` into the download directory, unless it did not change.
+
+        Returns:
+        A dictionary with the local `filename`, whether the file `changed`
+        since the previous download, and its `release` (see
+        `get_file_release()`).
+        """
+        filename = os.path.join(
+            self.download_dir, os.path.basename(urlsplit(url).path))
+        part_filename = filename + '.part'
+        entry = self.state.get(url, {})
+        unchanged = {'filename': filename, 'changed': False,
+                     'release': entry.get('release', '')}
+
+        headers = {}
+        if not force and os.path.exists(filename):
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        partial = entry.get('partial')
+        if partial and os.path.exists(part_filename):
+            validator = partial.get('etag') or partial.get('last_modified')
+            if validator:
+                headers['Range'] = 'bytes=%d-' % os.path.getsize(part_filename)
+                headers['If-Range'] = validator
+
+        if not self.count_request(url):
+            if os.path.exists(filename):
+                logging.warning("Daily request limit of %s reached, "
+                                "keeping the previous download", url)
+                return unchanged
+            raise RuntimeError('Daily request limit of %s reached' % url)
+
+        with self.session.get(url, headers=headers, stream=True,
+                              timeout=self.timeout) as resp:
+            if resp.status_code == 304 and os.path.exists(filename):
+                logging.info("%s is not modified", url)
+                return unchanged
+            resp.raise_for_status()
+
+            if resp.status_code == 206:
+                logging.info("Resuming download of %s", url)
+                mode = 'ab'
+            else:
+                mode = 'wb'
+                with self._lock:
+                    self.state.setdefault(url, {})['partial'] = {
+                        'etag': resp.headers.get('ETag'),
+                        'last_modified': resp.headers.get('Last-Modified'),
+                    }
+                self.save_state()
+
+            with open(part_filename, mode) as part_fh:
+                for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                    part_fh.write(chunk)
+
+        os.replace(part_filename, filename)
+        release = get_file_release(filename)
+        with self._lock:
+            entry = self.state.setdefault(url, {})
+            partial = entry.pop('partial', {})
+            entry.update({
+                'etag': partial.get('etag'),
+                'last_modified': partial.get('last_modified'),
+                'release': release,
+                'size': os.path.getsize(filename),
+            })
+        self.save_state()
+        logging.info("Downloaded %s (release %s)", url, release)
+        return {'filename': filename, 'changed': True, 'release': release}
+
+    def download_all(self, urls, force=False):
+        """
+        Download all `urls` concurrently (see `download()`), and return a
+        dictionary that maps each URL to its result.
+        """
+        os.makedirs(self.download_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+            futures = {url: executor.submit(self.download, url, force) for url in urls}
+            return {url: future.result() for url, future in futures.items()}
+
+
+class DiseaseOntologyDumper(BaseDumper):
+    """
+    Dumper of the "data_url" sources of manifest.json, set as the "class"
+    of its dumper section.
+
+    Unlike the default dumper, which calls `version.get_release()` to
+    download the headers of both files before downloading them again, all
+    files are first downloaded by a `SourceDownloader` into the
+    `DOWNLOAD_DIRNAME` directory, and the release is read from the
+    downloaded files. If no file changed and the release is the current
+    one, there is nothing to dump; otherwise the downloaded files are
+    copied into the data folder of the release.
+
+    `DAILY_REQUEST_LIMITS` maps hosts to the number of requests per day
+    allowed to them (see the module constant of the same name).
+    """
+
+    SRC_URLS = []  # Set from "data_url" by the generated dumper class
+    DAILY_REQUEST_LIMITS = DAILY_REQUEST_LIMITS
+
+    def prepare_client(self):
+        self.client = requests.Session()
+
+    def need_prepare(self):
+        return not self._state.get("client")
+
+    def release_client(self):
+        if self._state.get("client"):
+            self._state["client"].close()
+            self.client = None
+
+    def remote_is_better(self, remotefile, localfile):
+        return True
+
+    def create_todump_list(self, force=False, **kwargs):
+        downloader = SourceDownloader(
+            os.path.join(self.src_root_folder, DOWNLOAD_DIRNAME),
+            session=self.client,
+            daily_limits=self.DAILY_REQUEST_LIMITS
+        )
+        results = downloader.download_all(self.__class__.SRC_URLS, force=force)
+        self.release = get_release_string(
+            {url: result['release'] for url, result in results.items()})
+        self.downloaded_files = {
+            url: result['filename'] for url, result in results.items()
+        }
+
+        changed = any(result['changed'] for result in results.values())
+        if force or changed or self.release != self.current_release:
+            for url in self.__class__.SRC_URLS:
+                self.to_dump.append({
+                    "remote": url,
+                    "local": os.path.join(self.new_data_folder, os.path.basename(url)),
+                })
+
+    def download(self, remotefile, localfile):
+        # Files were downloaded by `create_todump_list()` already
+        self.prepare_local_folders(localfile)
+        shutil.copyfile(self.downloaded_files[remotefile], localfile)
+
+
+# Test harness
+if __name__ == "__main__":
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "manifest.json")) as manifest_fh:
+        urls = json.load(manifest_fh)["dumper"]["data_url"]
+    results = SourceDownloader("./data/" + DOWNLOAD_DIRNAME).download_all(urls)
+    print(json.dumps(results, indent=2))
+    print(get_release_string(
+        {url: result['release'] for url, result in results.items()}))
@@ -1,15 +1,60 @@
 #!/usr/bin/env python3
 
+import bisect
+import bz2
+import cProfile
+import gzip
+import hashlib
+import io
 import json
+import lzma
+import mmap
 import os
+import pstats
+import queue
 import re
+import sqlite3
 import sys
-
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from array import array
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from contextlib import closing, contextmanager
 from datetime import date
 
 import mygene
 from biothings.utils.dataload import dict_sweep, unlist
 
+try:                         # not available on Windows
+    import resource
+except ImportError:
+    resource = None
+
+try:                         # optional, only used by `GO.propagate_sparse()`
+    import numpy as np       # and `find_near_duplicates()`
+    from scipy import sparse
+except ImportError:
+    np = None
+    sparse = None
+
+try:                         # optional, only used by `open_input()`
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:                         # optional, only used by `export_genesets()`
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 try:                         # run as a data plugin module of Biothings SDK
     from biothings import config
     logging = config.logger
@@ -20,28 +65,176 @@ except Exception:            # run locally as a standalone script
 
 TAX_ID = 9606  # Taxonomy ID of human being
 
+# MyGene.info query results are cached in this SQLite file, which is kept
+# next to the data directory so that it survives across releases.
+# Set it to None to query MyGene.info for all genes on every run.
+MYGENE_CACHE_FILENAME = 'mygene_cache.sqlite'
+MYGENE_CACHE_TTL = 7 * 24 * 3600  # Seconds before a cached gene is re-queried
+MYGENE_OFFLINE = False  # If True, genes are served from the cache only
+MYGENE_URL = None  # MyGene.info API URL, None for the default one
+MYGENE_BATCH_SIZE = 1000  # Genes per MyGene.info request (1000 at most)
+MYGENE_CONCURRENCY = 4  # MyGene.info requests running at the same time
+MYGENE_RETRIES = 3  # Retries of a failed MyGene.info request
+MYGENE_BACKOFF = 1.0  # Seconds before the first retry, doubled on each retry
+
+# Input files (OBO, genemap2, NCBI genes) may be compressed; `open_input()`
+# detects the format from these magic numbers and decompresses it as a
+# stream, reading the file in blocks of INPUT_BUFFER_SIZE bytes.
+COMPRESSION_MAGIC = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+]
+INPUT_BUFFER_SIZE = 1 << 20
+
+# Genes can be resolved offline from NCBI "gene_info" and "gene_history"
+# files kept next to the data directory (see `NCBIGeneIndex`); only the
+# genes missing from them are queried from MyGene.info. None to disable.
+NCBI_GENE_INFO_FILENAME = None  # e.g. 'Homo_sapiens.gene_info'
+NCBI_GENE_HISTORY_FILENAME = None  # e.g. 'gene_history'
+NCBI_INDEX_MAGIC = b'NCBIGIX1'
+
+# Binary snapshots of parsed OBO files are saved in this directory (next to
+# the data directory), so an unchanged OBO file does not need to be parsed
+# again. Set it to None to always parse the OBO file.
+SNAPSHOT_DIRNAME = 'ontology_snapshots'
+SNAPSHOT_MAGIC = b'DOSNAP01'
+
+# Geneset documents can be assembled by a pool of worker processes, in
+# chunks of DO terms. 1 (the default) assembles them in the main process,
+# and None means one process per CPU. Assembling a document is cheap, so
+# the pool only pays off when it outweighs copying the inputs to each
+# worker and the documents back.
+ASSEMBLY_PROCESSES = 1
+ASSEMBLY_CHUNK_SIZE = 250
+
+# Metrics of each stage of `load_data()` are logged, and saved as a JSON
+# report in this file next to the data directory (None to not save them).
+# cProfile and tracemalloc captures are opt-in, as they slow the run down.
+METRICS_FILENAME = 'pipeline_metrics.json'
+METRICS_PROFILE = False
+METRICS_TRACE_MEMORY = False
+
+# State of the previous run of `load_data_incremental()`, kept next to the
+# data directory.
+BUILD_STATE_FILENAME = 'geneset_state.json'
+
+# Releases of `iter_release_genesets()` are prepared by a pool of worker
+# processes. None means one process per CPU, and 1 prepares them in the
+# main process.
+BATCH_PROCESSES = None
+
+# Bulk exports of `export_genesets()`: number of compressed NDJSON shards,
+# and name of the manifest file written next to them.
+EXPORT_SHARDS = 8
+EXPORT_MANIFEST_FILENAME = 'manifest.json'
+
+# Optional collapse of redundant genesets by `iter_genesets()`, e.g. of a
+# DO term whose genes all come from its only annotated child. None keeps
+# all genesets as they are; 'annotate' lists the IDs of the other genesets
+# with the same genes in each of them; 'reference' also replaces the genes
+# of each duplicate by the ID of its canonical geneset. With a Jaccard
+# similarity threshold below 1, near-duplicates are found by MinHash/LSH
+# (which needs NumPy) and annotated as well.
+DEDUP_MODE = None
+DEDUP_JACCARD_THRESHOLD = 1.0
+MINHASH_PERMUTATIONS = 128
+MINHASH_SEED = 0
+
 # Varibles when searching MIM Disease ID from "Phenotypes" column in "genemap2.txt"
 FIND_MIMID = re.compile('\, [0-9]* \([1-4]\)')  # Regex pattern
 PHENOTYPE_FILTER = '(3)'
+PHENOTYPE_MAPPING_KEY = '3'  # `PHENOTYPE_FILTER` without parentheses
+
+# Same as `FIND_MIMID`, with groups for the MIM disease ID and the
+# phenotype mapping key, to find all of them in a "Phenotypes" column at once.
+FIND_MIMIDS = re.compile(r', ([0-9]*) \(([1-4])\)')
+
+# Variables when searching DO IDs and OMIM xrefs in the DO OBO file
+FIND_DOID = re.compile('DOID:[0-9]+')
+FIND_NUMBER = re.compile('[0-9]+')
+
+class DecompressedReader(io.BufferedReader):
+    """
+    Buffered reader of a decompressed stream, that also closes the
+    compressed file when it is closed.
+    """
+    def __init__(self, stream, compressed_fh, buffer_size):
+        super().__init__(stream, buffer_size)
+        self.compressed_fh = compressed_fh
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.compressed_fh.close()
+
+
+def open_input(filename, buffer_size=INPUT_BUFFER_SIZE):
+    """
+    Open an input text file for reading, like `open(filename, 'r')`.
+
+    If the file is compressed with gzip, bz2, xz or zstd (detected from its
+    first bytes, see `COMPRESSION_MAGIC`), it is decompressed on the fly,
+    without temporary files. Both the file and the decompressed stream are
+    read in blocks of `buffer_size` bytes. zstd needs the `zstandard`
+    package.
+    """
+    raw_fh = open(filename, 'rb', buffering=buffer_size)
+    magic = raw_fh.peek(8)[:8]
+    compression = None
+    for prefix, name in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            compression = name
+            break
+
+    if compression is None:
+        return io.TextIOWrapper(raw_fh, encoding='utf-8')
+
+    try:
+        if compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=raw_fh, mode='rb')
+        elif compression == 'bz2':
+            stream = bz2.BZ2File(raw_fh, mode='rb')
+        elif compression == 'xz':
+            stream = lzma.LZMAFile(raw_fh, mode='rb')
+        elif zstandard is None:
+            raise ImportError('Reading %s needs zstandard' % filename)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(
+                raw_fh, read_size=buffer_size, closefd=False)
+    except BaseException:
+        raw_fh.close()
+        raise
+    return io.TextIOWrapper(
+        DecompressedReader(stream, raw_fh, buffer_size), encoding='utf-8')
+
 
 # Based on `go` class in "annotation-refinery/go.py".
 # See https://github.com/greenelab/annotation-refinery
 class GO:
     heads = None
     alt_id2std_id = None
+    omim_xrefs = None
     populated = None
     s_orgs = None
 
     # populate this field if you want to mark this GO as organism specific
     go_organism_tax_id = None
 
-    def __init__(self):
+    # Class of the terms, `GOTerm` or the compact `DOTerm`
+    term_class = None
+
+    def __init__(self, term_class=None):
         """
         Initialize data structures for storing the tree.
         """
+        self.term_class = term_class or GOTerm
         self.heads = []
         self.go_terms = {}
         self.alt_id2std_id = {}
+        self.omim_xrefs = {}
         self.populated = False
         self.s_orgs = []
 
@@ -49,7 +242,7 @@ class GO:
         """Load obo from the defined location. """
         obo_fh = None
         try:
-            obo_fh = open(path)
+            obo_fh = open_input(path)
         except IOError:
             logging.error('Could not open %s on the local filesystem.', path)
 
@@ -64,85 +257,114 @@ class GO:
     def parse(self, obo_fh):
         """
         Parse the passed obo handle.
+
+        The handle is streamed line by line in a single pass. Besides the
+        term graph and `alt_id2std_id`, the OMIM cross-references of every
+        term are collected into `omim_xrefs` (same content as the
+        dictionary returned by `build_doid_omim_dict()`), so the file does
+        not need to be read a second time.
         """
         inside = False
         gterm = None
+        xref_doid = None
+        in_terms = False  # True once the first [Term] stanza has been seen
         for line in obo_fh:
-            fields = line.rstrip().split()
+            # Only split off the tag here; the value is tokenized further
+            # only by the branches that need it.
+            fields = line.split(None, 1)
 
             if len(fields) < 1:
                 continue
-            elif fields[0] == '[Term]':
+
+            tag = fields[0]
+            value = fields[1] if len(fields) > 1 else ''
+
+            if tag == '[Term]':
                 if gterm:
                     if gterm.head:
                         self.heads.append(gterm)
                 inside = True
-            elif fields[0] == '[Typedef]':
+                in_terms = True
+            elif tag == '[Typedef]':
                 if gterm:
                     if gterm.head:
                         self.heads.append(gterm)
                 inside = False
 
-            elif inside and fields[0] == 'id:':
-                if fields[1] in self.go_terms:
-                    #logging.debug("Term %s exists in GO()", fields[1])
-                    gterm = self.go_terms[fields[1]]
+            elif tag == 'id:':
+                if in_terms:
+                    xref_doid = FIND_DOID.search(value)
+                    if xref_doid:
+                        xref_doid = xref_doid.group(0)
+                if not inside:
+                    continue
+                go_id = value.split(None, 1)[0]
+                if go_id in self.go_terms:
+                    #logging.debug("Term %s exists in GO()", go_id)
+                    gterm = self.go_terms[go_id]
                 else:
-                    #logging.debug("Adding term %s to GO()", fields[1])
-                    gterm = GOTerm(fields[1])
+                    #logging.debug("Adding term %s to GO()", go_id)
+                    gterm = self.term_class(go_id)
                     self.go_terms[gterm.get_id()] = gterm
-            elif inside and fields[0] == 'def:':
-                desc = ' '.join(fields[1:])
+            elif tag == 'xref:':
+                if in_terms and value.startswith('OMIM:'):
+                    omim = FIND_NUMBER.search(value).group(0)
+                    if xref_doid not in self.omim_xrefs:
+                        self.omim_xrefs[xref_doid] = set()
+                    self.omim_xrefs[xref_doid].add(omim)
+            elif not inside:
+                continue
+            elif tag == 'def:':
+                desc = ' '.join(value.split())
                 desc = desc.split('"')[1]
                 gterm.description = desc
-            elif inside and fields[0] == 'name:':
-                fields.pop(0)
+            elif tag == 'name:':
+                fields = value.split()
                 name = '_'.join(fields)
                 name = re.sub('[^\w\s_-]', '_', name).strip().lower()
                 name = re.sub('[-\s_]+', '_', name)
                 gterm.name = name
                 gterm.full_name = ' '.join(fields)
-            elif inside and fields[0] == 'namespace:':
-                gterm.namespace = fields[1]
-            elif inside and fields[0] == 'def:':
-                gterm.desc = ' '.join(fields[1:]).split('\"')[1]
-            elif inside and fields[0] == 'alt_id:':
-                gterm.alt_id.append(fields[1])
-                self.alt_id2std_id[fields[1]] = gterm.get_id()
-            elif inside and fields[0] == 'is_a:':
+            elif tag == 'namespace:':
+                gterm.namespace = value.split(None, 1)[0]
+            elif tag == 'alt_id:':
+                alt_id = value.split(None, 1)[0]
+                gterm.alt_id.append(alt_id)
+                self.alt_id2std_id[alt_id] = gterm.get_id()
+            elif tag == 'is_a:':
                 #logging.debug("Making term.head for term %s = False", gterm)
                 gterm.head = False
-                fields.pop(0)
-                pgo_id = fields.pop(0)
+                pgo_id = value.split(None, 1)[0]
                 if pgo_id not in self.go_terms:
-                    self.go_terms[pgo_id] = GOTerm(pgo_id)
+                    self.go_terms[pgo_id] = self.term_class(pgo_id)
 
                 gterm.is_a.append(self.go_terms[pgo_id])
                 self.go_terms[pgo_id].parent_of.add(gterm)
                 gterm.child_of.add(self.go_terms[pgo_id])
-            elif inside and fields[0] == 'relationship:':
-                if fields[1].find('has_part') != -1:
+            elif tag == 'relationship:':
+                fields = value.split(None, 2)
+                if fields[0].find('has_part') != -1:
                     # Has part is not a parental relationship --
                     # it is actually for children.
                     continue
                 #logging.debug("Making term.head for term %s = False", gterm)
                 gterm.head = False
-                pgo_id = fields[2]
+                pgo_id = fields[1]
                 if pgo_id not in self.go_terms:
-                    self.go_terms[pgo_id] = GOTerm(pgo_id)
+                    self.go_terms[pgo_id] = self.term_class(pgo_id)
                 # Check which relationship you are with this parent go term
-                if (fields[1] == 'regulates' or
-                        fields[1] == 'positively_regulates' or
-                        fields[1] == 'negatively_regulates'):
+                if (fields[0] == 'regulates' or
+                        fields[0] == 'positively_regulates' or
+                        fields[0] == 'negatively_regulates'):
                     gterm.relationship_regulates.append(self.go_terms[pgo_id])
-                elif fields[1] == 'part_of':
+                elif fields[0] == 'part_of':
                     gterm.relationship_part_of.append(self.go_terms[pgo_id])
                 else:
                     logging.info("Unkown relationship %s", self.go_terms[pgo_id].name)
 
                 self.go_terms[pgo_id].parent_of.add(gterm)
                 gterm.child_of.add(self.go_terms[pgo_id])
-            elif inside and fields[0] == 'is_obsolete:':
+            elif tag == 'is_obsolete:':
                 #logging.debug("Making term.head for term %s = False", gterm)
                 gterm.head = False
                 del self.go_terms[gterm.get_id()]
@@ -157,25 +379,65 @@ class GO:
 
         #logging.debug("Terms that are heads: %s", self.heads)
 
+    def topological_order(self, heads=None, within=None):
+        """
+        Return all terms reachable from the head terms (or from the terms
+        in `heads`), ordered so that every term comes after all of its
+        children (i.e. a post-order of the DAG walked along `parent_of`
+        edges). If `within` is a set of terms, the walk does not leave it.
+
+        The walk is iterative, so deep branches can not hit Python's
+        recursion limit, and each term is visited exactly once no matter
+        how many paths lead to it.
+        """
+        if heads is None:
+            heads = self.heads
+
+        order = []
+        visited = set()
+        for head_gterm in heads:
+            if head_gterm in visited:
+                continue
+            visited.add(head_gterm)
+            stack = [(head_gterm, iter(head_gterm.parent_of))]
+            while stack:
+                gterm, children = stack[-1]
+                for child_term in children:
+                    if child_term not in visited and \
+                            (within is None or child_term in within):
+                        visited.add(child_term)
+                        stack.append((child_term, iter(child_term.parent_of)))
+                        break
+                else:
+                    stack.pop()
+                    order.append(gterm)
+
+        return order
+
     def propagate(self):
         """
         propagate all gene annotations
+
+        Terms are processed children-first (see `topological_order()`), so
+        the propagated annotation set of every term is computed exactly
+        once and is final by the time its parents read it.
         """
         logging.info("Propagate gene annotations")
         logging.debug("Head term(s) = %s", self.heads)
-        for head_gterm in self.heads:
-            logging.info("Propagating %s", head_gterm.name)
-            self.propagate_recurse(head_gterm)
+        for gterm in self.topological_order():
+            self.propagate_children(gterm)
 
-    def propagate_recurse(self, gterm):
+    def propagate_children(self, gterm):
+        """
+        Merge the (already propagated) annotations of all children of
+        `gterm` into `gterm.annotations`, applying the `regulates` and
+        `part_of` cutoff rules.
+        """
         if not len(gterm.parent_of):
-            #logging.debug("Base case with term %s", gterm.name)
             return
 
+        new_annotations = set()
         for child_term in gterm.parent_of:
-            self.propagate_recurse(child_term)
-            new_annotations = set()
-
             regulates_relation = (gterm in child_term.relationship_regulates)
             part_of_relation = (gterm in child_term.relationship_part_of)
 
@@ -198,7 +460,215 @@ class GO:
                     copied_annotation = annotation.prop_copy()
 
                 new_annotations.add(copied_annotation)
-            gterm.annotations = gterm.annotations | new_annotations
+        gterm.annotations = gterm.annotations | new_annotations
+
+    def propagate_bitsets(self, gene_index):
+        """
+        Compact alternative to `propagate()`.
+
+        Instead of copying `Annotation` objects up the tree, the genes of
+        each term are kept as two integer bitsets over `gene_index`:
+        `gene_bits` for genes that may still pass a `regulates` relation,
+        and `cutoff_gene_bits` for genes that came through a `regulates`
+        or `part_of` relation and may not. Propagation then only ORs
+        integers, and `term.annotations` keeps the direct annotations.
+        """
+        logging.info("Propagate gene annotations as bitsets")
+        for gterm in self.topological_order():
+            self.seed_bitsets(gterm, gene_index)
+            for child_term in gterm.parent_of:
+                if gterm in child_term.relationship_regulates:
+                    gterm.cutoff_gene_bits |= child_term.gene_bits
+                elif gterm in child_term.relationship_part_of:
+                    gterm.cutoff_gene_bits |= (
+                        child_term.gene_bits | child_term.cutoff_gene_bits)
+                else:
+                    gterm.gene_bits |= child_term.gene_bits
+                    gterm.cutoff_gene_bits |= child_term.cutoff_gene_bits
+
+        # Terms that are not reachable from any head keep their own genes.
+        for gterm in self.go_terms.values():
+            if gterm.gene_bits is None:
+                self.seed_bitsets(gterm, gene_index)
+
+    def propagate_sparse(self, gene_index):
+        """
+        Vectorized alternative to `propagate_bitsets()`, for large
+        ontologies. Needs NumPy and SciPy.
+
+        Direct annotations are put in two sparse term x gene matrices (genes
+        and cutoff genes, as in `propagate_bitsets()`), and the `is_a`,
+        `regulates` and `part_of` edges in three sparse term x term
+        matrices. Terms are then grouped by height (the longest path down to
+        a leaf), and the genes of all terms of a level are accumulated at
+        once, by multiplying the edges of the level with the final genes of
+        all lower levels.
+
+        Returns:
+        A dictionary that maps each term ID to the sorted array of the
+        `gene_index` indices of its propagated genes.
+        """
+        if sparse is None:
+            raise ImportError('GO.propagate_sparse() needs NumPy and SciPy')
+
+        logging.info("Propagate gene annotations as sparse matrices")
+        order = self.topological_order()
+        height = {}
+        for gterm in order:
+            height[gterm] = 1 + max(
+                (height[child_term] for child_term in gterm.parent_of),
+                default=-1
+            )
+        # Sorting is stable, so children still come before their parents
+        order.sort(key=height.__getitem__)
+        position = {gterm: pos for pos, gterm in enumerate(order)}
+
+        seeds = {False: ([], []), True: ([], [])}  # By ready_regulates_cutoff
+        edges = {'is_a': ([], []), 'regulates': ([], []), 'part_of': ([], [])}
+        for pos, gterm in enumerate(order):
+            for annotation in gterm.annotations:
+                rows, cols = seeds[bool(annotation.ready_regulates_cutoff)]
+                rows.append(pos)
+                cols.append(gene_index.index[annotation.gid])
+            for child_term in gterm.parent_of:
+                if gterm in child_term.relationship_regulates:
+                    rows, cols = edges['regulates']
+                elif gterm in child_term.relationship_part_of:
+                    rows, cols = edges['part_of']
+                else:
+                    rows, cols = edges['is_a']
+                rows.append(pos)
+                cols.append(position[child_term])
+
+        def to_matrix(rows, cols, n_cols):
+            data = np.ones(len(rows), dtype=np.int32)
+            return sparse.csr_matrix(
+                (data, (rows, cols)), shape=(len(order), n_cols))
+
+        def to_boolean(matrix):
+            matrix.data[:] = 1  # Path counts do not matter, only paths do
+            return matrix
+
+        genes = to_matrix(*seeds[False], len(gene_index))
+        cutoff_genes = to_matrix(*seeds[True], len(gene_index))
+        is_a, regulates, part_of = (
+            to_matrix(*edges[kind], len(order))
+            for kind in ('is_a', 'regulates', 'part_of')
+        )
+
+        # Row range of each level; level 0 (leaves) keeps its direct genes.
+        bounds = []
+        for pos, gterm in enumerate(order):
+            if not bounds or height[gterm] != height[order[bounds[-1][0]]]:
+                bounds.append([pos, pos])
+            bounds[-1][1] = pos + 1
+
+        done_genes = genes[:bounds[0][1]] if bounds else genes
+        done_cutoff_genes = cutoff_genes[:bounds[0][1]] if bounds else cutoff_genes
+        for start, end in bounds[1:]:
+            level_is_a = is_a[start:end, :start]
+            level_regulates = regulates[start:end, :start]
+            level_part_of = part_of[start:end, :start]
+            level_genes = genes[start:end] + level_is_a @ done_genes
+            level_cutoff_genes = (
+                cutoff_genes[start:end]
+                + level_is_a @ done_cutoff_genes
+                + level_regulates @ done_genes
+                + level_part_of @ done_genes
+                + level_part_of @ done_cutoff_genes
+            )
+            done_genes = sparse.vstack(
+                [done_genes, to_boolean(level_genes)], format='csr')
+            done_cutoff_genes = sparse.vstack(
+                [done_cutoff_genes, to_boolean(level_cutoff_genes)], format='csr')
+
+        all_genes = (done_genes + done_cutoff_genes).tocsr()
+        all_genes.sum_duplicates()  # Also sorts the indices of each row
+
+        gene_arrays = {}
+        for term_id, gterm in self.go_terms.items():
+            pos = position.get(gterm)
+            if pos is not None:
+                gene_arrays[term_id] = \
+                    all_genes.indices[all_genes.indptr[pos]:all_genes.indptr[pos + 1]]
+            else:
+                # Terms that are not reachable from any head keep their
+                # own genes.
+                gene_arrays[term_id] = np.array(sorted(set(
+                    gene_index.index[annotation.gid]
+                    for annotation in gterm.annotations
+                )), dtype=np.int32)
+
+        return gene_arrays
+
+    def propagate_changes(self, changed_terms, previous_genes):
+        """
+        Incremental alternative to `propagate()`, for an ontology whose
+        propagated genes are known from a previous run in which only the
+        direct annotations of `changed_terms` were different.
+
+        Only `changed_terms` and their ancestors are re-propagated; the
+        genes of all other terms are read from `previous_genes`, which maps
+        term IDs to (genes, cutoff genes) pairs of gene ID lists, like
+        `gene_bits` and `cutoff_gene_bits` of `propagate_bitsets()`.
+
+        Returns:
+        A dictionary that maps each re-propagated term to its pair of
+        (genes, cutoff genes) sets.
+        """
+        logging.info("Propagate gene annotations of %d changed terms",
+                     len(changed_terms))
+        affected = set()
+        pending = list(changed_terms)
+        while pending:
+            gterm = pending.pop()
+            if gterm not in affected:
+                affected.add(gterm)
+                pending.extend(gterm.child_of)
+
+        genes = dict()
+
+        def get_genes(gterm):
+            if gterm in genes:
+                return genes[gterm]
+            gids, cutoff_gids = previous_genes.get(gterm.go_id, ([], []))
+            return set(gids), set(cutoff_gids)
+
+        def seed_genes(gterm):
+            return (
+                set(annotation.gid for annotation in gterm.annotations
+                    if not annotation.ready_regulates_cutoff),
+                set(annotation.gid for annotation in gterm.annotations
+                    if annotation.ready_regulates_cutoff)
+            )
+
+        # Only affected terms need to be ordered, as the genes of all their
+        # other children are already known.
+        for gterm in self.topological_order(heads=affected, within=affected):
+            gids, cutoff_gids = seed_genes(gterm)
+            for child_term in gterm.parent_of:
+                child_gids, child_cutoff_gids = get_genes(child_term)
+                if gterm in child_term.relationship_regulates:
+                    cutoff_gids |= child_gids
+                elif gterm in child_term.relationship_part_of:
+                    cutoff_gids |= child_gids | child_cutoff_gids
+                else:
+                    gids |= child_gids
+                    cutoff_gids |= child_cutoff_gids
+            genes[gterm] = (gids, cutoff_gids)
+
+        return genes
+
+    def seed_bitsets(self, gterm, gene_index):
+        """Initialize the bitsets of `gterm` from its direct annotations."""
+        gterm.gene_bits = gene_index.encode(
+            annotation.gid for annotation in gterm.annotations
+            if not annotation.ready_regulates_cutoff
+        )
+        gterm.cutoff_gene_bits = gene_index.encode(
+            annotation.gid for annotation in gterm.annotations
+            if annotation.ready_regulates_cutoff
+        )
 
     def get_term(self, tid):
         #logging.debug('get_term: %s', tid)
@@ -283,6 +753,8 @@ class GOTerm:
     summary = None
     desc = None
     votes = None
+    gene_bits = None
+    cutoff_gene_bits = None
 
     def __init__(self, go_id):
         self.head = True
@@ -304,6 +776,8 @@ class GOTerm:
         self.counts = None
         self.desc = None
         self.votes = set([])
+        self.gene_bits = None
+        self.cutoff_gene_bits = None
 
     def __cmp__(self, other):
         return cmp(self.go_id, other.go_id)
@@ -376,6 +850,307 @@ class GOTerm:
         return self.namespace
 
 
+class DOAnnotation(tuple):
+    """
+    Compact, immutable alternative to `Annotation` for the DO pipeline.
+
+    Annotations of DO terms only differ by their gene ID and by
+    `ready_regulates_cutoff`, all other `Annotation` fields being left to
+    their defaults. So a `DOAnnotation` is just a (gid,
+    ready_regulates_cutoff) tuple: it has no instance dictionary, and
+    hashing and comparing it is done in C.
+    """
+    __slots__ = ()
+
+    # Same default fields as `Annotation`
+    xdb = None
+    ref = None
+    evidence = None
+    date = None
+    direct = False
+    cross_annotated = False
+    origin = None
+    ortho_evidence = None
+
+    def __new__(cls, gid=None, ready_regulates_cutoff=False):
+        return tuple.__new__(cls, (gid, ready_regulates_cutoff))
+
+    @property
+    def gid(self):
+        return self[0]
+
+    @property
+    def ready_regulates_cutoff(self):
+        return self[1]
+
+    def prop_copy(self, ready_regulates_cutoff=None):
+        # Copies are equal to the annotation itself unless the cutoff flag
+        # changes, and immutable objects can be shared.
+        if ready_regulates_cutoff is None or \
+                ready_regulates_cutoff == self[1]:
+            return self
+        return tuple.__new__(DOAnnotation, (self[0], ready_regulates_cutoff))
+
+    def __repr__(self):
+        return 'DOAnnotation(gid=%r, ready_regulates_cutoff=%r)' % self
+
+
+class DOTerm:
+    """
+    Compact alternative to `GOTerm` for the DO pipeline, with `__slots__`
+    for only the attributes that the pipeline uses, and `DOAnnotation`
+    objects as annotations.
+    """
+    __slots__ = (
+        'go_id', 'name', 'full_name', 'description', 'namespace', 'head',
+        'alt_id', 'is_a', 'relationship_regulates', 'relationship_part_of',
+        'parent_of', 'child_of', 'annotations', 'gene_bits',
+        'cutoff_gene_bits',
+    )
+
+    def __init__(self, go_id):
+        self.go_id = go_id
+        self.name = None
+        self.full_name = None
+        self.description = None
+        self.namespace = ''
+        self.head = True
+        self.alt_id = []
+        self.is_a = []
+        self.relationship_regulates = []
+        self.relationship_part_of = []
+        self.parent_of = set()
+        self.child_of = set()
+        self.annotations = set()
+        self.gene_bits = None
+        self.cutoff_gene_bits = None
+
+    # Unlike `GOTerm`, terms are hashed by identity, which is computed in
+    # C: there is a single term object per ID in an ontology anyway.
+
+    def __repr__(self):
+        return self.go_id + ': ' + self.name
+
+    def get_id(self):
+        return self.go_id
+
+    def add_annotation(self, gid, ref=None):
+        """
+        Add a direct annotation of gene `gid`. DO annotations have no
+        reference, so `ref` must be None.
+        """
+        if ref is not None:
+            raise ValueError('DOTerm annotations have no reference')
+        self.annotations.add(DOAnnotation(gid))
+
+    def get_annotation_size(self):
+        return len(self.annotations)
+
+    def get_namespace(self):
+        return self.namespace
+
+
+class GeneIndex:
+    """
+    Intern gene IDs to dense integer indices, so that a set of genes can be
+    stored as the bits of a single Python integer.
+
+    Indices follow the sorted order of the gene IDs, so `decode()` returns
+    gene IDs already sorted.
+    """
+    def __init__(self, gids):
+        self.gids = sorted(gids)
+        self.index = {gid: idx for idx, gid in enumerate(self.gids)}
+
+    def __len__(self):
+        return len(self.gids)
+
+    def encode(self, gids):
+        """Return the bitset of the passed gene IDs."""
+        bits = 0
+        for gid in gids:
+            bits |= 1 << self.index[gid]
+        return bits
+
+    def decode(self, bits):
+        """Return the sorted list of gene IDs in the passed bitset."""
+        gids = []
+        # Reversed binary representation: character `idx` is bit `idx`.
+        bit_str = bin(bits)[:1:-1]
+        idx = bit_str.find('1')
+        while idx != -1:
+            gids.append(self.gids[idx])
+            idx = bit_str.find('1', idx + 1)
+        return gids
+
+
+class TermIndex:
+    """
+    Precomputed reachability index of a parsed ontology, to answer
+    ancestor, descendant and lowest common ancestor queries without
+    walking the graph.
+
+    Terms are numbered in topological order, parents first, and the
+    ancestors and descendants of each term are stored as integer bitsets
+    over these positions (see `GeneIndex`), which answer intersection
+    queries, and as tuples of term IDs, which answer listing queries
+    without decoding the bitsets. Edges are the `parent_of` and `child_of`
+    links used by propagation.
+
+    Call `index_genes()` after propagation to also answer which terms
+    contain a gene.
+    """
+    def __init__(self, disease_ontology):
+        self.alt_id2std_id = disease_ontology.alt_id2std_id
+        go_terms = disease_ontology.go_terms
+
+        # Start from all terms, as some may not be reachable from a head.
+        # Obsolete terms are left out.
+        order = disease_ontology.topological_order(
+            list(disease_ontology.heads) + list(go_terms.values())
+        )
+        order = [gterm for gterm in order if go_terms.get(gterm.go_id) is gterm]
+        order.reverse()
+
+        self.term_ids = [gterm.go_id for gterm in order]
+        self.position = {term_id: pos for pos, term_id in enumerate(self.term_ids)}
+        self.ancestor_bits = [0] * len(order)
+        self.descendant_bits = [0] * len(order)
+        self.gene_terms = {}
+
+        ancestor_positions = [None] * len(order)
+        for pos, gterm in enumerate(order):
+            bits = 0
+            positions = set()
+            for parent_term in gterm.child_of:
+                parent_pos = self.position.get(parent_term.go_id)
+                if parent_pos is not None:
+                    bits |= self.ancestor_bits[parent_pos] | (1 << parent_pos)
+                    positions.update(ancestor_positions[parent_pos])
+                    positions.add(parent_pos)
+            self.ancestor_bits[pos] = bits
+            ancestor_positions[pos] = positions
+
+        descendant_positions = [None] * len(order)
+        for pos in range(len(order) - 1, -1, -1):
+            bits = 0
+            positions = set()
+            for child_term in order[pos].parent_of:
+                child_pos = self.position.get(child_term.go_id)
+                if child_pos is not None:
+                    bits |= self.descendant_bits[child_pos] | (1 << child_pos)
+                    positions.update(descendant_positions[child_pos])
+                    positions.add(child_pos)
+            self.descendant_bits[pos] = bits
+            descendant_positions[pos] = positions
+
+        term_ids = self.term_ids
+        self.ancestor_ids = [
+            tuple(term_ids[pos] for pos in sorted(positions))
+            for positions in ancestor_positions
+        ]
+        self.descendant_ids = [
+            tuple(term_ids[pos] for pos in sorted(positions))
+            for positions in descendant_positions
+        ]
+
+    def __len__(self):
+        return len(self.term_ids)
+
+    def get_position(self, term_id):
+        """Return the position of a term ID or alternative ID."""
+        try:
+            return self.position[term_id]
+        except KeyError:
+            return self.position[self.alt_id2std_id[term_id]]
+
+    def decode(self, bits):
+        """Return the term IDs in the passed bitset, parents first."""
+        term_ids = []
+        # Reversed binary representation: character `pos` is bit `pos`.
+        bit_str = bin(bits)[:1:-1]
+        pos = bit_str.find('1')
+        while pos != -1:
+            term_ids.append(self.term_ids[pos])
+            pos = bit_str.find('1', pos + 1)
+        return term_ids
+
+    def ancestors(self, term_id, include_self=False):
+        """
+        Return the IDs of all ancestors of a term, parents first (then the
+        term itself if `include_self` is True).
+        """
+        pos = self.get_position(term_id)
+        ancestor_ids = list(self.ancestor_ids[pos])
+        if include_self:
+            ancestor_ids.append(self.term_ids[pos])
+        return ancestor_ids
+
+    def descendants(self, term_id, include_self=False):
+        """
+        Return the IDs of all descendants of a term (after the term itself
+        if `include_self` is True), parents first.
+        """
+        pos = self.get_position(term_id)
+        descendant_ids = list(self.descendant_ids[pos])
+        if include_self:
+            descendant_ids.insert(0, self.term_ids[pos])
+        return descendant_ids
+
+    def is_ancestor(self, term_id, other_term_id):
+        """Return True if `term_id` is an ancestor of `other_term_id`."""
+        pos = self.get_position(term_id)
+        return bool(self.ancestor_bits[self.get_position(other_term_id)] >> pos & 1)
+
+    def lowest_common_ancestors(self, term_id, other_term_id):
+        """
+        Return the IDs of the lowest common ancestors of two terms: their
+        common ancestors (a term counts as its own ancestor here) that are
+        not an ancestor of another common ancestor. There may be several
+        of them in a DAG, and none if the terms have no common root.
+        """
+        pos = self.get_position(term_id)
+        other_pos = self.get_position(other_term_id)
+        other_bits = self.ancestor_bits[other_pos] | (1 << other_pos)
+        common_ids = [
+            common_id
+            for common_id in self.ancestor_ids[pos] + (self.term_ids[pos],)
+            if other_bits >> self.position[common_id] & 1
+        ]
+        common = (self.ancestor_bits[pos] | (1 << pos)) & other_bits
+        return [
+            common_id for common_id in common_ids
+            if not self.descendant_bits[self.position[common_id]] & common
+        ]
+
+    def index_genes(self, disease_ontology, gene_index=None):
+        """
+        Build the gene -> terms postings from the propagated genes of each
+        term: their `gene_bits` and `cutoff_gene_bits` over `gene_index`
+        after `GO.propagate_bitsets()`, or their annotations after
+        `GO.propagate()`.
+        """
+        gene_terms = {}
+        for term_id in self.term_ids:
+            term = disease_ontology.go_terms[term_id]
+            if gene_index is not None:
+                gids = gene_index.decode(term.gene_bits | term.cutoff_gene_bits)
+            else:
+                gids = set(annotation.gid for annotation in term.annotations)
+            for gid in gids:
+                if gid not in gene_terms:
+                    gene_terms[gid] = []
+                gene_terms[gid].append(term_id)
+        self.gene_terms = {gid: tuple(terms) for gid, terms in gene_terms.items()}
+
+    def terms_with_gene(self, gid):
+        """
+        Return the IDs of the terms whose geneset contains the gene, parents
+        first (see `index_genes()`).
+        """
+        return list(self.gene_terms.get(gid, ()))
+
+
 # Copied from "annotation-refinery/process_do.py"
 # See https://github.com/greenelab/annotation-refinery
 def build_doid_omim_dict(obo_filename):
@@ -384,48 +1159,287 @@ def build_doid_omim_dict(obo_filename):
     from OBO file that have OMIM cross-reference IDs
 
     Arguments:
-    obo_filename -- A string. Location of the DO OBO file to be read in.
+    obo_filename -- A string. Location of the DO OBO file to be read in,
+    which may be compressed (see `open_input()`).
 
     Returns:
     doid_omim_dict -- A dictionary of only the DO terms in the OBO file
     that have OMIM xrefs. The keys in the dictionary are DOIDs, and the
     values are sets of OMIM xref IDs.
     """
-    obo_fh = open(obo_filename, 'r')
     doid_omim_dict = {}
+    doid = None
+    in_terms = False  # True once the first [Term] stanza has been seen
+
+    # The file is streamed line by line instead of being read into memory.
+    # Note that `GO.parse()` collects the same dictionary in `omim_xrefs`
+    # while it builds the ontology, see `load_disease_ontology()`.
+    with open_input(obo_filename) as obo_fh:
+        for line in obo_fh:
+            if not in_terms:
+                in_terms = (line.strip() == '[Term]')
+                continue
+
+            if line.startswith('id:'):
+                doid = FIND_DOID.search(line)
+                if doid:
+                    doid = doid.group(0)
+
+            elif line.startswith('xref: OMIM:'):
+                # If term has OMIM xref, get it and add it to the
+                # doid_omim_dict. Otherwise, ignore.
+                omim = FIND_NUMBER.search(line).group(0)
+
+                if doid not in doid_omim_dict:
+                    doid_omim_dict[doid] = set()
+                doid_omim_dict[doid].add(omim)
 
-    # This statement builds a list of the lines in the file and reverses
-    # its order. This is because the list 'pop()' method pops out list
-    # elements starting from the end. This way the lines will be read in
-    # the following loop in order, from top to bottom of the file.
-    obo_reversed_str_array = obo_fh.readlines()[::-1]
-
-    while obo_reversed_str_array:  # Loop adapted from Dima @ Princeton
-        line = obo_reversed_str_array.pop()
-        line = line.strip()
-        if line == '[Term]':
-            while line != '' and obo_reversed_str_array:
-                line = obo_reversed_str_array.pop()
-
-                if line.startswith('id:'):
-                    doid = re.search('DOID:[0-9]+', line)
-                    if doid:
-                        doid = doid.group(0)
-
-                if line.startswith('xref: OMIM:'):
-                    # If term has OMIM xref, get it and add it to the
-                    # doid_omim_dict. Otherwise, ignore.
-                    omim = re.search('[0-9]+', line).group(0)
-
-                    if doid not in doid_omim_dict:
-                        doid_omim_dict[doid] = set()
-                    if omim not in doid_omim_dict[doid]:
-                        doid_omim_dict[doid].add(omim)
-
-    obo_fh.close()
     return doid_omim_dict
 
 
+def load_disease_ontology(obo_filename, snapshot_dir=None, term_class=DOTerm):
+    """
+    Function to read in DO OBO file in a single pass and build both the
+    Disease Ontology and the dictionary of its OMIM cross-references.
+
+    Arguments:
+    obo_filename -- A string. Location of the DO OBO file to be read in,
+    which may be compressed (see `open_input()`).
+
+    snapshot_dir -- Optional directory of binary snapshots. If it holds a
+    snapshot of an OBO file with the same content, the snapshot is loaded
+    instead of parsing the file; otherwise a snapshot is saved after parsing.
+
+    term_class -- Class of the ontology terms: the compact `DOTerm` by
+    default, or `GOTerm`.
+
+    Returns:
+    disease_ontology -- A GO object that has parsed the DO OBO file.
+
+    doid_omim_dict -- A dictionary of DO terms mapping to sets of OMIM xrefs,
+    same as the one returned by build_doid_omim_dict().
+    """
+    if snapshot_dir and os.path.exists(obo_filename):
+        key = file_digest(obo_filename)
+        snapshot_filename = os.path.join(
+            snapshot_dir, '%s.%s.snapshot' % (os.path.basename(obo_filename), key[:16])
+        )
+        disease_ontology = load_ontology_snapshot(
+            snapshot_filename, key, term_class=term_class)
+        if disease_ontology is not None:
+            logging.info('Loaded ontology snapshot %s', snapshot_filename)
+            return disease_ontology, disease_ontology.omim_xrefs
+
+    disease_ontology = GO(term_class)
+    obo_is_loaded = disease_ontology.load_obo(obo_filename)
+
+    if obo_is_loaded is False:
+        # Nothing else can be built without the ontology, and an empty one
+        # would silently upload no genesets at all.
+        logging.error('Failed to load OBO file.')
+        raise IOError('Could not open %s' % obo_filename)
+
+    if snapshot_dir:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        save_ontology_snapshot(disease_ontology, snapshot_filename, key)
+        logging.info('Saved ontology snapshot %s', snapshot_filename)
+
+    return disease_ontology, disease_ontology.omim_xrefs
+
+
+def file_digest(filename):
+    """Return the SHA-256 hex digest of the content of a file."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_ontology_snapshot(disease_ontology, snapshot_filename, key=''):
+    """
+    Save a parsed ontology as a compact binary snapshot.
+
+    The file starts with `SNAPSHOT_MAGIC`, the length of a JSON header and
+    the header itself, which holds `key` (e.g. the OBO file digest) and the
+    offset and size of each section. All strings (term IDs, names,
+    descriptions, alt_ids and OMIM IDs) are stored once in a NUL separated
+    UTF-8 section, and everything else is stored as arrays of 32-bit
+    integers that index terms or strings: a table with one row per term,
+    the parent/child edges, the ordered is_a/regulates/part_of lists,
+    alt_ids, heads, the `go_terms` keys and the OMIM xrefs.
+    """
+    strings = []
+    string_idx = {}
+
+    def add_string(value):
+        if value is None:
+            return -1
+        if value not in string_idx:
+            string_idx[value] = len(strings)
+            strings.append(value)
+        return string_idx[value]
+
+    # Terms are collected from `go_terms`, `heads` and all their relatives,
+    # as obsolete terms may be left in the graph after being removed from
+    # `go_terms`.
+    term_idx = {}
+    terms = []
+    pending = list(disease_ontology.go_terms.values()) + disease_ontology.heads
+    while pending:
+        gterm = pending.pop()
+        if gterm in term_idx:
+            continue
+        term_idx[gterm] = len(terms)
+        terms.append(gterm)
+        pending.extend(gterm.parent_of)
+        pending.extend(gterm.child_of)
+        pending.extend(gterm.is_a)
+        pending.extend(gterm.relationship_regulates)
+        pending.extend(gterm.relationship_part_of)
+
+    sections = {name: array('i') for name in (
+        'terms', 'child_of', 'is_a', 'regulates', 'part_of', 'alt_id',
+        'alt_id2std_id', 'heads', 'go_terms', 'omim_xrefs'
+    )}
+    for idx, gterm in enumerate(terms):
+        sections['terms'].extend((
+            add_string(gterm.go_id),
+            add_string(gterm.name),
+            add_string(gterm.full_name),
+            add_string(gterm.description),
+            add_string(gterm.namespace),
+            1 if gterm.head else 0,
+        ))
+        for parent in gterm.child_of:
+            sections['child_of'].extend((idx, term_idx[parent]))
+        for section, parents in (
+                ('is_a', gterm.is_a),
+                ('regulates', gterm.relationship_regulates),
+                ('part_of', gterm.relationship_part_of)):
+            for parent in parents:
+                sections[section].extend((idx, term_idx[parent]))
+        for alt_id in gterm.alt_id:
+            sections['alt_id'].extend((idx, add_string(alt_id)))
+
+    for alt_id, std_id in disease_ontology.alt_id2std_id.items():
+        sections['alt_id2std_id'].extend((add_string(alt_id), add_string(std_id)))
+    for gterm in disease_ontology.heads:
+        sections['heads'].append(term_idx[gterm])
+    for term_id, gterm in disease_ontology.go_terms.items():
+        sections['go_terms'].extend((add_string(term_id), term_idx[gterm]))
+    for doid, omim_ids in disease_ontology.omim_xrefs.items():
+        for omim_id in sorted(omim_ids):
+            sections['omim_xrefs'].extend((add_string(doid), add_string(omim_id)))
+
+    blobs = [('strings', '\0'.join(strings).encode('utf-8'))]
+    blobs.extend((name, values.tobytes()) for name, values in sections.items())
+
+    # Sections are laid out right after the header, each aligned to 8 bytes.
+    # Their offsets in the header are relative to the end of the header.
+    header = {'key': key, 'byteorder': sys.byteorder, 'sections': {}}
+    offset = 0
+    for name, blob in blobs:
+        header['sections'][name] = [offset, len(blob)]
+        offset += len(blob) + (-len(blob) % 8)
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (-(len(SNAPSHOT_MAGIC) + 4 + len(header_bytes)) % 8)
+
+    tmp_filename = snapshot_filename + '.tmp'
+    with open(tmp_filename, 'wb') as fh:
+        fh.write(SNAPSHOT_MAGIC)
+        fh.write(len(header_bytes).to_bytes(4, 'little'))
+        fh.write(header_bytes)
+        for name, blob in blobs:
+            fh.write(blob)
+            fh.write(b'\0' * (-len(blob) % 8))
+    os.replace(tmp_filename, snapshot_filename)
+
+
+def load_ontology_snapshot(snapshot_filename, key='', term_class=GOTerm):
+    """
+    Load a binary snapshot saved by `save_ontology_snapshot()`, and return
+    the rebuilt GO object, whose terms are `term_class` objects. Returns
+    None if the file does not exist, is not a snapshot or was saved with a
+    different `key`.
+
+    The file is read at once, and its sections are decoded without copies
+    through a `memoryview`; all terms are then rebuilt as Python objects,
+    which is what saves the time of parsing the OBO file.
+    """
+    if not os.path.exists(snapshot_filename):
+        return None
+
+    with open(snapshot_filename, 'rb') as fh:
+        snapshot = fh.read()
+
+    magic_len = len(SNAPSHOT_MAGIC)
+    if snapshot[:magic_len] != SNAPSHOT_MAGIC:
+        logging.warning('%s is not an ontology snapshot', snapshot_filename)
+        return None
+    header_len = int.from_bytes(snapshot[magic_len:magic_len + 4], 'little')
+    data_start = magic_len + 4 + header_len
+    header = json.loads(snapshot[magic_len + 4:data_start])
+    if header['key'] != key or header['byteorder'] != sys.byteorder:
+        return None
+
+    sections = {}
+    view = memoryview(snapshot)
+    for name, (offset, size) in header['sections'].items():
+        offset += data_start
+        section = view[offset:offset + size]
+        if name == 'strings':
+            sections[name] = str(section, 'utf-8').split('\0')
+        else:
+            sections[name] = section.cast('i').tolist()
+
+    strings = sections['strings']
+
+    def get_string(idx):
+        return strings[idx] if idx >= 0 else None
+
+    def pairs(name):
+        values = sections[name]
+        return zip(values[0::2], values[1::2])
+
+    terms = []
+    term_table = sections['terms']
+    for row in range(0, len(term_table), 6):
+        gterm = term_class(strings[term_table[row]])
+        gterm.name = get_string(term_table[row + 1])
+        gterm.full_name = get_string(term_table[row + 2])
+        gterm.description = get_string(term_table[row + 3])
+        gterm.namespace = get_string(term_table[row + 4])
+        gterm.head = term_table[row + 5] == 1
+        terms.append(gterm)
+
+    for child, parent in pairs('child_of'):
+        terms[child].child_of.add(terms[parent])
+        terms[parent].parent_of.add(terms[child])
+    for child, parent in pairs('is_a'):
+        terms[child].is_a.append(terms[parent])
+    for child, parent in pairs('regulates'):
+        terms[child].relationship_regulates.append(terms[parent])
+    for child, parent in pairs('part_of'):
+        terms[child].relationship_part_of.append(terms[parent])
+    for idx, alt_id in pairs('alt_id'):
+        terms[idx].alt_id.append(strings[alt_id])
+
+    disease_ontology = GO(term_class)
+    for alt_id, std_id in pairs('alt_id2std_id'):
+        disease_ontology.alt_id2std_id[strings[alt_id]] = strings[std_id]
+    disease_ontology.heads = [terms[idx] for idx in sections['heads']]
+    for term_id, idx in pairs('go_terms'):
+        disease_ontology.go_terms[strings[term_id]] = terms[idx]
+    for doid, omim_id in pairs('omim_xrefs'):
+        doid = get_string(doid)
+        if doid not in disease_ontology.omim_xrefs:
+            disease_ontology.omim_xrefs[doid] = set()
+        disease_ontology.omim_xrefs[doid].add(strings[omim_id])
+
+    return disease_ontology
+
+
 # Based on `MIMdisease` class in "annotation-refinery/process_do.py".
 # See https://github.com/greenelab/annotation-refinery
 class MIMdisease:
@@ -435,6 +1449,82 @@ class MIMdisease:
         self.genes = []      # list of gene IDs
 
 
+def iter_mim_gene_pairs(genemap_filename):
+    """
+    Generate a (MIM disease ID, Entrez gene ID) pair of strings for each
+    disorder of each line in the genemap file that passes the filters of
+    `build_mim_diseases_dict()`, in file order (pairs may repeat).
+
+    Lines without the phenotype mapping key of `PHENOTYPE_FILTER` are
+    skipped before being split (see `parse_genemap_line()`).
+    """
+    with open_input(genemap_filename) as genemap_fh:
+        for line in genemap_fh:  # Loop based on Dima's @ Princeton
+            # Cheap pre-filter on the raw line before splitting it
+            if PHENOTYPE_FILTER not in line:
+                continue
+
+            for pair in parse_genemap_line(line):
+                yield pair
+
+
+def parse_genemap_line(line):
+    """
+    Generate the (MIM disease ID, Entrez gene ID) pairs of a single line of
+    the genemap file. All disorders of the line are matched by a single
+    regex scan.
+    """
+    tokens = line.rstrip('\n').split('\t', 13)
+
+    try:
+        entrez_id = tokens[9].strip()
+        disorders = tokens[12].strip()
+    except IndexError:
+        return
+
+    # Skip line if disorders field is empty, or if no disorder in it
+    # can have the mapping key of our filter
+    if PHENOTYPE_FILTER not in disorders:
+        return
+
+    # Skip line with empty "Entrez Gene ID" column
+    if entrez_id == '':
+        return
+
+    # Disorders are separated by ";", and only the first match of
+    # `FIND_MIMIDS` in each disorder is used.
+    done_until = 0  # End of the last disorder that had a match
+    for mim_info in FIND_MIMIDS.finditer(disorders):
+        if mim_info.start() < done_until:
+            continue
+        start = disorders.rfind(';', 0, mim_info.start()) + 1
+        end = disorders.find(';', mim_info.end())
+        if end == -1:
+            end = len(disorders)
+        done_until = end
+
+        if mim_info.group(2) != PHENOTYPE_MAPPING_KEY:
+            continue
+        disorder = disorders[start:end]
+        if '[' in disorder or '?' in disorder:
+            continue
+        yield mim_info.group(1), entrez_id
+
+
+def collect_mim_genes(genemap_filename):
+    """
+    Return a dictionary that maps each MIM disease ID to a dictionary whose
+    keys are its Entrez gene IDs, in order of first appearance (the dict is
+    used as an ordered set).
+    """
+    mim_genes = {}
+    for mim_disease_id, entrez_id in iter_mim_gene_pairs(genemap_filename):
+        if mim_disease_id not in mim_genes:
+            mim_genes[mim_disease_id] = {}
+        mim_genes[mim_disease_id][entrez_id] = None
+    return mim_genes
+
+
 # Based on `build_mim_diseases_dict()` in "annotation-refinery/process_do.py".
 # See https://github.com/greenelab/annotation-refinery
 def build_mim_diseases_dict(genemap_filename):
@@ -443,7 +1533,8 @@ def build_mim_diseases_dict(genemap_filename):
     diseases.
 
     Arguments:
-    genemap_filename -- A string. Location of the genemap file to read in.
+    genemap_filename -- A string. Location of the genemap file to read in,
+    which may be compressed (see `open_input()`).
 
     Returns:
     mim_diseases -- A dictionary. The keys are MIM disease IDs, and the
@@ -454,62 +1545,170 @@ def build_mim_diseases_dict(genemap_filename):
     """
 
     mim_diseases = {}
+    for mim_disease_id, genes in collect_mim_genes(genemap_filename).items():
+        mim_diseases[mim_disease_id] = MIMdisease()
+        mim_diseases[mim_disease_id].id = mim_disease_id
+        mim_diseases[mim_disease_id].phenotype = PHENOTYPE_FILTER
+        mim_diseases[mim_disease_id].genes = list(genes)
 
-    genemap_fh = open(genemap_filename, 'r')
-    for line in genemap_fh:  # Loop based on Dima's @ Princeton
-        tokens = line.strip('\n').split('\t')
+    return mim_diseases
 
-        try:
-            mim_geneid = tokens[5].strip()
-            entrez_id = tokens[9].strip()
-            disorders = tokens[12].strip()
-        except IndexError:
-            continue
 
-        # Skip line if disorders field is empty
-        if disorders == '':
-            continue
+def hash_genemap_line(line):
+    """Return a short hex digest of a genemap line."""
+    return hashlib.blake2b(line.encode('utf-8'), digest_size=8).hexdigest()
 
-        # Log message for empty "Entrez Gene ID" column
-        if entrez_id == '':
-            #logging.info(f"Empty Entrez Gene ID for MIM Number {mim_geneid}")
-            continue
 
-        # Split disorders and handle them one by one
-        disorders_list = disorders.split(';')
-        for disorder in disorders_list:
-            if '[' in disorder or '?' in disorder:
+def update_mim_diseases_dict(genemap_filename, previous_lines=None):
+    """
+    Diff-aware version of `build_mim_diseases_dict()`, that only parses the
+    lines of the genemap file that were not in the previous version.
+
+    Arguments:
+    genemap_filename -- A string. Location of the genemap file to read in,
+    which may be compressed (see `open_input()`).
+
+    previous_lines -- The `genemap_lines` returned by the previous call, or
+    None to parse all lines.
+
+    Returns:
+    A (mim_diseases, genemap_lines, affected_mim_ids) tuple:
+    - mim_diseases: a dictionary like the one returned by
+      `build_mim_diseases_dict()`, except that the genes of each MIM
+      disease are in no particular order;
+    - genemap_lines: a JSON-serializable dictionary that maps the hash of
+      each line (see `hash_genemap_line()`) to its [count, pairs], where
+      `pairs` is the list of [MIM disease ID, Entrez gene ID] of the line;
+    - affected_mim_ids: the set of MIM disease IDs whose genes were added
+      or removed since `previous_lines` (all IDs without `previous_lines`).
+    """
+    if previous_lines is None:
+        previous_lines = {}
+
+    line_counts = {}
+    new_lines = {}  # Hash -> line, for lines not seen in the previous file
+    with open_input(genemap_filename) as genemap_fh:
+        for line in genemap_fh:
+            # Lines without the mapping key never yield any pair
+            if PHENOTYPE_FILTER not in line:
                 continue
+            line_hash = hash_genemap_line(line)
+            line_counts[line_hash] = line_counts.get(line_hash, 0) + 1
+            if line_hash not in previous_lines and line_hash not in new_lines:
+                new_lines[line_hash] = line
+    logging.info("%d new genemap lines to parse", len(new_lines))
+
+    genemap_lines = {}
+    for line_hash, count in line_counts.items():
+        if line_hash in new_lines:
+            pairs = [list(pair) for pair in parse_genemap_line(new_lines[line_hash])]
+        else:
+            pairs = previous_lines[line_hash][1]
+        genemap_lines[line_hash] = [count, pairs]
+
+    # Number of lines that have each (MIM disease ID, Entrez gene ID) pair
+    pair_counts = {}
+    for count, pairs in genemap_lines.values():
+        for mim_disease_id, entrez_id in pairs:
+            pair = (mim_disease_id, entrez_id)
+            pair_counts[pair] = pair_counts.get(pair, 0) + count
+
+    # Change of those numbers since the previous file
+    pair_deltas = {}
+    for line_hash in set(genemap_lines) | set(previous_lines):
+        if line_hash in genemap_lines:
+            count, pairs = genemap_lines[line_hash]
+        else:
+            count, pairs = 0, previous_lines[line_hash][1]
+        previous_count = previous_lines.get(line_hash, [0])[0]
+        if count == previous_count:
+            continue
+        for mim_disease_id, entrez_id in pairs:
+            pair = (mim_disease_id, entrez_id)
+            pair_deltas[pair] = pair_deltas.get(pair, 0) + count - previous_count
 
-            # This next line returns a re Match object:
-            # It will be None if no match is found.
-            mim_info = re.search(FIND_MIMID, disorder)
+    affected_mim_ids = set()
+    for pair, delta in pair_deltas.items():
+        count = pair_counts.get(pair, 0)
+        if (count == 0) != (count - delta == 0):
+            affected_mim_ids.add(pair[0])
 
-            if mim_info:
-                split_mim_info = mim_info.group(0).split(' ')
-                mim_disease_id = split_mim_info[1].strip()
-                mim_phenotype = split_mim_info[2].strip()
+    mim_diseases = {}
+    for mim_disease_id, entrez_id in pair_counts:
+        if mim_disease_id not in mim_diseases:
+            mim_diseases[mim_disease_id] = MIMdisease()
+            mim_diseases[mim_disease_id].id = mim_disease_id
+            mim_diseases[mim_disease_id].phenotype = PHENOTYPE_FILTER
+        mim_diseases[mim_disease_id].genes.append(entrez_id)
 
-                # Check if the mim_phenotype number is the one
-                # in our filter. If not, skip and continue
-                if mim_phenotype != PHENOTYPE_FILTER:
-                    continue
+    return mim_diseases, genemap_lines, affected_mim_ids
 
-                if mim_disease_id not in mim_diseases:
-                    mim_diseases[mim_disease_id] = MIMdisease()
-                    mim_diseases[mim_disease_id].id = mim_disease_id
-                    mim_diseases[mim_disease_id].phenotype = mim_phenotype
 
-                if entrez_id not in mim_diseases[mim_disease_id].genes:
-                    mim_diseases[mim_disease_id].genes.append(entrez_id)
+class MIMGeneTable:
+    """
+    Columnar MIM disease -> Entrez gene table.
 
-    genemap_fh.close()
-    return mim_diseases
+    `mim_ids` and `entrez_ids` are parallel integer arrays with one entry
+    per (MIM disease, gene) pair, sorted by MIM disease ID, and genes of
+    the same disease in order of first appearance in the genemap file.
+
+    The table can be used in place of the dictionary returned by
+    `build_mim_diseases_dict()`: indexing it with a MIM disease ID string
+    returns a `MIMdisease` object built from its rows.
+    """
+    def __init__(self, mim_ids, entrez_ids):
+        self.mim_ids = mim_ids
+        self.entrez_ids = entrez_ids
+
+        # Row range of each MIM disease ID
+        self.rows = {}
+        start = 0
+        for row in range(1, len(mim_ids) + 1):
+            if row == len(mim_ids) or mim_ids[row] != mim_ids[start]:
+                self.rows[str(mim_ids[start])] = (start, row)
+                start = row
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, mim_disease_id):
+        return mim_disease_id in self.rows
+
+    def __getitem__(self, mim_disease_id):
+        start, end = self.rows[mim_disease_id]
+        mim_disease = MIMdisease()
+        mim_disease.id = mim_disease_id
+        mim_disease.phenotype = PHENOTYPE_FILTER
+        mim_disease.genes = [str(gid) for gid in self.entrez_ids[start:end]]
+        return mim_disease
+
+    def keys(self):
+        return self.rows.keys()
+
+
+def build_mim_gene_table(genemap_filename):
+    """
+    Function to parse genemap file into a columnar `MIMGeneTable`, which
+    is much smaller than the dictionary of `MIMdisease` objects returned by
+    `build_mim_diseases_dict()`.
+    """
+    mim_ids = array('q')
+    entrez_ids = array('q')
+    mim_genes = collect_mim_genes(genemap_filename)
+    # MIM disease IDs matched by `FIND_MIMIDS` may be empty, but
+    # such IDs can not be referenced by any OMIM xref.
+    for mim_disease_id in sorted((mim for mim in mim_genes if mim), key=int):
+        genes = mim_genes[mim_disease_id]
+        mim_ids.extend([int(mim_disease_id)] * len(genes))
+        entrez_ids.extend(int(gid) for gid in genes)
+
+    return MIMGeneTable(mim_ids, entrez_ids)
 
 
 # Based on `add_do_term_annotations()` in "annotation-refinery/process_do.py"
 # See https://github.com/greenelab/annotation-refinery
-def add_term_annotations(doid_omim_dict, disease_ontology, mim_diseases):
+def add_term_annotations(doid_omim_dict, disease_ontology, mim_diseases,
+                         mim_ids=None):
     """
     Function to add annotations to only the disease_ontology terms found in
     the doid_omim_dict (created by the build_doid_omim_dict() function).
@@ -523,7 +1722,11 @@ def add_term_annotations(doid_omim_dict, disease_ontology, mim_diseases):
     has parsed a DO OBO file instead of a GO OBO file.
 
     mim_diseases -- Dictionary of MIM IDs as the keys and MIMdisease
-    objects (defined above) as values.
+    objects (defined above) as values, or a `MIMGeneTable`.
+
+    mim_ids -- Optional set of MIM IDs (see `update_mim_diseases_dict()`).
+    If given, only the terms that have one of these IDs as OMIM xref are
+    annotated.
 
     Returns:
     A set of Entrez gene IDs, which will be used in MyGene.info query.
@@ -540,6 +1743,9 @@ def add_term_annotations(doid_omim_dict, disease_ontology, mim_diseases):
         #logging.info("Processing %s", term)
 
         omim_id_list = doid_omim_dict[doid]
+        if mim_ids is not None and mim_ids.isdisjoint(omim_id_list):
+            continue
+
         for omim_id in omim_id_list:
             # If omim_id is not in mim_diseases dict, ignore it.
             if omim_id not in mim_diseases:
@@ -628,88 +1834,1329 @@ def create_gs_abstract(do_term, doid_omim_dict):
     return abstract
 
 
-def query_mygene(entrez_set, tax_id):
-    """Query MyGene.info to get detailed gene information."""
+class MyGeneCache:
+    """
+    Persistent SQLite cache of MyGene.info query results.
 
-    q_genes = entrez_set
+    Each entry holds the raw MyGene.info hits of one query string (an Entrez
+    gene ID) for a given species and list of output fields, together with
+    the time it was fetched. Entries older than `ttl` seconds are treated
+    as misses, unless the cache is `offline`, in which case all entries are
+    served and nothing is queried.
+    """
+    def __init__(self, filename, ttl=MYGENE_CACHE_TTL, offline=False):
+        self.filename = filename
+        self.ttl = ttl
+        self.offline = offline
+        with closing(sqlite3.connect(self.filename)) as conn, conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS genes ('
+                'query TEXT, fields TEXT, hits TEXT, updated REAL, '
+                'PRIMARY KEY (query, fields))'
+            )
+
+    @staticmethod
+    def fields_key(tax_id, output_fields):
+        return '%s:%s' % (tax_id, ','.join(sorted(output_fields)))
+
+    def get(self, queries, tax_id, output_fields):
+        """
+        Look up the passed query strings.
+
+        Returns:
+        A tuple of (hits, misses): `hits` maps each cached query string to
+        its list of MyGene.info hits, and `misses` is the list of query
+        strings that have to be queried.
+        """
+        fields_key = self.fields_key(tax_id, output_fields)
+        oldest = time.time() - self.ttl
+        with closing(sqlite3.connect(self.filename)) as conn:
+            rows = conn.execute(
+                'SELECT query, hits, updated FROM genes WHERE fields = ?',
+                (fields_key,)
+            )
+            cached = {
+                query: hits for query, hits, updated in rows
+                if self.offline or updated >= oldest
+            }
+
+        hits = {}
+        misses = []
+        for query in queries:
+            if query in cached:
+                hits[query] = json.loads(cached[query])
+            else:
+                misses.append(query)
+
+        return hits, misses
+
+    def update(self, hits, tax_id, output_fields):
+        """Store the passed {query string: list of hits} dictionary."""
+        fields_key = self.fields_key(tax_id, output_fields)
+        updated = time.time()
+        with closing(sqlite3.connect(self.filename)) as conn, conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO genes VALUES (?, ?, ?, ?)',
+                [
+                    (query, fields_key, json.dumps(query_hits), updated)
+                    for query, query_hits in hits.items()
+                ]
+            )
+
+
+class MyGeneClient:
+    """
+    Batched, concurrent and retrying client of MyGene.info `querymany`.
+
+    Query terms are split into batches of `batch_size`, and at most
+    `concurrency` batches are queried at the same time. Each worker thread
+    reuses its own `mygene.MyGeneInfo` instance (and thus its HTTP
+    connection) across batches. A failed batch is retried up to `retries`
+    times with exponential backoff. Per-batch timings are appended to
+    `timings` and logged, to help tuning batch size and concurrency.
+    """
+    def __init__(self, url=None, batch_size=MYGENE_BATCH_SIZE,
+                 concurrency=MYGENE_CONCURRENCY, retries=MYGENE_RETRIES,
+                 backoff=MYGENE_BACKOFF):
+        self.url = url
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timings = []
+        self._local = threading.local()
+
+    def get_mygene(self):
+        """Return the `mygene.MyGeneInfo` instance of the current thread."""
+        mg = getattr(self._local, 'mg', None)
+        if mg is None:
+            mg = mygene.MyGeneInfo()
+            mg.delay = 0  # Requests are paced by `concurrency` instead
+            if self.url:
+                mg.url = self.url
+            self._local.mg = mg
+        return mg
+
+    def query_batch(self, batch_num, batch, **kwargs):
+        """Query one batch, retrying on errors, and return its hits."""
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                q_results = self.get_mygene().querymany(
+                    batch, returnall=True, verbose=False, **kwargs
+                )
+                break
+            except Exception as exc:
+                if attempt > self.retries:
+                    logging.error(
+                        "MyGene.info batch %d failed after %d attempts: %s",
+                        batch_num, attempt, exc
+                    )
+                    raise
+                delay = self.backoff * 2 ** (attempt - 1)
+                logging.warning(
+                    "MyGene.info batch %d failed (%s), retrying in %.1fs",
+                    batch_num, exc, delay
+                )
+                time.sleep(delay)
+
+        seconds = time.perf_counter() - start
+        self.timings.append({
+            'batch': batch_num,
+            'size': len(batch),
+            'attempts': attempt,
+            'seconds': seconds,
+        })
+        logging.info(
+            "MyGene.info batch %d: %d genes in %.2fs (%d attempts)",
+            batch_num, len(batch), seconds, attempt
+        )
+        return q_results['out']
+
+    def querymany(self, q_terms, callback=None, **kwargs):
+        """
+        Query all terms and return a dictionary that maps each query term
+        to its list of hits. Keyword arguments are passed to
+        `MyGeneInfo.querymany()`.
+
+        `callback` is called (in the calling thread) with the hits
+        dictionary of each batch as soon as it completes, so results can be
+        saved even if another batch fails. If any batch still fails after
+        its retries, the first error is raised once all batches are done.
+        """
+        batches = [
+            q_terms[i:i + self.batch_size]
+            for i in range(0, len(q_terms), self.batch_size)
+        ]
+
+        hits = dict()
+        error = None
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [
+                executor.submit(self.query_batch, batch_num, batch, **kwargs)
+                for batch_num, batch in enumerate(batches)
+            ]
+            for future in as_completed(futures):
+                try:
+                    batch_out = future.result()
+                except Exception as exc:
+                    error = error or exc
+                    continue
+
+                batch_hits = dict()
+                for gene in batch_out:
+                    batch_hits.setdefault(gene["query"], []).append(gene)
+                if callback is not None:
+                    callback(batch_hits)
+                hits.update(batch_hits)
+
+        if error is not None:
+            raise error
+        return hits
+
+
+class NCBIGeneIndex:
+    """
+    Memory-mapped lookup table of the genes of one species, built from NCBI
+    "gene_info" and "gene_history" files by `NCBIGeneIndex.build()`.
+
+    The file starts with `NCBI_INDEX_MAGIC`, the length of a JSON header and
+    the header itself, like ontology snapshots. Its sections are the sorted
+    64-bit array of gene IDs, the offsets of their records in a section of
+    JSON records (symbol and Ensembl genes), and the sorted 64-bit arrays
+    of discontinued gene IDs and of the IDs that replaced them (0 if none).
+    Genes are looked up by binary search on the memory map, so opening the
+    index does not read it.
+    """
+    def __init__(self, index_filename):
+        self.filename = index_filename
+        self.fh = open(index_filename, 'rb')
+        self.map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic_len = len(NCBI_INDEX_MAGIC)
+        if self.map[:magic_len] != NCBI_INDEX_MAGIC:
+            self.close()
+            raise ValueError('%s is not an NCBI gene index' % index_filename)
+        header_len = int.from_bytes(self.map[magic_len:magic_len + 4], 'little')
+        data_start = magic_len + 4 + header_len
+        self.header = json.loads(self.map[magic_len + 4:data_start])
+        self.tax_id = self.header['tax_id']
+
+        # All views of the map are kept, to be released before closing it.
+        self.views = [memoryview(self.map)]
+        self.sections = {}
+        for name, (offset, size) in self.header['sections'].items():
+            section = self.views[0][data_start + offset:data_start + offset + size]
+            self.views.append(section)
+            if name != 'records':
+                section = section.cast('q')
+                self.views.append(section)
+            self.sections[name] = section
+        self.gene_ids = self.sections['gene_ids']
+        self.record_offsets = self.sections['record_offsets']
+        self.records = self.sections['records']
+        self.history_ids = self.sections['history_ids']
+        self.history_targets = self.sections['history_targets']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Release the memory map, which must not be used anymore."""
+        for view in reversed(getattr(self, 'views', [])):
+            view.release()
+        self.views = []
+        self.sections = {}
+        self.map.close()
+        self.fh.close()
+
+    @staticmethod
+    def get_key(gene_info_filename, gene_history_filename, tax_id):
+        """Key of an index, which changes with its source files."""
+        key = [tax_id]
+        for filename in (gene_info_filename, gene_history_filename):
+            if filename:
+                stat = os.stat(filename)
+                key.append([os.path.basename(filename), stat.st_size, stat.st_mtime_ns])
+        return json.dumps(key)
+
+    @classmethod
+    def build(cls, index_filename, gene_info_filename,
+              gene_history_filename=None, tax_id=TAX_ID):
+        """
+        Build the index of the genes of `tax_id` in a "gene_info" file and,
+        optionally, a "gene_history" file, and return it opened.
+        """
+        tax_prefix = '%s\t' % tax_id
+        genes = []  # (gene ID, record) pairs
+        with open_input(gene_info_filename) as gene_info_fh:
+            for line in gene_info_fh:
+                # Columns: tax_id, GeneID, Symbol, LocusTag, Synonyms, dbXrefs, ...
+                if not line.startswith(tax_prefix):
+                    continue
+                columns = line.rstrip('\n').split('\t')
+                record = {'symbol': columns[2]}
+                ensembl_genes = [
+                    xref[len('Ensembl:'):] for xref in columns[5].split('|')
+                    if xref.startswith('Ensembl:')
+                ]
+                if ensembl_genes:
+                    record['ensembl'] = ensembl_genes
+                genes.append((int(columns[1]), record))
+        genes.sort(key=lambda gene: gene[0])
+
+        history = []  # (discontinued gene ID, gene ID or 0) pairs
+        if gene_history_filename:
+            with open_input(gene_history_filename) as history_fh:
+                for line in history_fh:
+                    # Columns: tax_id, GeneID, Discontinued_GeneID, ...
+                    if not line.startswith(tax_prefix):
+                        continue
+                    columns = line.split('\t', 3)
+                    target = 0 if columns[1] == '-' else int(columns[1])
+                    history.append((int(columns[2]), target))
+        history.sort()
+
+        records = array('q', [0])
+        record_bytes = []
+        for _, record in genes:
+            record_bytes.append(json.dumps(record).encode('utf-8'))
+            records.append(records[-1] + len(record_bytes[-1]))
+
+        blobs = [
+            ('gene_ids', array('q', [gid for gid, _ in genes]).tobytes()),
+            ('record_offsets', records.tobytes()),
+            ('history_ids', array('q', [gid for gid, _ in history]).tobytes()),
+            ('history_targets', array('q', [gid for _, gid in history]).tobytes()),
+            ('records', b''.join(record_bytes)),
+        ]
+        header = {
+            'key': cls.get_key(gene_info_filename, gene_history_filename, tax_id),
+            'tax_id': tax_id,
+            'byteorder': sys.byteorder,
+            'sections': {},
+        }
+        offset = 0
+        for name, blob in blobs:
+            header['sections'][name] = [offset, len(blob)]
+            offset += len(blob) + (-len(blob) % 8)
+        header_bytes = json.dumps(header).encode('utf-8')
+        header_bytes += b' ' * (-(len(NCBI_INDEX_MAGIC) + 4 + len(header_bytes)) % 8)
+
+        tmp_filename = index_filename + '.tmp'
+        with open(tmp_filename, 'wb') as fh:
+            fh.write(NCBI_INDEX_MAGIC)
+            fh.write(len(header_bytes).to_bytes(4, 'little'))
+            fh.write(header_bytes)
+            for name, blob in blobs:
+                fh.write(blob)
+                fh.write(b'\0' * (-len(blob) % 8))
+        os.replace(tmp_filename, index_filename)
+        logging.info("Indexed %d genes and %d discontinued genes in %s",
+                     len(genes), len(history), index_filename)
+        return cls(index_filename)
+
+    @classmethod
+    def load(cls, gene_info_filename, gene_history_filename=None, tax_id=TAX_ID):
+        """
+        Open the index of the passed files, kept next to "gene_info" with an
+        ".index" suffix, and (re)build it if it is missing or out of date.
+        """
+        index_filename = gene_info_filename + '.index'
+        key = cls.get_key(gene_info_filename, gene_history_filename, tax_id)
+        if os.path.exists(index_filename):
+            try:
+                index = cls(index_filename)
+            except ValueError:
+                index = None
+            if index is not None:
+                if index.header['key'] == key and \
+                        index.header['byteorder'] == sys.byteorder:
+                    return index
+                index.close()
+        return cls.build(
+            index_filename, gene_info_filename, gene_history_filename, tax_id)
+
+    @staticmethod
+    def find(sorted_ids, gid):
+        """Return the position of `gid` in a sorted array, or None."""
+        pos = bisect.bisect_left(sorted_ids, gid)
+        if pos < len(sorted_ids) and sorted_ids[pos] == gid:
+            return pos
+        return None
+
+    def resolve(self, gid):
+        """
+        Return the current ID of gene `gid`, following discontinued IDs to
+        the genes that replaced them, or None if it is not a current gene.
+        """
+        for _ in range(100):  # Guard against loops in the history
+            if self.find(self.gene_ids, gid) is not None:
+                return gid
+            pos = self.find(self.history_ids, gid)
+            if pos is None or self.history_targets[pos] == 0:
+                return None
+            gid = self.history_targets[pos]
+        return None
+
+    def get_hit(self, q_str):
+        """
+        Return the MyGene.info-like hit of the query string of a gene ID
+        (see `NCBIGeneClient`), or None if it can not be resolved.
+        """
+        gid = self.resolve(int(q_str))
+        if gid is None:
+            return None
+        pos = self.find(self.gene_ids, gid)
+        record = json.loads(bytes(
+            self.records[self.record_offsets[pos]:self.record_offsets[pos + 1]]))
+        hit = {'query': q_str, '_id': str(gid), 'entrezgene': gid,
+               'symbol': record['symbol']}
+        ensembl_genes = record.get('ensembl', [])
+        if len(ensembl_genes) == 1:
+            hit['ensembl'] = {'gene': ensembl_genes[0]}
+        elif ensembl_genes:
+            hit['ensembl'] = [{'gene': gene} for gene in ensembl_genes]
+        return hit
+
+
+class NCBIGeneClient:
+    """
+    Offline alternative to `MyGeneClient`, with the same `querymany()`,
+    that resolves Entrez gene IDs with an `NCBIGeneIndex`, including
+    discontinued IDs, like the "entrezgene" and "retired" scopes of
+    MyGene.info.
+
+    NCBI gene_info files have no UniProt IDs, so hits have none. Genes that
+    are not in the index are queried from the `fallback` client (e.g. a
+    `MyGeneClient`), if any, or reported as not found.
+    """
+    def __init__(self, index, fallback=None):
+        self.index = index
+        self.fallback = fallback
+
+    def querymany(self, q_terms, callback=None, **kwargs):
+        """
+        Return a dictionary that maps each query term to its list of hits.
+        `callback` is only called with the hits of the `fallback` client, so
+        that a `MyGeneCache` only caches MyGene.info results.
+        """
+        hits = dict()
+        misses = []
+        species = kwargs.get('species', self.index.tax_id)
+        for q_str in q_terms:
+            hit = None
+            if str(species) == str(self.index.tax_id):
+                hit = self.index.get_hit(q_str)
+            if hit is None:
+                misses.append(q_str)
+            else:
+                hits[q_str] = [hit]
+        logging.info("%d genes resolved from %s, %d missing",
+                     len(hits), self.index.filename, len(misses))
+
+        if misses and self.fallback is not None:
+            hits.update(self.fallback.querymany(misses, callback=callback, **kwargs))
+        else:
+            for q_str in misses:
+                hits[q_str] = [{'query': q_str, 'notfound': True}]
+        return hits
+
+
+def query_mygene(entrez_set, tax_id, cache=None, client=None):
+    """
+    Query MyGene.info to get detailed gene information.
+
+    If a `MyGeneCache` is passed, only the genes that are missing from it
+    (or have expired) are queried, and their results are added to it.
+
+    `client` is the `MyGeneClient` (or another client with the same
+    `querymany()`, like `NCBIGeneClient`) used for the queries; a default
+    one is created if it is not passed.
+    """
+
+    q_genes = [str(gid) for gid in entrez_set]
     q_scopes = ['entrezgene', 'retired']
     output_fields = ['entrezgene', 'ensembl.gene', 'symbol', 'uniprot']
 
-    mg = mygene.MyGeneInfo()
-    logging.info(f"Querying {q_scopes} in MyGene.info ...")
-    q_results = mg.querymany(
-        q_genes,
-        scopes=q_scopes,
-        fields=output_fields,
-        species=tax_id,
-        returnall=True
-    )
+    hits = dict()
+    if cache is not None:
+        hits, q_genes = cache.get(q_genes, tax_id, output_fields)
+        logging.info(f"{len(hits)} genes found in MyGene.info cache")
+
+    if q_genes and cache is not None and cache.offline:
+        logging.error(f"{len(q_genes)} genes not found in offline cache")
+        raise LookupError('Genes not in MyGene.info cache: %s' % q_genes[:10])
+
+    if q_genes:
+        if client is None:
+            client = MyGeneClient(url=MYGENE_URL)
+        if cache is not None:
+            def cache_batch(batch_hits):
+                cache.update(batch_hits, tax_id, output_fields)
+        else:
+            cache_batch = None
+
+        logging.info(f"Querying {q_scopes} in MyGene.info ...")
+        hits.update(client.querymany(
+            q_genes,
+            callback=cache_batch,
+            scopes=q_scopes,
+            fields=output_fields,
+            species=tax_id
+        ))
+
+    missing = [q_str for q_str, q_hits in hits.items() if q_hits[0].get('notfound')]
+    if missing:
+        logging.warning(f"{len(missing)} genes not found in MyGene.info: {missing[:10]}")
 
     genes_info = dict()
-    for gene in q_results['out']:
-        q_str = gene["query"]
-        genes_info[q_str] = {
-            'source': q_str,
-            'mygene': gene.get('_id', None),
-            'ncbigene': gene.get('entrezgene', None),
-            'ensemblgene': gene.get('ensembl', None),
-            'symbol': gene.get('symbol', None),
-            'uniprot': gene.get('uniprot', None)
-        }
+    for q_str, q_hits in hits.items():
+        for gene in q_hits:
+            genes_info[q_str] = create_gene_record(q_str, gene)
 
     return genes_info
 
 
+def create_gene_record(q_str, gene):
+    """
+    Function to create the record of a gene in geneset documents from its
+    MyGene.info hit.
+
+    Records are cleaned up here, once per gene, the same way `dict_sweep()`
+    and `unlist()` of Biothings would clean them up in each geneset
+    document: keys with None values are removed, and single-element lists
+    are replaced by their element. Records are shared by all genesets that
+    include the gene, so they must not be modified.
+    """
+    gene_record = {
+        'source': q_str,
+        'mygene': gene.get('_id', None),
+        'ncbigene': gene.get('entrezgene', None),
+        'ensemblgene': gene.get('ensembl', None),
+        'symbol': gene.get('symbol', None),
+        'uniprot': gene.get('uniprot', None)
+    }
+    gene_record = dict_sweep(gene_record, vals=[None], remove_invalid_list=True)
+    return unlist(gene_record)
+
+
+def create_geneset(term_id, term, gid_list, genes_info, doid_omim_dict):
+    """
+    Function to create the geneset document of a DO term.
+
+    Arguments:
+    term_id -- The DO ID of the term.
+
+    term -- The GOTerm object of the term.
+
+    gid_list -- Sorted list of the term's (propagated) Entrez gene IDs.
+
+    genes_info -- Dictionary of gene information returned by query_mygene(),
+    whose gene records are already cleaned up by create_gene_record().
+
+    doid_omim_dict -- A dictionary of DO terms mapping to sets of OMIM xrefs.
+
+    Returns:
+    my_geneset -- The geneset document.
+    """
+    my_geneset = {}
+    my_geneset['_id'] = create_gs_id(term)
+    my_geneset['is_public'] = True
+    my_geneset['creator'] = 'disease_ontology_parser'
+    my_geneset['date'] = date.today().isoformat()
+    my_geneset['taxid'] = TAX_ID
+
+    # None of the values can be None, so only `unlist()` of Biothings still
+    # applies at the document level: a single gene is not put in a list.
+    genes = [genes_info[str(gid)] for gid in gid_list]
+    if len(genes) == 1:
+        my_geneset['genes'] = genes[0]
+    else:
+        my_geneset['genes'] = genes
+    my_geneset['disease_ontology'] = {
+        'id': term_id,
+        'abstract': create_gs_abstract(term, doid_omim_dict)
+    }
+    return my_geneset
+
+
+def get_peak_rss():
+    """Return the peak resident set size of the process in bytes, or None."""
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+class PipelineMetrics:
+    """
+    Wall time, CPU time, peak RSS growth and item counts of the stages of
+    the geneset pipeline (see `iter_genesets()`).
+
+    CPU time is the time of the thread that runs a stage, so stages that
+    run in the background (`query_mygene`) are not counted twice. With
+    `profile=True`, each stage is also run under cProfile, and with
+    `trace_memory=True` under tracemalloc, and the top functions and peak
+    traced memory are added to the report.
+
+    Peak RSS and traced memory are process-wide, so they can not be split
+    between stages that overlap, like `query_mygene` in the background of
+    `propagate`. The figures of such stages include the allocations of
+    each other, and the stages are flagged with `memory_overlap`. The
+    tracemalloc peak is only reset by a stage that starts while no other
+    stage runs, so that it never hides the peak of a running stage.
+    """
+    def __init__(self, profile=False, trace_memory=False, profile_top=20):
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.profile_top = profile_top
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.started_tracing = False
+        self.running = []  # A {'overlap': bool} dictionary per running stage
+
+    def get_stage(self, name):
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = {
+                    'wall_time': 0.0,
+                    'cpu_time': 0.0,
+                    'peak_rss_delta': 0,
+                    'counts': {},
+                }
+            return self.stages[name]
+
+    def count(self, name, **counts):
+        """Add item counts to a stage."""
+        stage = self.get_stage(name)
+        with self.lock:
+            for key, value in counts.items():
+                stage['counts'][key] = stage['counts'].get(key, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager that measures the code it runs as stage `name`."""
+        stage = self.get_stage(name)
+        profiler = None
+        if self.profile:
+            profiler = cProfile.Profile()
+        run = {'overlap': False}
+        with self.lock:
+            for other_run in self.running:
+                other_run['overlap'] = run['overlap'] = True
+            self.running.append(run)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            if not run['overlap']:
+                tracemalloc.reset_peak()
+            traced_start = tracemalloc.get_traced_memory()[0]
+
+        peak_rss = get_peak_rss()
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield stage
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.thread_time() - cpu_start
+            with self.lock:
+                self.running.remove(run)
+                if run['overlap']:
+                    stage['memory_overlap'] = True
+                stage['wall_time'] += wall_time
+                stage['cpu_time'] += cpu_time
+                if peak_rss is not None:
+                    stage['peak_rss_delta'] += get_peak_rss() - peak_rss
+                if self.trace_memory:
+                    traced_peak = tracemalloc.get_traced_memory()[1] - traced_start
+                    stage['traced_memory_peak'] = max(
+                        stage.get('traced_memory_peak', 0), traced_peak)
+                if profiler is not None:
+                    if 'profile' in stage:
+                        profiler.create_stats()
+                        stage['profile'].add(profiler)
+                    else:
+                        stage['profile'] = pstats.Stats(
+                            profiler, stream=io.StringIO())
+
+    def call(self, name, func, *args, **kwargs):
+        """Call `func(*args, **kwargs)` as stage `name`."""
+        with self.stage(name):
+            return func(*args, **kwargs)
+
+    def iterate(self, name, iterable, count_key='items'):
+        """
+        Generate the items of `iterable`, measuring only the time spent
+        producing them (not the time spent by the caller between items) as
+        stage `name`, and counting them as its `count_key`.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            self.count(name, **{count_key: 1})
+            yield item
+
+    def report(self):
+        """Return the metrics as a JSON-serializable dictionary."""
+        report = {}
+        for name, stage in self.stages.items():
+            report[name] = {
+                key: value for key, value in stage.items() if key != 'profile'
+            }
+            if 'profile' in stage:
+                stats = stage['profile'].stats
+                top = sorted(stats.items(), key=lambda item: -item[1][3])
+                report[name]['profile'] = [
+                    {
+                        'function': '%s:%d(%s)' % func,
+                        'calls': calls,
+                        'tottime': tottime,
+                        'cumtime': cumtime,
+                    }
+                    for func, (_, calls, tottime, cumtime, _) in
+                    top[:self.profile_top]
+                ]
+        return report
+
+    def log(self):
+        """Log the metrics of each stage."""
+        for name, stage in self.stages.items():
+            counts = ', '.join(
+                '%s=%d' % item for item in stage['counts'].items())
+            logging.info(
+                "Stage %s: %.3fs wall, %.3fs CPU, %+.1f MiB peak RSS%s%s",
+                name, stage['wall_time'], stage['cpu_time'],
+                stage['peak_rss_delta'] / 2**20,
+                ' (overlapping stages)' if stage.get('memory_overlap') else '',
+                ', ' + counts if counts else ''
+            )
+
+    def save(self, filename):
+        """Save the report as a JSON file."""
+        with open(filename, 'w') as report_fh:
+            json.dump(self.report(), report_fh, indent=2)
+
+    def close(self):
+        """Stop tracemalloc if these metrics started it."""
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+
+def get_term_labels(term, gid_list):
+    """
+    Return the (name, full name, description, gene IDs) tuple of a DO term
+    that `create_term_genesets()` needs, without the links to other terms.
+    """
+    return term.name, term.full_name, term.description, gid_list
+
+
+def create_term_genesets(term_ids, term_labels, genes_info, doid_omim_dict):
+    """
+    Function to create the geneset documents of the DO terms in `term_ids`,
+    from their `term_labels` (see `get_term_labels()`).
+    """
+    genesets = []
+    for term_id in term_ids:
+        term = GOTerm(term_id)
+        term.name, term.full_name, term.description, gid_list = \
+            term_labels[term_id]
+        genesets.append(create_geneset(
+            term_id, term, gid_list, genes_info, doid_omim_dict
+        ))
+    return genesets
+
+
+# Read-only inputs of `create_term_genesets()` in worker processes
+assembly_inputs = None
+
+
+def init_assembly_worker(term_labels, genes_info, doid_omim_dict):
+    """Initializer of the worker processes of `iter_assembled_genesets()`."""
+    global assembly_inputs
+    assembly_inputs = (term_labels, genes_info, doid_omim_dict)
+
+
+def assemble_genesets(term_ids):
+    """Worker function of `iter_assembled_genesets()`."""
+    return create_term_genesets(term_ids, *assembly_inputs)
+
+
+def iter_assembled_genesets(term_labels, genes_info, doid_omim_dict,
+                            processes=ASSEMBLY_PROCESSES,
+                            chunk_size=ASSEMBLY_CHUNK_SIZE):
+    """
+    Generate the geneset documents of all terms in `term_labels`, a
+    dictionary that maps DO IDs to their `get_term_labels()`, in the same
+    order.
+
+    Documents are assembled in the main process by default. With more than
+    one of `processes` (or None, for one per CPU), they are assembled in
+    chunks of `chunk_size` terms by a pool of worker processes. The
+    read-only inputs are passed once to
+    each worker, when it starts, so that each task only carries the list of
+    DO IDs of its chunk.
+    """
+    term_ids = list(term_labels)
+    chunks = [
+        term_ids[start:start + chunk_size]
+        for start in range(0, len(term_ids), chunk_size)
+    ]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(chunks))
+
+    if processes <= 1:
+        for chunk in chunks:
+            for my_geneset in create_term_genesets(
+                    chunk, term_labels, genes_info, doid_omim_dict):
+                yield my_geneset
+        return
+
+    logging.info("Assemble %d genesets in %d processes",
+                 len(term_ids), processes)
+    with ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=init_assembly_worker,
+            initargs=(term_labels, genes_info, doid_omim_dict)
+    ) as executor:
+        # `map()` returns the results in the order of `chunks`
+        for genesets in executor.map(assemble_genesets, chunks):
+            for my_geneset in genesets:
+                yield my_geneset
+
+
+def get_geneset_id(term_id, term_labels):
+    """Return the `create_gs_id()` of a DO term in `term_labels`."""
+    term = GOTerm(term_id)
+    term.full_name = term_labels[term_id][1]
+    return create_gs_id(term)
+
+
+def gene_ids_digest(gid_list):
+    """
+    Return a digest of a sorted list of gene IDs only, which groups
+    duplicate genesets (unlike `geneset_fingerprint()`, which also covers
+    the DO ID and abstract of a geneset, to detect changes).
+    """
+    return hashlib.sha1(json.dumps(gid_list).encode('utf-8')).digest()
+
+
+def find_duplicate_genesets(term_labels):
+    """
+    Group the DO terms of `term_labels` (see `get_term_labels()`) that have
+    exactly the same genes, by the `gene_ids_digest()` of their gene IDs.
+
+    Returns:
+    A dictionary that maps the ID of each duplicate term to the ID of the
+    canonical term of its group, the first one in `term_labels`.
+    """
+    canonical_ids = dict()
+    duplicates = dict()
+    for term_id, labels in term_labels.items():
+        canonical_id = canonical_ids.setdefault(
+            gene_ids_digest(labels[-1]), term_id)
+        if canonical_id != term_id:
+            duplicates[term_id] = canonical_id
+    return duplicates
+
+
+def minhash_signatures(gene_sets, permutations=MINHASH_PERMUTATIONS,
+                       seed=MINHASH_SEED):
+    """
+    Return the MinHash signatures of a list of gene ID lists, as a
+    (gene sets x permutations) array. Each permutation is a random
+    universal hash function `(a * gid + b) % p` of the gene IDs.
+    """
+    prime = (1 << 31) - 1
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, prime, size=permutations).astype(np.int64)
+    b = rng.randint(0, prime, size=permutations).astype(np.int64)
+
+    signatures = np.empty((len(gene_sets), permutations), dtype=np.int64)
+    for idx, gids in enumerate(gene_sets):
+        values = np.asarray(gids, dtype=np.int64) % prime
+        signatures[idx] = ((np.outer(values, a) + b) % prime).min(axis=0)
+    return signatures
+
+
+def get_lsh_bands(threshold, permutations, recall=0.99):
+    """
+    Return the (bands, rows) split of `permutations` MinHash values with the
+    most rows per band (i.e. the fewest candidate pairs) that still makes a
+    pair of gene sets of Jaccard similarity `threshold` a candidate with a
+    probability of at least `recall`: `1 - (1 - threshold ** rows) ** bands`.
+    """
+    best_bands, best_rows = permutations, 1
+    for rows in range(2, permutations + 1):
+        bands = permutations // rows
+        if 1 - (1 - threshold ** rows) ** bands < recall:
+            break
+        best_bands, best_rows = bands, rows
+    return best_bands, best_rows
+
+
+def find_near_duplicates(term_labels, threshold=DEDUP_JACCARD_THRESHOLD,
+                         permutations=MINHASH_PERMUTATIONS, seed=MINHASH_SEED):
+    """
+    Find the pairs of DO terms of `term_labels` (see `get_term_labels()`)
+    whose genes have a Jaccard similarity of at least `threshold`, but are
+    not the same. Needs NumPy.
+
+    Rather than comparing all pairs of terms, the MinHash signatures of
+    their genes are split in bands (see `get_lsh_bands()`), and only the
+    terms that share the values of a band are compared, by the exact
+    Jaccard similarity of their genes.
+
+    Returns:
+    A dictionary that maps the ID of each term that has near-duplicates to
+    a list of (term ID, Jaccard similarity) pairs, in the order of
+    `term_labels`.
+    """
+    if np is None:
+        raise ImportError('find_near_duplicates() needs NumPy')
+
+    term_ids = list(term_labels)
+    gene_sets = [term_labels[term_id][-1] for term_id in term_ids]
+    signatures = minhash_signatures(gene_sets, permutations, seed)
+    bands, rows = get_lsh_bands(threshold, permutations)
+
+    candidates = set()
+    for band in range(bands):
+        buckets = dict()
+        band_values = signatures[:, band * rows:(band + 1) * rows]
+        for idx, values in enumerate(band_values):
+            buckets.setdefault(values.tobytes(), []).append(idx)
+        for bucket in buckets.values():
+            for pos, idx in enumerate(bucket):
+                for other_idx in bucket[pos + 1:]:
+                    candidates.add((idx, other_idx))
+
+    gene_set_cache = dict()
+
+    def get_gene_set(idx):
+        if idx not in gene_set_cache:
+            gene_set_cache[idx] = set(gene_sets[idx])
+        return gene_set_cache[idx]
+
+    near_duplicates = dict()
+    for idx, other_idx in sorted(candidates):
+        sizes = sorted((len(gene_sets[idx]), len(gene_sets[other_idx])))
+        if sizes[0] < threshold * sizes[1]:
+            continue  # The Jaccard similarity is at most sizes[0] / sizes[1]
+        gene_set, other_gene_set = get_gene_set(idx), get_gene_set(other_idx)
+        intersection = len(gene_set & other_gene_set)
+        jaccard = intersection / (len(gene_set) + len(other_gene_set) - intersection)
+        if threshold <= jaccard < 1:
+            term_id, other_term_id = term_ids[idx], term_ids[other_idx]
+            near_duplicates.setdefault(term_id, []).append((other_term_id, jaccard))
+            near_duplicates.setdefault(other_term_id, []).append((term_id, jaccard))
+    return near_duplicates
+
+
+def iter_collapsed_genesets(genesets, gs_ids, duplicates, near_duplicates=None,
+                            reference=False):
+    """
+    Add the duplicates (see `find_duplicate_genesets()`) and near-duplicates
+    (see `find_near_duplicates()`) of each geneset of `genesets` to it, as
+    lists of geneset IDs in "duplicates" and of {"_id", "jaccard"}
+    dictionaries in "near_duplicates". `gs_ids` maps DO IDs to geneset IDs.
+
+    With `reference=True`, the genes of each duplicate are replaced by the
+    ID of its canonical geneset in "duplicate_of", and only the canonical
+    geneset lists its duplicates.
+    """
+    groups = dict()
+    for term_id, canonical_id in duplicates.items():
+        groups.setdefault(canonical_id, [canonical_id]).append(term_id)
+
+    for my_geneset in genesets:
+        term_id = my_geneset['disease_ontology']['id']
+        canonical_id = duplicates.get(term_id, term_id)
+        if reference and canonical_id != term_id:
+            del my_geneset['genes']
+            my_geneset['duplicate_of'] = gs_ids[canonical_id]
+        elif canonical_id in groups:
+            my_geneset['duplicates'] = [
+                gs_ids[other_id] for other_id in groups[canonical_id]
+                if other_id != term_id
+            ]
+        if near_duplicates and term_id in near_duplicates:
+            my_geneset['near_duplicates'] = [
+                {'_id': gs_ids[other_id], 'jaccard': round(jaccard, 4)}
+                for other_id, jaccard in near_duplicates[term_id]
+            ]
+        yield my_geneset
+
+
 # Based on `process_do_terms()` in "annotation-refinery/process_do.py".
 # See https://github.com/greenelab/annotation-refinery
 # Changed from a regular function to generator to work with Biothings SDK.
-def get_genesets(obo_filename, genemap_filename):
-    disease_ontology = GO()
-    obo_is_loaded = disease_ontology.load_obo(obo_filename)
+def iter_genesets(obo_filename, genemap_filename, compact=False,
+                  gene_cache=None, snapshot_dir=None, sparse_matrices=False,
+                  metrics=None, gene_client=None, dedup=None,
+                  dedup_threshold=DEDUP_JACCARD_THRESHOLD):
+    """
+    Generate the genesets of all DO terms that have (propagated) genes.
+
+    Each geneset document is yielded as soon as it is built, so the caller
+    can consume (e.g. upload) documents while the rest are being assembled
+    and never has to hold all of them in memory.
+
+    With `compact=True`, gene annotations are propagated as integer
+    bitsets (see `GO.propagate_bitsets()`) instead of `Annotation` copies,
+    which uses much less memory and time on large ontologies. With
+    `sparse_matrices=True`, they are propagated as sparse matrices (see
+    `GO.propagate_sparse()`), which needs NumPy and SciPy and pays off on
+    ontologies much larger than DO.
+
+    `gene_cache` is an optional `MyGeneCache` and `gene_client` an optional
+    client (e.g. `NCBIGeneClient`) used by `query_mygene()`, and
+    `snapshot_dir` an optional directory of ontology snapshots used by
+    `load_disease_ontology()`.
+
+    `dedup` is an optional mode ('annotate' or 'reference') of collapse of
+    the genesets that have the same genes (see `DEDUP_MODE`), and of the
+    ones whose genes have a Jaccard similarity of at least
+    `dedup_threshold`, when it is below 1.
+
+    Each stage is measured in `metrics`, an optional `PipelineMetrics`,
+    whose metrics are logged once all genesets have been generated. OMIM
+    xrefs are collected while the OBO file is parsed, so the
+    `build_doid_omim_dict` stage is part of the `load_obo` one.
+    """
+    if metrics is None:
+        metrics = PipelineMetrics()
+
+    with metrics.stage('load_obo'):
+        disease_ontology, doid_omim_dict = load_disease_ontology(
+            obo_filename, snapshot_dir=snapshot_dir
+        )
+    metrics.count(
+        'load_obo',
+        terms=len(disease_ontology.go_terms),
+        xrefs=sum(len(omim_ids) for omim_ids in doid_omim_dict.values())
+    )
+
+    with metrics.stage('build_mim_diseases_dict'):
+        mim_diseases = build_mim_diseases_dict(genemap_filename)
+    metrics.count('build_mim_diseases_dict', mim_diseases=len(mim_diseases))
+
+    with metrics.stage('add_term_annotations'):
+        entrez_set = add_term_annotations(
+            doid_omim_dict,
+            disease_ontology,
+            mim_diseases
+        )
+    direct_annotations = sum(
+        len(term.annotations) for term in disease_ontology.go_terms.values())
+    metrics.count(
+        'add_term_annotations',
+        entrez_ids=len(entrez_set),
+        annotations=direct_annotations
+    )
+
+    # Gene information is only needed to assemble the documents, so query
+    # it in the background while the (CPU bound) propagation runs.
+    executor = ThreadPoolExecutor(max_workers=1)
+    genes_future = executor.submit(
+        metrics.call, 'query_mygene',
+        query_mygene, entrez_set, TAX_ID, cache=gene_cache, client=gene_client
+    )
+    executor.shutdown(wait=False)
+
+    with metrics.stage('propagate'):
+        disease_ontology.populated = True
+        if sparse_matrices:
+            gene_index = GeneIndex(entrez_set)
+            gene_arrays = disease_ontology.propagate_sparse(gene_index)
+            gids = np.array(gene_index.gids, dtype=np.int64)
+        elif compact:
+            gene_index = GeneIndex(entrez_set)
+            disease_ontology.propagate_bitsets(gene_index)
+        else:
+            disease_ontology.propagate()
+
+        term_labels = dict()
+        for term_id, term in disease_ontology.go_terms.items():
+            # If a term includes anyvalid gene IDs, add it as a geneset.
+            # Genes in a geneset are sorted by their IDs to make output reproducible.
+            if sparse_matrices:
+                gid_list = gids[gene_arrays[term_id]].tolist()
+            elif compact:
+                gid_list = gene_index.decode(
+                    term.gene_bits | term.cutoff_gene_bits)
+            else:
+                gid_list = sorted(
+                    set(annotation.gid for annotation in term.annotations))
+
+            if gid_list:
+                term_labels[term_id] = get_term_labels(term, gid_list)
+
+    metrics.count(
+        'propagate',
+        term_gene_pairs=sum(len(labels[-1]) for labels in term_labels.values())
+    )
+    if not (sparse_matrices or compact):
+        metrics.count('propagate', annotation_copies=sum(
+            len(term.annotations) for term in disease_ontology.go_terms.values()
+        ) - direct_annotations)
+
+    if dedup:
+        with metrics.stage('dedup'):
+            duplicates = find_duplicate_genesets(term_labels)
+            near_duplicates = None
+            if dedup_threshold < 1:
+                near_duplicates = find_near_duplicates({
+                    term_id: labels for term_id, labels in term_labels.items()
+                    if term_id not in duplicates
+                }, dedup_threshold)
+            gs_ids = {
+                term_id: get_geneset_id(term_id, term_labels)
+                for term_id in term_labels
+            }
+            gene_records = sum(len(labels[-1]) for labels in term_labels.values())
+            if dedup == 'reference':
+                # Genes of duplicates are not assembled at all
+                for term_id in duplicates:
+                    term_labels[term_id] = term_labels[term_id][:-1] + ([],)
+            collapsed_gene_records = sum(
+                len(labels[-1]) for labels in term_labels.values())
+        metrics.count(
+            'dedup',
+            duplicates=len(duplicates),
+            near_duplicates=len(near_duplicates or ()),
+            gene_records=gene_records,
+            collapsed_gene_records=collapsed_gene_records
+        )
+        logging.info("%d of %d genesets are duplicates, gene records "
+                     "collapsed %.2fx", len(duplicates), len(term_labels),
+                     gene_records / max(collapsed_gene_records, 1))
+
+    genes_info = genes_future.result()
+    metrics.count('query_mygene', genes=len(genes_info))
+
+    genesets = iter_assembled_genesets(term_labels, genes_info, doid_omim_dict)
+    if dedup:
+        genesets = iter_collapsed_genesets(
+            genesets, gs_ids, duplicates, near_duplicates,
+            reference=dedup == 'reference'
+        )
+    for my_geneset in metrics.iterate('assemble_genesets', genesets, 'genesets'):
+        yield my_geneset
+
+    metrics.log()
+    metrics.close()
+
+
+def get_genesets(obo_filename, genemap_filename, **kwargs):
+    """
+    Return the list of all genesets built by `iter_genesets()`, which also
+    gets all keyword arguments.
+    """
+
+    return list(iter_genesets(obo_filename, genemap_filename, **kwargs))
+
+
+def geneset_fingerprint(term_id, gid_list, abstract):
+    """
+    Return a fingerprint of the content of a geneset that matters to
+    incremental rebuilds: its DO ID, gene IDs and abstract.
+    """
+    content = json.dumps([term_id, gid_list, abstract])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def load_build_state(state_filename):
+    """Load the state saved by `iter_geneset_changes()`, if any."""
+    if not state_filename or not os.path.exists(state_filename):
+        return None
+    with open(state_filename) as state_fh:
+        return json.load(state_fh)
 
-    if obo_is_loaded is False:
-        logging.error('Failed to load OBO file.')
 
-    doid_omim_dict = build_doid_omim_dict(obo_filename)
+def save_build_state(state_filename, state):
+    """Save the state of a build atomically."""
+    tmp_filename = state_filename + '.tmp'
+    with open(tmp_filename, 'w') as state_fh:
+        json.dump(state, state_fh)
+    os.replace(tmp_filename, state_filename)
 
-    mim_diseases = build_mim_diseases_dict(genemap_filename)
 
-    entrez_set = add_term_annotations(
-        doid_omim_dict,
-        disease_ontology,
-        mim_diseases
+def iter_geneset_changes(obo_filename, genemap_filename, state_filename,
+                         gene_cache=None, snapshot_dir=None, gene_client=None):
+    """
+    Generate the genesets that changed since the previous run.
+
+    The state of each run is saved in `state_filename`: the digest of the
+    OBO file, the parsed genemap lines (see `update_mim_diseases_dict()`),
+    the direct and propagated gene IDs of every DO term and the fingerprint
+    (see `geneset_fingerprint()`) of every geneset. Only the genemap lines
+    that changed are parsed. If the OBO file is unchanged, only the terms
+    that reference an affected MIM disease ID are re-annotated, and only
+    the terms whose direct OMIM annotations changed and their ancestors are
+    re-propagated (see `GO.propagate_changes()`); otherwise, or without a
+    previous state, all terms are annotated and propagated.
+
+    Generates (change, document) pairs, where `change` is 'added',
+    'changed' or 'deleted'. Deleted genesets are given as `{'_id': ...}`.
+    Gene information is only queried for the genes of emitted genesets.
+    The new state is saved once all changes have been generated.
+    """
+    obo_digest = file_digest(obo_filename)
+    disease_ontology, doid_omim_dict = load_disease_ontology(
+        obo_filename, snapshot_dir=snapshot_dir
+    )
+
+    previous = load_build_state(state_filename)
+    previous_lines = None
+    if previous is not None:
+        previous_lines = previous.get('genemap_lines')
+    mim_diseases, genemap_lines, affected_mim_ids = update_mim_diseases_dict(
+        genemap_filename, previous_lines
     )
 
-    genes_info = query_mygene(entrez_set, TAX_ID)
+    if previous is not None and previous['obo_digest'] != obo_digest:
+        logging.info("OBO file changed, propagating all terms")
+        previous_fingerprints = previous['fingerprints']
+        previous = None
+    elif previous is not None:
+        previous_fingerprints = previous['fingerprints']
+    else:
+        previous_fingerprints = dict()
+
+    if previous is None or previous_lines is None:
+        entrez_set = add_term_annotations(
+            doid_omim_dict,
+            disease_ontology,
+            mim_diseases
+        )
+    else:
+        # Only the terms that reference an affected MIM disease ID are
+        # annotated from genemap, the others get their previous genes.
+        logging.info("%d MIM disease IDs affected by genemap changes",
+                     len(affected_mim_ids))
+        entrez_set = add_term_annotations(
+            doid_omim_dict,
+            disease_ontology,
+            mim_diseases,
+            mim_ids=affected_mim_ids
+        )
+        affected_terms = set(
+            disease_ontology.get_term(doid)
+            for doid, omim_ids in doid_omim_dict.items()
+            if not affected_mim_ids.isdisjoint(omim_ids)
+        )
+        for term_id, gids in previous['direct_genes'].items():
+            term = disease_ontology.go_terms.get(term_id)
+            if term is None or term in affected_terms:
+                continue
+            for gid in gids:
+                term.add_annotation(gid=gid, ref=None)
     disease_ontology.populated = True
-    disease_ontology.propagate()
 
-    genesets = list()
+    direct_genes = dict()
     for term_id, term in disease_ontology.go_terms.items():
-        # If a term includes anyvalid gene IDs, add it as a geneset.
-        gid_set = set()
-        for annotation in term.annotations:
-            gid_set.add(annotation.gid)
-
-        if gid_set:
-            my_geneset = {}
-            my_geneset['_id'] = create_gs_id(term)
-            my_geneset['is_public'] = True
-            my_geneset['creator'] = 'disease_ontology_parser'
-            my_geneset['date'] = date.today().isoformat()
-            my_geneset['taxid'] = TAX_ID
+        if term.annotations:
+            direct_genes[term_id] = sorted(
+                set(annotation.gid for annotation in term.annotations))
+
+    propagated_genes = dict()  # term ID -> [gene IDs, cutoff gene IDs]
+    if previous is None:
+        gene_index = GeneIndex(entrez_set)
+        disease_ontology.propagate_bitsets(gene_index)
+        updated_terms = list(disease_ontology.go_terms.items())
+        for term_id, term in updated_terms:
+            if term.gene_bits or term.cutoff_gene_bits:
+                propagated_genes[term_id] = [
+                    gene_index.decode(term.gene_bits),
+                    gene_index.decode(term.cutoff_gene_bits)
+                ]
+    else:
+        previous_direct = previous['direct_genes']
+        changed_terms = set(
+            disease_ontology.go_terms[term_id]
+            for term_id in set(direct_genes) | set(previous_direct)
+            if direct_genes.get(term_id) != previous_direct.get(term_id)
+            and term_id in disease_ontology.go_terms
+        )
+        propagated_genes = dict(previous['propagated_genes'])
+        updated_terms = list()
+        for term, (gids, cutoff_gids) in disease_ontology.propagate_changes(
+                changed_terms, propagated_genes).items():
+            if term.go_id not in disease_ontology.go_terms:
+                continue
+            updated_terms.append((term.go_id, term))
+            if gids or cutoff_gids:
+                propagated_genes[term.go_id] = [sorted(gids), sorted(cutoff_gids)]
+            else:
+                propagated_genes.pop(term.go_id, None)
+
+    # Fingerprints of terms that were not re-propagated are unchanged.
+    fingerprints = dict()
+    if previous is not None:
+        fingerprints.update(previous_fingerprints)
+    changed = list()
+    for term_id, term in updated_terms:
+        gs_id = create_gs_id(term)
+        gids, cutoff_gids = propagated_genes.get(term_id, ([], []))
+        gid_list = sorted(set(gids) | set(cutoff_gids))
+        if not gid_list:
+            fingerprints.pop(gs_id, None)
+            continue
+        fingerprints[gs_id] = geneset_fingerprint(
+            term_id, gid_list, create_gs_abstract(term, doid_omim_dict))
+        if fingerprints[gs_id] != previous_fingerprints.get(gs_id):
+            changed.append((term_id, term, gid_list))
+
+    deleted = [
+        gs_id for gs_id in previous_fingerprints if gs_id not in fingerprints
+    ]
+    logging.info("%d genesets added or changed, %d deleted",
+                 len(changed), len(deleted))
+
+    changed_gids = set(gid for _, _, gid_list in changed for gid in gid_list)
+    genes_info = dict()
+    if changed_gids:
+        genes_info = query_mygene(
+            changed_gids, TAX_ID, cache=gene_cache, client=gene_client)
 
-            # Genes in a geneset are sorted by their IDs to make output reproducible.
-            my_geneset['genes'] = [genes_info[str(gid)] for gid in sorted(gid_set)]
-            my_geneset['disease_ontology'] = {
-                'id': term_id,
-                'abstract': create_gs_abstract(term, doid_omim_dict)
-            }
-            my_geneset = dict_sweep(my_geneset, vals=[None], remove_invalid_list=True)
-            my_geneset = unlist(my_geneset)
-            genesets.append(my_geneset)
+    term_labels = dict(
+        (term_id, get_term_labels(term, gid_list))
+        for term_id, term, gid_list in changed
+    )
+    for my_geneset in iter_assembled_genesets(
+            term_labels, genes_info, doid_omim_dict):
+        if my_geneset['_id'] in previous_fingerprints:
+            yield 'changed', my_geneset
+        else:
+            yield 'added', my_geneset
+    for gs_id in deleted:
+        yield 'deleted', {'_id': gs_id}
 
-    return genesets
+    save_build_state(state_filename, {
+        'obo_digest': obo_digest,
+        'direct_genes': direct_genes,
+        'genemap_lines': genemap_lines,
+        'propagated_genes': propagated_genes,
+        'fingerprints': fingerprints,
+    })
 
 
 def load_data(data_dir):
@@ -718,19 +3165,460 @@ def load_data(data_dir):
     obo_filename = os.path.join(data_dir, "HumanDO.obo")
     genemap_filename = os.path.join(data_dir, "genemap2.txt")
 
-    genesets = get_genesets(obo_filename, genemap_filename)
-    for gs in genesets:
+    metrics = PipelineMetrics(
+        profile=METRICS_PROFILE, trace_memory=METRICS_TRACE_MEMORY
+    )
+    for gs in iter_genesets(
+            obo_filename, genemap_filename, metrics=metrics,
+            dedup=DEDUP_MODE, dedup_threshold=DEDUP_JACCARD_THRESHOLD,
+            **get_cache_options(data_dir)):
+        yield gs
+
+    if METRICS_FILENAME:
+        metrics.save(os.path.join(
+            os.path.dirname(os.path.abspath(data_dir)), METRICS_FILENAME
+        ))
+
+
+def get_shard(gs_id, shards):
+    """Return the shard of a geneset ID, which only depends on the ID."""
+    digest = hashlib.blake2b(gs_id.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shards
+
+
+def write_geneset_shard(export_dir, shard_filename, documents, compresslevel):
+    """
+    Worker function of `export_genesets()`, that writes the documents of
+    the `documents` queue, until None, as a gzip-compressed NDJSON file.
+
+    The gzip header has no file name or time, so the same documents always
+    give the same bytes.
+
+    Returns:
+    The manifest entry of the shard.
+    """
+    filename = os.path.join(export_dir, shard_filename)
+    count = 0
+    try:
+        with open(filename, 'wb') as shard_fh, gzip.GzipFile(
+                filename='', mode='wb', fileobj=shard_fh,
+                compresslevel=compresslevel, mtime=0) as gzip_fh:
+            for my_geneset in iter(documents.get, None):
+                gzip_fh.write(json.dumps(my_geneset).encode('utf-8') + b'\n')
+                count += 1
+    except BaseException:
+        # Keep consuming, so that `export_genesets()` is never blocked
+        for _ in iter(documents.get, None):
+            pass
+        raise
+
+    return {
+        'filename': shard_filename,
+        'documents': count,
+        'bytes': os.path.getsize(filename),
+        'sha256': file_digest(filename),
+    }
+
+
+def as_list(value):
+    """Return `value` as a list: [] for None, [value] for a single value."""
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def get_gene_rows(my_geneset):
+    """
+    Generate a flat row for each gene of a geneset document, for the
+    columnar export of `export_genesets()`. A duplicate that only refers to
+    its canonical geneset (see `iter_collapsed_genesets()`) has no genes,
+    so no rows.
+    """
+    for gene in as_list(my_geneset.get('genes')):
+        uniprot = gene.get('uniprot', {})
+        yield {
+            'geneset_id': my_geneset['_id'],
+            'doid': my_geneset['disease_ontology']['id'],
+            'source': gene['source'],
+            'mygene': gene.get('mygene'),
+            'ncbigene': gene.get('ncbigene'),
+            'symbol': gene.get('symbol'),
+            'ensemblgene': [
+                ensembl['gene'] for ensembl in as_list(gene.get('ensemblgene'))
+            ],
+            'swissprot': as_list(uniprot.get('Swiss-Prot')),
+            'trembl': as_list(uniprot.get('TrEMBL')),
+        }
+
+
+def export_genesets(genesets, export_dir, shards=EXPORT_SHARDS, parquet=False,
+                    compresslevel=6):
+    """
+    Write geneset documents as a bulk export, for indexers that load files
+    in parallel instead of documents one at a time.
+
+    Arguments:
+    genesets -- An iterable of geneset documents, e.g. `iter_genesets()`.
+
+    export_dir -- Directory of the export files.
+
+    shards -- Number of gzip-compressed NDJSON files. Documents are
+    assigned to shards by `get_shard()` of their ID, and written by one
+    thread per shard, in the order they are generated.
+
+    parquet -- If True, also write "genes.parquet", with one row per
+    geneset/gene pair (see `get_gene_rows()`). This needs PyArrow.
+
+    compresslevel -- gzip compression level of the shards.
+
+    Returns:
+    The manifest, also saved as `EXPORT_MANIFEST_FILENAME`, that lists the
+    document count, size and SHA-256 digest of each file.
+    """
+    if parquet and pyarrow is None:
+        raise ImportError('export_genesets(parquet=True) needs PyArrow')
+
+    os.makedirs(export_dir, exist_ok=True)
+    shard_queues = [queue.Queue(maxsize=1000) for _ in range(shards)]
+    gene_rows = []
+    with ThreadPoolExecutor(max_workers=shards) as executor:
+        futures = [
+            executor.submit(
+                write_geneset_shard, export_dir,
+                'genesets-%05d-of-%05d.ndjson.gz' % (shard, shards),
+                shard_queues[shard], compresslevel
+            )
+            for shard in range(shards)
+        ]
+        try:
+            for my_geneset in genesets:
+                shard_queues[get_shard(my_geneset['_id'], shards)].put(my_geneset)
+                if parquet:
+                    gene_rows.extend(get_gene_rows(my_geneset))
+        finally:
+            for shard_queue in shard_queues:
+                shard_queue.put(None)
+        shard_entries = [future.result() for future in futures]
+
+    manifest = {
+        'format': 'ndjson.gz',
+        'documents': sum(entry['documents'] for entry in shard_entries),
+        'shards': shard_entries,
+    }
+
+    if parquet:
+        parquet_filename = os.path.join(export_dir, 'genes.parquet')
+        columns = [
+            'geneset_id', 'doid', 'source', 'mygene', 'ncbigene', 'symbol',
+            'ensemblgene', 'swissprot', 'trembl',
+        ]
+        table = pyarrow.table({
+            column: [row[column] for row in gene_rows] for column in columns
+        })
+        pyarrow.parquet.write_table(table, parquet_filename, compression='zstd')
+        manifest['parquet'] = {
+            'filename': 'genes.parquet',
+            'rows': table.num_rows,
+            'bytes': os.path.getsize(parquet_filename),
+            'sha256': file_digest(parquet_filename),
+        }
+
+    manifest_filename = os.path.join(export_dir, EXPORT_MANIFEST_FILENAME)
+    with open(manifest_filename, 'w') as manifest_fh:
+        json.dump(manifest, manifest_fh, indent=2)
+    logging.info("Exported %d genesets in %d shards to %s",
+                 manifest['documents'], shards, export_dir)
+    return manifest
+
+
+def load_data_incremental(data_dir):
+    """
+    Generator for Biothings SDK that only yields the genesets added or
+    changed since the previous run, then a `{'_id': ..., '_deleted': True}`
+    document for each geneset that was deleted.
+    """
+
+    obo_filename = os.path.join(data_dir, "HumanDO.obo")
+    genemap_filename = os.path.join(data_dir, "genemap2.txt")
+    state_filename = os.path.join(
+        os.path.dirname(os.path.abspath(data_dir)), BUILD_STATE_FILENAME
+    )
+
+    for change, gs in iter_geneset_changes(
+            obo_filename, genemap_filename, state_filename,
+            **get_cache_options(data_dir)):
+        if change == 'deleted':
+            gs['_deleted'] = True
         yield gs
 
 
+def get_cache_options(data_dir):
+    """
+    Return the `gene_cache`, `snapshot_dir` and `gene_client` keyword
+    arguments of `iter_genesets()` for a data directory. Caches and NCBI
+    gene files are kept next to the data directory, so that they survive
+    across releases.
+    """
+    cache_dir = os.path.dirname(os.path.abspath(data_dir))
+
+    gene_cache = None
+    if MYGENE_CACHE_FILENAME:
+        cache_filename = os.path.join(cache_dir, MYGENE_CACHE_FILENAME)
+        gene_cache = MyGeneCache(cache_filename, offline=MYGENE_OFFLINE)
+
+    snapshot_dir = None
+    if SNAPSHOT_DIRNAME:
+        snapshot_dir = os.path.join(cache_dir, SNAPSHOT_DIRNAME)
+
+    gene_client = None
+    if NCBI_GENE_INFO_FILENAME:
+        gene_history_filename = None
+        if NCBI_GENE_HISTORY_FILENAME:
+            gene_history_filename = os.path.join(
+                cache_dir, NCBI_GENE_HISTORY_FILENAME)
+        gene_index = NCBIGeneIndex.load(
+            os.path.join(cache_dir, NCBI_GENE_INFO_FILENAME),
+            gene_history_filename
+        )
+        fallback = None if MYGENE_OFFLINE else MyGeneClient(url=MYGENE_URL)
+        gene_client = NCBIGeneClient(gene_index, fallback=fallback)
+
+    return {
+        'gene_cache': gene_cache,
+        'snapshot_dir': snapshot_dir,
+        'gene_client': gene_client,
+    }
+
+
+def build_release_chain(obo_filename, genemap_filenames, snapshot_dir=None):
+    """
+    Worker function of `iter_release_genesets()`, that prepares the
+    releases of an OBO file with each of `genemap_filenames` in turn.
+
+    The ontology is loaded once. The first genemap file is parsed and
+    propagated in full; for each following one, only the lines that
+    changed since the previous file are parsed, only the terms that
+    reference an affected MIM disease ID are annotated again, and only
+    them and their ancestors are re-propagated (see
+    `GO.propagate_changes()`). The genes of all other terms, whose
+    subgraph is unchanged, are reused from the previous release.
+
+    Work is only reused within a chain, i.e. between genemap files of the
+    same OBO file content: the first release of each OBO version is
+    annotated and propagated from scratch, even if most of its subgraphs
+    are the same as in the previous version.
+
+    Returns:
+    A list of the `term_labels` (see `iter_assembled_genesets()`) of each
+    release, and the `doid_omim_dict` of the OBO file.
+    """
+    disease_ontology, doid_omim_dict = load_disease_ontology(
+        obo_filename, snapshot_dir=snapshot_dir
+    )
+    disease_ontology.populated = True
+    omim_terms = dict()  # DO ID -> term, for the DO IDs of `doid_omim_dict`
+    for doid in doid_omim_dict:
+        term = disease_ontology.go_terms.get(
+            disease_ontology.alt_id2std_id.get(doid, doid))
+        if term is not None:
+            omim_terms[doid] = term
+
+    genemap_lines = None
+    propagated_genes = None  # term ID -> (gene IDs, cutoff gene IDs)
+    releases = []
+    for genemap_filename in genemap_filenames:
+        mim_diseases, genemap_lines, affected_mim_ids = update_mim_diseases_dict(
+            genemap_filename, genemap_lines
+        )
+        if propagated_genes is None:
+            entrez_set = add_term_annotations(
+                doid_omim_dict, disease_ontology, mim_diseases)
+            gene_index = GeneIndex(entrez_set)
+            disease_ontology.propagate_bitsets(gene_index)
+            propagated_genes = dict()
+            for term_id, term in disease_ontology.go_terms.items():
+                if term.gene_bits or term.cutoff_gene_bits:
+                    propagated_genes[term_id] = (
+                        gene_index.decode(term.gene_bits),
+                        gene_index.decode(term.cutoff_gene_bits)
+                    )
+        else:
+            logging.info("%d MIM disease IDs affected by %s",
+                         len(affected_mim_ids), genemap_filename)
+            changed_terms = set(
+                term for doid, term in omim_terms.items()
+                if not affected_mim_ids.isdisjoint(doid_omim_dict[doid])
+            )
+            for term in changed_terms:
+                term.annotations.clear()
+            add_term_annotations(
+                dict((doid, doid_omim_dict[doid])
+                     for doid, term in omim_terms.items() if term in changed_terms),
+                disease_ontology,
+                mim_diseases
+            )
+            for term, (gids, cutoff_gids) in disease_ontology.propagate_changes(
+                    changed_terms, propagated_genes).items():
+                if gids or cutoff_gids:
+                    propagated_genes[term.go_id] = (sorted(gids), sorted(cutoff_gids))
+                else:
+                    propagated_genes.pop(term.go_id, None)
+
+        # Same terms, in the same order, as in `iter_genesets()`
+        term_labels = dict()
+        for term_id, term in disease_ontology.go_terms.items():
+            if term_id in propagated_genes:
+                gids, cutoff_gids = propagated_genes[term_id]
+                term_labels[term_id] = get_term_labels(
+                    term, sorted(set(gids) | set(cutoff_gids)))
+        releases.append(term_labels)
+
+    return releases, doid_omim_dict
+
+
+def iter_release_genesets(releases, processes=BATCH_PROCESSES,
+                          gene_cache=None, snapshot_dir=None, gene_client=None):
+    """
+    Batch alternative to calling `iter_genesets()` on each release of a
+    list, that shares the work between releases.
+
+    Arguments:
+    releases -- A list of (OBO file, genemap file) pairs.
+
+    processes -- Number of worker processes that prepare the releases.
+
+    gene_cache -- Optional `MyGeneCache` used by `query_mygene()`.
+
+    snapshot_dir -- Optional directory of ontology snapshots. A temporary
+    one is used if it is not given.
+
+    gene_client -- Optional client used by `query_mygene()`.
+
+    Releases with the same OBO file content are prepared in up to
+    `processes` chains of consecutive releases (see
+    `build_release_chain()`), so that each distinct OBO file is parsed
+    only once, and each genemap file is parsed only for its lines that
+    are not in the previous release of its chain. Releases with the same
+    content as a previous one are only prepared once. Gene information of
+    all releases is then queried at once.
+
+    Identical subgraphs are not reused between different OBO versions:
+    only releases whose OBO files have the same content share parsing and
+    propagation, and each chain starts with a full propagation.
+
+    Generates:
+    A ((OBO file, genemap file), genesets) pair for each release, in the
+    order of `releases`, where `genesets` generates the same documents as
+    `iter_genesets()` on that release.
+    """
+    releases = [tuple(release) for release in releases]
+    if not releases:
+        return
+    digests = dict()
+    for filename in set(filename for release in releases for filename in release):
+        digests[filename] = file_digest(filename)
+
+    # Releases with distinct content, grouped by OBO file content
+    distinct_releases = dict()  # (OBO digest, genemap digest) -> release
+    obo_releases = dict()  # OBO digest -> distinct releases
+    for obo_filename, genemap_filename in releases:
+        key = (digests[obo_filename], digests[genemap_filename])
+        if key not in distinct_releases:
+            distinct_releases[key] = (obo_filename, genemap_filename)
+            obo_releases.setdefault(key[0], []).append(
+                (obo_filename, genemap_filename))
+    logging.info("%d releases, %d distinct, %d distinct OBO files",
+                 len(releases), len(distinct_releases), len(obo_releases))
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    chain_size = -(-len(distinct_releases) // max(processes, 1))
+    chains = []
+    for obo_group in obo_releases.values():
+        for start in range(0, len(obo_group), chain_size):
+            chains.append(obo_group[start:start + chain_size])
+    processes = min(processes, len(chains))
+
+    release_labels = dict()  # (OBO digest, genemap digest) -> term labels
+    doid_omim_dicts = dict()  # OBO digest -> doid_omim_dict
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Chains of the same OBO file load its snapshot, saved by the first
+        # one, instead of parsing it again.
+        snapshot_dir = snapshot_dir or tmp_dir
+        for obo_group in obo_releases.values():
+            if len(obo_group) > chain_size:
+                load_disease_ontology(obo_group[0][0], snapshot_dir=snapshot_dir)
+
+        tasks = [
+            (chain[0][0], [genemap_filename for _, genemap_filename in chain],
+             snapshot_dir)
+            for chain in chains
+        ]
+        if processes <= 1:
+            results = [build_release_chain(*task) for task in tasks]
+        else:
+            logging.info("Prepare %d releases in %d processes",
+                         len(distinct_releases), processes)
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                results = list(executor.map(build_release_chain, *zip(*tasks)))
+        for chain, (chain_labels, doid_omim_dict) in zip(chains, results):
+            obo_digest = digests[chain[0][0]]
+            doid_omim_dicts[obo_digest] = doid_omim_dict
+            for (_, genemap_filename), term_labels in zip(chain, chain_labels):
+                release_labels[(obo_digest, digests[genemap_filename])] = term_labels
+
+    entrez_set = set(
+        gid
+        for term_labels in release_labels.values()
+        for labels in term_labels.values()
+        for gid in labels[-1]
+    )
+    genes_info = query_mygene(
+        entrez_set, TAX_ID, cache=gene_cache, client=gene_client)
+
+    for obo_filename, genemap_filename in releases:
+        obo_digest = digests[obo_filename]
+        term_labels = release_labels[(obo_digest, digests[genemap_filename])]
+        yield (obo_filename, genemap_filename), iter_assembled_genesets(
+            term_labels, genes_info, doid_omim_dicts[obo_digest])
+
+
+def load_data_batch(data_dirs):
+    """
+    Batch version of `load_data()` for a list of data directories, e.g. to
+    backfill past releases. Generates a (data directory, genesets) pair for
+    each of them, where `genesets` generates its documents.
+    """
+
+    releases = [
+        (os.path.join(data_dir, "HumanDO.obo"),
+         os.path.join(data_dir, "genemap2.txt"))
+        for data_dir in data_dirs
+    ]
+    # Caches are kept next to the first data directory.
+    batch = iter_release_genesets(releases, **get_cache_options(data_dirs[0]))
+    for data_dir, (_, genesets) in zip(data_dirs, batch):
+        yield data_dir, genesets
+
+
 # Test harness
 if __name__ == "__main__":
     data_dir = "./data/latest"
-    genesets = list(load_data(data_dir))
-    for gs in genesets:
+
+    # With an export directory argument, write a bulk export instead
+    if len(sys.argv) > 1:
+        manifest = export_genesets(load_data(data_dir), sys.argv[1])
+        print(json.dumps(manifest, indent=2))
+        sys.exit()
+
+    gs_count = 0
+    for gs in load_data(data_dir):
         print(json.dumps(gs, indent=2))
+        gs_count += 1
 
-    print("\nTotal number of gs:", len(genesets))
+    print("\nTotal number of gs:", gs_count)
 
     # 2020-12-26:
     #   - 2,959 unique Entrez gene IDs to query
@@ -2,12 +2,90 @@
 
 """This script include a few simple tests for local use only."""
 
+import bz2
+import gzip
 import json
+import lzma
 import os
+import tempfile
+import threading
 import unittest
-from parser import get_genesets
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+import parser
+from parser import (
+    DOTerm,
+    GOTerm,
+    MyGeneCache,
+    MyGeneClient,
+    PipelineMetrics,
+    TermIndex,
+    create_gene_record,
+    create_geneset,
+    export_genesets,
+    find_duplicate_genesets,
+    find_near_duplicates,
+    get_gene_rows,
+    get_genesets,
+    iter_assembled_genesets,
+    iter_collapsed_genesets,
+    iter_release_genesets,
+    build_mim_diseases_dict,
+    build_mim_gene_table,
+    load_disease_ontology,
+    query_mygene,
+    update_mim_diseases_dict,
+)
+from version import get_release
+import dumper
+from dumper import SourceDownloader, get_release_string
+from benchmarks import (
+    fake_mygene_hit,
+    generate_genemap,
+    generate_obo,
+    legacy_create_geneset,
+    legacy_build_mim_diseases_dict,
+    legacy_propagate,
+    load_annotated_ontology,
+    propagate_bitsets,
+    propagate_sparse,
+    propagated_annotations,
+    propagated_genes,
+)
+
+SNAPSHOT_OBO = "./data/snapshot-for-test/2020-12-22.HumanDO.obo"
+SNAPSHOT_GENEMAP = "./data/snapshot-for-test/2020-12-23.genemap2.txt"
+
+# The 2020-12-22 HumanDO.obo snapshot is not in the repository, so tests
+# that need an OBO file run on synthetic HumanDO.obo and genemap2.txt files
+# (see `generate_obo()` in benchmarks.py), generated once per test run.
+TEST_TERMS = 3000
+TEST_OBO = None
+TEST_GENEMAP = None
+test_data_dir = None
+
+# Geneset documents built by `test_geneset_documents()`, dated GOLDEN_DATE
+GOLDEN_GENESETS = "./data/snapshot-for-test/golden_genesets.ndjson"
+GOLDEN_DATE = "2020-12-23"
+
+
+def setUpModule():
+    global TEST_OBO, TEST_GENEMAP, test_data_dir
+    test_data_dir = tempfile.TemporaryDirectory()
+    TEST_OBO = os.path.join(test_data_dir.name, "HumanDO.obo")
+    TEST_GENEMAP = os.path.join(test_data_dir.name, "genemap2.txt")
+    omim_ids = generate_obo(TEST_OBO, TEST_TERMS)
+    generate_genemap(TEST_GENEMAP, omim_ids)
+
+
+def tearDownModule():
+    test_data_dir.cleanup()
+
 
 class TestResult(unittest.TestCase):
+    @unittest.skipUnless(os.path.exists(SNAPSHOT_OBO), "Snapshot OBO file not found")
     def test_snapshot(self):
         """20 seconds to run this test."""
 
@@ -50,6 +128,848 @@ class TestResult(unittest.TestCase):
             'A congenital heart disease characterized by abnormal development of the left-sided structures of the heart. Annotations from child terms in the disease ontology are propagated through transitive closure. Annotations directly to this term are provided by the OMIM disease IDs 241550 and 614435.'
         )
 
+    def test_propagation(self):
+        """Topological propagation must match the old recursive one."""
+
+        legacy_do = load_annotated_ontology(
+            TEST_OBO, TEST_GENEMAP, GOTerm)
+        legacy_propagate(legacy_do)
+
+        disease_ontology = load_annotated_ontology(
+            TEST_OBO, TEST_GENEMAP, GOTerm)
+        disease_ontology.propagate()
+
+        self.assertEqual(
+            propagated_annotations(disease_ontology),
+            propagated_annotations(legacy_do)
+        )
+
+    def test_term_classes(self):
+        """Compact terms must propagate the same annotations."""
+
+        go_do = load_annotated_ontology(TEST_OBO, TEST_GENEMAP, GOTerm)
+        go_do.propagate()
+
+        disease_ontology = load_annotated_ontology(TEST_OBO, TEST_GENEMAP)
+        disease_ontology.propagate()
+
+        self.assertIsInstance(disease_ontology.heads[0], DOTerm)
+        self.assertEqual(list(disease_ontology.go_terms), list(go_do.go_terms))
+        for term_id, term in go_do.go_terms.items():
+            self.assertEqual(
+                {(a.gid, a.ready_regulates_cutoff)
+                 for a in disease_ontology.go_terms[term_id].annotations},
+                {(a.gid, a.ready_regulates_cutoff) for a in term.annotations}
+            )
+
+    def test_propagation_bitsets(self):
+        """Bitset propagation must yield the same genes per term."""
+
+        disease_ontology = load_annotated_ontology(TEST_OBO, TEST_GENEMAP)
+        disease_ontology.propagate()
+
+        compact_do = load_annotated_ontology(TEST_OBO, TEST_GENEMAP)
+        gene_index = propagate_bitsets(compact_do)
+
+        self.assertEqual(
+            propagated_genes(compact_do, gene_index),
+            propagated_genes(disease_ontology)
+        )
+
+    def test_term_index(self):
+        """Index queries must match walks of the term graph."""
+
+        disease_ontology = load_annotated_ontology(TEST_OBO, TEST_GENEMAP)
+        gene_index = propagate_bitsets(disease_ontology)
+        term_index = TermIndex(disease_ontology)
+        term_index.index_genes(disease_ontology, gene_index)
+        genes = propagated_genes(disease_ontology, gene_index)
+
+        def walk(term, links):
+            found = set()
+            pending = list(getattr(term, links))
+            while pending:
+                other_term = pending.pop()
+                if other_term.go_id not in found:
+                    found.add(other_term.go_id)
+                    pending.extend(getattr(other_term, links))
+            return found
+
+        self.assertEqual(len(term_index), len(disease_ontology.go_terms))
+        for term_id, term in disease_ontology.go_terms.items():
+            ancestors = walk(term, 'child_of')
+            self.assertEqual(set(term_index.ancestors(term_id)), ancestors)
+            self.assertEqual(
+                set(term_index.descendants(term_id)), walk(term, 'parent_of'))
+            for gid in genes[term_id]:
+                self.assertIn(term_id, term_index.terms_with_gene(gid))
+
+        for term_id, term in list(disease_ontology.go_terms.items())[::50]:
+            for other_id, other_term in list(disease_ontology.go_terms.items())[::70]:
+                common = (walk(term, 'child_of') | {term_id}) & \
+                    (walk(other_term, 'child_of') | {other_id})
+                lowest = {
+                    common_id for common_id in common
+                    if not any(term_index.is_ancestor(common_id, other)
+                               for other in common)
+                }
+                self.assertEqual(
+                    set(term_index.lowest_common_ancestors(term_id, other_id)),
+                    lowest
+                )
+
+    @unittest.skipIf(parser.sparse is None, "NumPy and SciPy are not installed")
+    def test_propagation_sparse(self):
+        """Sparse matrix propagation must yield the same genes per term."""
+
+        disease_ontology = load_annotated_ontology(TEST_OBO, TEST_GENEMAP)
+        disease_ontology.propagate()
+
+        sparse_do = load_annotated_ontology(TEST_OBO, TEST_GENEMAP)
+        self.assertEqual(
+            propagate_sparse(sparse_do),
+            propagated_genes(disease_ontology)
+        )
+
+    def test_genemap(self):
+        """Both genemap parsers must match the old one."""
+
+        legacy_diseases = legacy_build_mim_diseases_dict(SNAPSHOT_GENEMAP)
+        mim_diseases = build_mim_diseases_dict(SNAPSHOT_GENEMAP)
+        mim_table = build_mim_gene_table(SNAPSHOT_GENEMAP)
+
+        self.assertEqual(list(mim_diseases), list(legacy_diseases))
+        for mim_id, legacy_disease in legacy_diseases.items():
+            self.assertEqual(mim_diseases[mim_id].genes, legacy_disease.genes)
+            self.assertEqual(mim_table[mim_id].genes, legacy_disease.genes)
+        self.assertEqual(len(mim_table), len(legacy_diseases))
+
+    def test_genemap_update(self):
+        """The diff-aware genemap parser must match a full parse."""
+
+        with open(SNAPSHOT_GENEMAP) as genemap_fh:
+            lines = genemap_fh.readlines()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            old_genemap = os.path.join(tmp_dir, "genemap2.txt")
+            with open(old_genemap, "w") as genemap_fh:
+                genemap_fh.writelines(lines[::3] + lines[1::3])
+            old_diseases = build_mim_diseases_dict(old_genemap)
+            _, genemap_lines, _ = update_mim_diseases_dict(old_genemap)
+
+        mim_diseases = build_mim_diseases_dict(SNAPSHOT_GENEMAP)
+        updated_diseases, _, affected_mim_ids = update_mim_diseases_dict(
+            SNAPSHOT_GENEMAP, genemap_lines)
+
+        self.assertEqual(set(updated_diseases), set(mim_diseases))
+        for mim_id, mim_disease in mim_diseases.items():
+            self.assertEqual(
+                sorted(updated_diseases[mim_id].genes),
+                sorted(mim_disease.genes)
+            )
+        self.assertEqual(affected_mim_ids, {
+            mim_id for mim_id in set(mim_diseases) | set(old_diseases)
+            if mim_id not in old_diseases or mim_id not in mim_diseases
+            or set(old_diseases[mim_id].genes) != set(mim_diseases[mim_id].genes)
+        })
+
+    def test_propagate_changes(self):
+        """Re-propagating changed terms must match a full propagation."""
+
+        with open(TEST_GENEMAP) as genemap_fh:
+            lines = genemap_fh.readlines()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            old_genemap = os.path.join(tmp_dir, "genemap2.txt")
+            with open(old_genemap, "w") as genemap_fh:
+                genemap_fh.writelines(lines[::2])
+            old_do = load_annotated_ontology(TEST_OBO, old_genemap)
+        old_index = propagate_bitsets(old_do)
+        previous_genes = {
+            term_id: (old_index.decode(term.gene_bits),
+                      old_index.decode(term.cutoff_gene_bits))
+            for term_id, term in old_do.go_terms.items()
+        }
+
+        disease_ontology = load_annotated_ontology(TEST_OBO, TEST_GENEMAP)
+        changed_terms = [
+            term for term_id, term in disease_ontology.go_terms.items()
+            if term.annotations != old_do.go_terms[term_id].annotations
+        ]
+        self.assertTrue(changed_terms)
+        genes = disease_ontology.propagate_changes(changed_terms, previous_genes)
+        for term, (gids, cutoff_gids) in genes.items():
+            previous_genes[term.go_id] = (sorted(gids), sorted(cutoff_gids))
+
+        new_do = load_annotated_ontology(TEST_OBO, TEST_GENEMAP)
+        new_index = propagate_bitsets(new_do)
+        for term_id, term in new_do.go_terms.items():
+            self.assertEqual(
+                previous_genes[term_id],
+                (new_index.decode(term.gene_bits),
+                 new_index.decode(term.cutoff_gene_bits)),
+                term_id
+            )
+
+    def test_compressed_inputs(self):
+        """Compressed inputs are parsed like uncompressed ones."""
+
+        compressors = [('gz', gzip.compress), ('bz2', bz2.compress),
+                       ('xz', lzma.compress)]
+        if parser.zstandard is not None:
+            compressors.append(
+                ('zst', parser.zstandard.ZstdCompressor().compress))
+
+        mim_diseases = build_mim_diseases_dict(TEST_GENEMAP)
+        disease_ontology, doid_omim_dict = load_disease_ontology(TEST_OBO)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for suffix, compress in compressors:
+                filenames = []
+                for filename in (TEST_GENEMAP, TEST_OBO):
+                    filenames.append(os.path.join(
+                        tmp_dir, os.path.basename(filename) + '.' + suffix))
+                    with open(filename, 'rb') as input_fh, \
+                            open(filenames[-1], 'wb') as output_fh:
+                        output_fh.write(compress(input_fh.read()))
+
+                self.assertEqual(
+                    {mim: disease.genes for mim, disease in
+                     build_mim_diseases_dict(filenames[0]).items()},
+                    {mim: disease.genes for mim, disease in mim_diseases.items()}
+                )
+                compressed_do, compressed_xrefs = load_disease_ontology(filenames[1])
+                self.assertEqual(compressed_xrefs, doid_omim_dict)
+                self.assertEqual(list(compressed_do.go_terms),
+                                 list(disease_ontology.go_terms))
+
+    def test_geneset_documents(self):
+        """Documents must match the golden ones, byte for byte."""
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            obo_filename = os.path.join(tmp_dir, "HumanDO.obo")
+            genemap_filename = os.path.join(tmp_dir, "genemap2.txt")
+            omim_ids = generate_obo(obo_filename, n_terms=30, depth=4)
+            generate_genemap(genemap_filename, omim_ids, n_genes=20)
+            disease_ontology = load_annotated_ontology(
+                obo_filename, genemap_filename)
+
+        gene_index = propagate_bitsets(disease_ontology)
+        doid_omim_dict = disease_ontology.omim_xrefs
+        hits = {str(gid): fake_mygene_hit(gid) for gid in gene_index.gids}
+        genes_info = {
+            q_str: create_gene_record(q_str, hit) for q_str, hit in hits.items()
+        }
+
+        lines = []
+        for term_id, term in disease_ontology.go_terms.items():
+            gid_list = gene_index.decode(term.gene_bits | term.cutoff_gene_bits)
+            if not gid_list:
+                continue
+            my_geneset = create_geneset(
+                term_id, term, gid_list, genes_info, doid_omim_dict)
+            legacy_geneset = legacy_create_geneset(
+                term_id, term, gid_list, hits, doid_omim_dict)
+            my_geneset['date'] = legacy_geneset['date'] = GOLDEN_DATE
+            self.assertEqual(json.dumps(my_geneset), json.dumps(legacy_geneset))
+            lines.append(json.dumps(my_geneset) + '\n')
+
+        with open(GOLDEN_GENESETS) as golden_fh:
+            self.assertEqual(''.join(lines), golden_fh.read())
+
+    def test_assembly_processes(self):
+        """Genesets assembled by worker processes must keep their order."""
+
+        term_labels = {
+            "DOID:%d" % idx: ("term %d" % idx, "term %d" % idx,
+                              "Term number %d." % idx, [idx, idx + 1])
+            for idx in range(1, 50)
+        }
+        genes_info = {
+            str(gid): {'source': str(gid), 'symbol': None}
+            for gid in range(1, 51)
+        }
+        doid_omim_dict = {"DOID:7": {"100100", "100050"}}
+
+        serial = list(iter_assembled_genesets(
+            term_labels, genes_info, doid_omim_dict, processes=1))
+        parallel = list(iter_assembled_genesets(
+            term_labels, genes_info, doid_omim_dict,
+            processes=2, chunk_size=10))
+        self.assertEqual(parallel, serial)
+        self.assertEqual(
+            [gs['_id'] for gs in serial],
+            ["DO-%d:term %d" % (idx, idx) for idx in range(1, 50)]
+        )
+
+    def test_export(self):
+        """Exports are sharded by ID, complete and reproducible."""
+
+        term_labels = {
+            "DOID:%d" % idx: ("term %d" % idx, "term %d" % idx,
+                              "Term number %d." % idx, [idx, idx + 1][:idx % 2 + 1])
+            for idx in range(1, 50)
+        }
+        genes_info = {
+            str(gid): create_gene_record(str(gid), fake_mygene_hit(gid))
+            for gid in range(1, 51)
+        }
+        genesets = list(iter_assembled_genesets(
+            term_labels, genes_info, {}, processes=1))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifests = [
+                export_genesets(genesets, os.path.join(tmp_dir, name), shards=3)
+                for name in ("a", "b")
+            ]
+            self.assertEqual(manifests[0], manifests[1])
+            self.assertEqual(manifests[0]['documents'], len(genesets))
+
+            exported = []
+            for entry in manifests[0]['shards']:
+                shard_filename = os.path.join(tmp_dir, "a", entry['filename'])
+                with gzip.open(shard_filename, 'rt') as shard_fh:
+                    shard_genesets = [json.loads(line) for line in shard_fh]
+                self.assertEqual(len(shard_genesets), entry['documents'])
+                exported.extend(shard_genesets)
+            self.assertEqual(
+                sorted(exported, key=lambda gs: gs['_id']),
+                sorted(genesets, key=lambda gs: gs['_id'])
+            )
+
+    @unittest.skipIf(parser.np is None, "NumPy is not installed")
+    def test_dedup(self):
+        """Duplicates are referenced, and near-duplicates annotated."""
+
+        gene_sets = {
+            "DOID:1": list(range(1, 21)),
+            "DOID:2": list(range(1, 21)),   # Duplicate of DOID:1
+            "DOID:3": list(range(2, 22)),   # Jaccard 19 / 21 with DOID:1
+            "DOID:4": list(range(100, 120)),
+            "DOID:5": list(range(1, 21)),   # Duplicate of DOID:1
+            "DOID:6": [7],
+        }
+        term_labels = {
+            term_id: ("term " + term_id, "term " + term_id, "", gids)
+            for term_id, gids in gene_sets.items()
+        }
+        duplicates = find_duplicate_genesets(term_labels)
+        self.assertEqual(duplicates, {"DOID:2": "DOID:1", "DOID:5": "DOID:1"})
+
+        canonical_labels = {
+            term_id: labels for term_id, labels in term_labels.items()
+            if term_id not in duplicates
+        }
+        near_duplicates = find_near_duplicates(canonical_labels, 0.8)
+        self.assertEqual(set(near_duplicates), {"DOID:1", "DOID:3"})
+        self.assertAlmostEqual(near_duplicates["DOID:1"][0][1], 19 / 21)
+
+        genes_info = {
+            str(gid): create_gene_record(str(gid), fake_mygene_hit(gid))
+            for gid in range(1, 120)
+        }
+        genesets = list(iter_assembled_genesets(
+            term_labels, genes_info, {}, processes=1))
+        gs_ids = {gs['disease_ontology']['id']: gs['_id'] for gs in genesets}
+        collapsed = {
+            gs['disease_ontology']['id']: gs for gs in iter_collapsed_genesets(
+                [dict(gs) for gs in genesets], gs_ids, duplicates,
+                near_duplicates, reference=True)
+        }
+        self.assertEqual(collapsed["DOID:1"]['duplicates'],
+                         [gs_ids["DOID:2"], gs_ids["DOID:5"]])
+        self.assertEqual(collapsed["DOID:1"]['near_duplicates'],
+                         [{'_id': gs_ids["DOID:3"], 'jaccard': 0.9048}])
+        self.assertNotIn('genes', collapsed["DOID:2"])
+        self.assertEqual(collapsed["DOID:2"]['duplicate_of'], gs_ids["DOID:1"])
+        self.assertEqual(collapsed["DOID:4"], genesets[3])
+        self.assertLess(len(json.dumps(list(collapsed.values()))),
+                        len(json.dumps(genesets)))
+
+    def test_gene_rows(self):
+        """Columnar rows are flat, and collapsed duplicates have none."""
+
+        term_labels = {
+            "DOID:1": ("term 1", "term 1", "", [1, 2, 3]),
+            "DOID:2": ("term 2", "term 2", "", [1, 2, 3]),
+            "DOID:3": ("term 3", "term 3", "", [4]),
+        }
+        genes_info = {
+            str(gid): create_gene_record(str(gid), fake_mygene_hit(gid))
+            for gid in range(1, 5)
+        }
+        genesets = list(iter_assembled_genesets(
+            term_labels, genes_info, {}, processes=1))
+        gs_ids = {gs['disease_ontology']['id']: gs['_id'] for gs in genesets}
+        genesets = list(iter_collapsed_genesets(
+            genesets, gs_ids, find_duplicate_genesets(term_labels),
+            reference=True))
+
+        rows = [list(get_gene_rows(gs)) for gs in genesets]
+        self.assertEqual([len(gene_rows) for gene_rows in rows], [3, 0, 1])
+        self.assertEqual(rows[0][0], {
+            'geneset_id': gs_ids["DOID:1"], 'doid': "DOID:1", 'source': '1',
+            'mygene': '1', 'ncbigene': 1, 'symbol': 'GENE1',
+            'ensemblgene': ['ENSG1'], 'swissprot': ['P1'], 'trembl': ['Q1'],
+        })
+        self.assertEqual(rows[0][2]['ensemblgene'], ['ENSG3', 'ENSGB3'])
+        self.assertEqual(rows[2][0]['swissprot'], [])
+
+    @unittest.skipIf(parser.pyarrow is None, "PyArrow is not installed")
+    def test_export_parquet(self):
+        """The columnar export has one row per geneset/gene pair."""
+
+        disease_ontology = load_annotated_ontology(TEST_OBO, TEST_GENEMAP)
+        gene_index = propagate_bitsets(disease_ontology)
+        genes_info = {
+            str(gid): create_gene_record(str(gid), fake_mygene_hit(gid))
+            for gid in gene_index.gids
+        }
+        genesets = []
+        for term_id, term in disease_ontology.go_terms.items():
+            gid_list = gene_index.decode(term.gene_bits | term.cutoff_gene_bits)
+            if gid_list:
+                genesets.append(create_geneset(
+                    term_id, term, gid_list, genes_info, {}))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest = export_genesets(genesets, tmp_dir, parquet=True)
+            table = parser.pyarrow.parquet.read_table(
+                os.path.join(tmp_dir, manifest['parquet']['filename']))
+        self.assertEqual(table.num_rows, sum(
+            len(gs['genes']) if isinstance(gs['genes'], list) else 1
+            for gs in genesets
+        ))
+
+    def test_ontology_snapshot(self):
+        """An ontology loaded from its snapshot must match the parsed one."""
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            parsed_do, parsed_xrefs = load_disease_ontology(
+                TEST_OBO, snapshot_dir=tmp_dir)
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+            loaded_do, loaded_xrefs = load_disease_ontology(
+                TEST_OBO, snapshot_dir=tmp_dir)
+
+            # A missing OBO file must not yield an empty ontology
+            with self.assertRaises(IOError):
+                load_disease_ontology(
+                    os.path.join(tmp_dir, "HumanDO.obo"), snapshot_dir=tmp_dir)
+
+        self.assertIsNot(loaded_do, parsed_do)
+        self.assertEqual(loaded_xrefs, parsed_xrefs)
+        self.assertEqual(loaded_do.alt_id2std_id, parsed_do.alt_id2std_id)
+        self.assertEqual(
+            [term.go_id for term in loaded_do.heads],
+            [term.go_id for term in parsed_do.heads]
+        )
+        self.assertEqual(list(loaded_do.go_terms), list(parsed_do.go_terms))
+        for term_id, term in parsed_do.go_terms.items():
+            loaded_term = loaded_do.go_terms[term_id]
+            self.assertEqual(loaded_term.full_name, term.full_name)
+            self.assertEqual(loaded_term.description, term.description)
+            self.assertEqual(
+                sorted(child.go_id for child in loaded_term.parent_of),
+                sorted(child.go_id for child in term.parent_of)
+            )
+            self.assertEqual(
+                [parent.go_id for parent in loaded_term.is_a],
+                [parent.go_id for parent in term.is_a]
+            )
+
+
+class TestMetrics(unittest.TestCase):
+    def test_stages(self):
+        metrics = PipelineMetrics(profile=True, trace_memory=True)
+        with metrics.stage('build'):
+            items = [str(idx) for idx in range(10000)]
+        metrics.count('build', items=len(items))
+        consumed = list(metrics.iterate('consume', items, 'strings'))
+        metrics.close()
+
+        self.assertEqual(consumed, items)
+        report = metrics.report()
+        self.assertEqual(list(report), ['build', 'consume'])
+        self.assertEqual(report['build']['counts'], {'items': 10000})
+        self.assertEqual(report['consume']['counts'], {'strings': 10000})
+        for stage in report.values():
+            self.assertGreater(stage['wall_time'], 0)
+            self.assertGreaterEqual(stage['cpu_time'], 0)
+            self.assertGreater(stage['traced_memory_peak'], 0)
+            self.assertTrue(stage['profile'])
+            self.assertNotIn('memory_overlap', stage)
+
+        # Memory of overlapping stages is flagged, as it can not be split
+        with metrics.stage('propagate'):
+            metrics.call('query_mygene', lambda: None)
+        metrics.close()
+        report = metrics.report()
+        self.assertTrue(report['propagate']['memory_overlap'])
+        self.assertTrue(report['query_mygene']['memory_overlap'])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_filename = os.path.join(tmp_dir, 'metrics.json')
+            metrics.save(report_filename)
+            with open(report_filename) as report_fh:
+                self.assertEqual(json.load(report_fh), report)
+
+
+class MockMyGeneHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the `/query` endpoint of MyGene.info."""
+
+    queries = []  # All query terms received by the server
+    failures = 0  # Number of upcoming requests to fail with HTTP 500
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        params = parse_qs(self.rfile.read(length).decode())
+        if MockMyGeneHandler.failures > 0:
+            MockMyGeneHandler.failures -= 1
+            self.send_error(500)
+            return
+
+        terms = [term.strip('"') for term in params['q'][0].split(',')]
+        self.queries.extend(terms)
+
+        hits = [
+            {'query': term, '_id': term, 'entrezgene': int(term), 'symbol': 'GENE' + term}
+            for term in terms
+        ]
+        body = json.dumps(hits).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMyGene(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), MockMyGeneHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.mygene_url = parser.MYGENE_URL
+        parser.MYGENE_URL = 'http://127.0.0.1:%d/v3' % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        parser.MYGENE_URL = cls.mygene_url
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        MockMyGeneHandler.queries.clear()
+        MockMyGeneHandler.failures = 0
+
+    def test_client(self):
+        """Genes are queried in concurrent batches, with retries."""
+
+        client = MyGeneClient(
+            url=parser.MYGENE_URL, batch_size=2, concurrency=2, backoff=0
+        )
+        MockMyGeneHandler.failures = 1
+        genes_info = query_mygene({1, 2, 3, 4, 5}, 9606, client=client)
+
+        self.assertEqual(sorted(genes_info), ['1', '2', '3', '4', '5'])
+        self.assertEqual(genes_info['3']['ncbigene'], 3)
+        self.assertEqual(len(client.timings), 3)
+        self.assertEqual(sum(t['attempts'] for t in client.timings), 4)
+
+        # Failed batches are raised after all others are done
+        client.retries = 0
+        MockMyGeneHandler.failures = 1
+        with self.assertRaises(Exception):
+            client.querymany(['1', '2', '3'], scopes='entrezgene')
+
+    def test_cache(self):
+        """Only genes missing from the cache are queried."""
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = MyGeneCache(os.path.join(tmp_dir, 'cache.sqlite'))
+
+            genes_info = query_mygene({1017, 7157}, 9606, cache=cache)
+            self.assertEqual(sorted(MockMyGeneHandler.queries), ['1017', '7157'])
+            self.assertEqual(genes_info['7157']['symbol'], 'GENE7157')
+
+            MockMyGeneHandler.queries.clear()
+            cached_info = query_mygene({1017, 7157, 672}, 9606, cache=cache)
+            self.assertEqual(MockMyGeneHandler.queries, ['672'])
+            self.assertEqual(cached_info['7157'], genes_info['7157'])
+
+            # Expired entries are queried again
+            MockMyGeneHandler.queries.clear()
+            cache.ttl = -1
+            query_mygene({672}, 9606, cache=cache)
+            self.assertEqual(MockMyGeneHandler.queries, ['672'])
+
+            # Offline mode serves expired entries, but can not query misses
+            MockMyGeneHandler.queries.clear()
+            offline_cache = MyGeneCache(cache.filename, ttl=-1, offline=True)
+            offline_info = query_mygene({1017, 7157, 672}, 9606, cache=offline_cache)
+            self.assertEqual(MockMyGeneHandler.queries, [])
+            self.assertEqual(len(offline_info), 3)
+            with self.assertRaises(LookupError):
+                query_mygene({1017, 3845}, 9606, cache=offline_cache)
+
+    def test_ncbi_client(self):
+        """Genes are resolved offline, and misses are queried from MyGene.info."""
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gene_info_filename = os.path.join(tmp_dir, 'gene_info')
+            with open(gene_info_filename, 'w') as gene_info_fh:
+                gene_info_fh.write('#tax_id\tGeneID\tSymbol\tLocusTag\tSynonyms\tdbXrefs\n')
+                gene_info_fh.write('10090\t7\tMOUSE7\t-\t-\t-\n')
+                for gid in (7, 1017, 20, 25):
+                    xrefs = 'MIM:1|Ensembl:ENSG%d' % gid if gid == 25 else '-'
+                    gene_info_fh.write('9606\t%d\tGENE%d\t-\t-\t%s\n' % (gid, gid, xrefs))
+            gene_history_filename = os.path.join(tmp_dir, 'gene_history')
+            with open(gene_history_filename, 'w') as history_fh:
+                history_fh.write('#tax_id\tGeneID\tDiscontinued_GeneID\n')
+                history_fh.write('9606\t15\t10\tOLD10\t20200101\n')
+                history_fh.write('9606\t20\t15\tOLD15\t20210101\n')
+                history_fh.write('9606\t-\t30\tOLD30\t20210101\n')
+
+            with parser.NCBIGeneIndex.load(
+                    gene_info_filename, gene_history_filename) as index:
+                client = parser.NCBIGeneClient(index)
+                genes_info = query_mygene({7, 1017, 10, 25, 30, 40}, 9606, client=client)
+                self.assertEqual(MockMyGeneHandler.queries, [])
+                self.assertEqual(genes_info['7'], {
+                    'source': '7', 'mygene': '7', 'ncbigene': 7, 'symbol': 'GENE7'})
+                self.assertEqual(genes_info['10']['ncbigene'], 20)
+                self.assertEqual(genes_info['25']['ensemblgene'], {'gene': 'ENSG25'})
+                self.assertEqual(genes_info['30'], {'source': '30'})
+                self.assertEqual(genes_info['40'], {'source': '40'})
+
+                client.fallback = MyGeneClient(url=parser.MYGENE_URL)
+                genes_info = query_mygene({1017, 40}, 9606, client=client)
+                self.assertEqual(MockMyGeneHandler.queries, ['40'])
+                self.assertEqual(genes_info['40']['symbol'], 'GENE40')
+
+            # The index is reused, and rebuilt when a file changes
+            index_mtime = os.stat(gene_info_filename + '.index').st_mtime_ns
+            parser.NCBIGeneIndex.load(gene_info_filename, gene_history_filename).close()
+            self.assertEqual(
+                os.stat(gene_info_filename + '.index').st_mtime_ns, index_mtime)
+            with open(gene_info_filename, 'a') as gene_info_fh:
+                gene_info_fh.write('9606\t40\tGENE40\t-\t-\t-\n')
+            with parser.NCBIGeneIndex.load(gene_info_filename) as index:
+                self.assertEqual(index.resolve(40), 40)
+                self.assertIsNone(index.resolve(10))
+
+    def test_release_batch(self):
+        """Batch releases must match separate builds, with one gene query."""
+
+        with open(TEST_GENEMAP) as genemap_fh:
+            lines = genemap_fh.readlines()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            old_genemap = os.path.join(tmp_dir, "genemap2.txt")
+            with open(old_genemap, "w") as genemap_fh:
+                genemap_fh.writelines(lines[::2])
+            releases = [
+                (TEST_OBO, old_genemap),
+                (TEST_OBO, TEST_GENEMAP),
+                (TEST_OBO, old_genemap),
+            ]
+            batch = [
+                (release, list(genesets)) for release, genesets in
+                iter_release_genesets(releases, processes=2)
+            ]
+            self.assertEqual(len(MockMyGeneHandler.queries),
+                             len(set(MockMyGeneHandler.queries)))
+
+            self.assertEqual([release for release, _ in batch], releases)
+            for release, genesets in batch:
+                self.assertEqual(genesets, get_genesets(*release))
+            self.assertNotEqual(batch[0][1], batch[1][1])
+
+
+    def test_incremental(self):
+        """Deltas of incremental builds must match full rebuilds."""
+
+        with open(TEST_GENEMAP) as genemap_fh:
+            lines = genemap_fh.readlines()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_dir = os.path.join(tmp_dir, "latest")
+            os.mkdir(data_dir)
+            with open(TEST_OBO) as obo_fh, \
+                    open(os.path.join(data_dir, "HumanDO.obo"), "w") as data_fh:
+                data_fh.write(obo_fh.read())
+
+            genesets = {}  # geneset ID -> document, as uploaded
+            builds = []  # Counts of added, changed and deleted genesets
+            for genemap_lines in (lines[::2], lines, lines[::2], lines[::2]):
+                genemap_filename = os.path.join(data_dir, "genemap2.txt")
+                with open(genemap_filename, "w") as genemap_fh:
+                    genemap_fh.writelines(genemap_lines)
+                expected = {
+                    gs['_id']: gs for gs in
+                    get_genesets(os.path.join(data_dir, "HumanDO.obo"),
+                                 genemap_filename)
+                }
+
+                counts = {'added': 0, 'changed': 0, 'deleted': 0}
+                for gs in parser.load_data_incremental(data_dir):
+                    if gs.get('_deleted'):
+                        self.assertEqual(gs, {'_id': gs['_id'], '_deleted': True})
+                        del genesets[gs['_id']]
+                        counts['deleted'] += 1
+                    else:
+                        self.assertNotEqual(genesets.get(gs['_id']), gs)
+                        counts['changed' if gs['_id'] in genesets else 'added'] += 1
+                        genesets[gs['_id']] = gs
+                self.assertEqual(genesets, expected)
+                builds.append(counts)
+
+            self.assertTrue(os.path.exists(
+                os.path.join(tmp_dir, parser.BUILD_STATE_FILENAME)))
+
+        self.assertTrue(builds[1]['added'] and builds[1]['changed'])
+        self.assertTrue(builds[2]['deleted'] and builds[2]['changed'])
+        # The saved state is reloaded: nothing changed
+        self.assertEqual(builds[3], {'added': 0, 'changed': 0, 'deleted': 0})
+
+
+class MockReleaseHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the download URLs of the data files."""
+
+    files = {
+        '/HumanDO.obo': (
+            'format-version: 1.2\n'
+            'data-version: doid/releases/2021-12-15/doid-non-classified.obo\n'
+            '\n[Term]\nid: DOID:4\n' + 'xref: OMIM:100100\n' * 10000
+        ).encode(),
+        '/genemap2.txt': (
+            '# Copyright (c) 1966-2021 Johns Hopkins University.\n'
+            '# Generated: 2021-12-19\n'
+            + 'chr1\t0\t123400000\t1p\n' * 10000
+        ).encode(),
+    }
+    responses = []  # (path, status, body size) of each response
+
+    def do_GET(self):
+        body = self.files[self.path]
+        etag = '"%d"' % hash(body)
+        if self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        elif self.headers.get('Range') and self.headers.get('If-Range', etag) == etag:
+            first, last = self.headers['Range'].split('=')[1].split('-')
+            status, body = 206, body[int(first):int(last or len(body) - 1) + 1]
+        else:
+            status = 200
+
+        self.responses.append((self.path, status, len(body)))
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRelease(unittest.TestCase):
+    def test_get_release(self):
+        """Only headers are downloaded, and unchanged files are not."""
+
+        server = HTTPServer(('127.0.0.1', 0), MockReleaseHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:%d' % server.server_port
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dumper = SimpleNamespace(
+                SRC_URLS=[base_url + '/HumanDO.obo', base_url + '/genemap2.txt'],
+                src_root_folder=tmp_dir
+            )
+            expected = 'obo-2021-12-15_genemap2-2021-12-19'
+
+            self.assertEqual(get_release(dumper), expected)
+            self.assertEqual(
+                sorted(status for _, status, _ in MockReleaseHandler.responses),
+                [206, 206]
+            )
+            for path, _, size in MockReleaseHandler.responses:
+                self.assertLess(size, len(MockReleaseHandler.files[path]))
+
+            MockReleaseHandler.responses.clear()
+            self.assertEqual(get_release(dumper), expected)
+            self.assertEqual(
+                [status for _, status, _ in MockReleaseHandler.responses],
+                [304, 304]
+            )
+
+        server.shutdown()
+        server.server_close()
+
+    def test_downloader(self):
+        """Unchanged files are skipped, partial ones resumed, and limits kept."""
+
+        server = HTTPServer(('127.0.0.1', 0), MockReleaseHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:%d' % server.server_port
+        urls = [base_url + '/HumanDO.obo', base_url + '/genemap2.txt']
+        files = MockReleaseHandler.files
+
+        def download_all(tmp_dir, daily_limits=None):
+            MockReleaseHandler.responses.clear()
+            results = SourceDownloader(
+                tmp_dir, daily_limits=daily_limits).download_all(urls)
+            releases = {url: result['release'] for url, result in results.items()}
+            self.assertEqual(get_release_string(releases),
+                             'obo-2021-12-15_genemap2-2021-12-19')
+            for url, result in results.items():
+                with open(result['filename'], 'rb') as downloaded_fh:
+                    self.assertEqual(downloaded_fh.read(), files[url[len(base_url):]])
+            return results
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results = download_all(tmp_dir)
+            self.assertTrue(all(result['changed'] for result in results.values()))
+            self.assertEqual(
+                sorted(status for _, status, _ in MockReleaseHandler.responses),
+                [200, 200]
+            )
+
+            results = download_all(tmp_dir)
+            self.assertFalse(any(result['changed'] for result in results.values()))
+            self.assertEqual(
+                [status for _, status, _ in MockReleaseHandler.responses],
+                [304, 304]
+            )
+
+            # Interrupted download: only the rest of the file is requested
+            filename = results[urls[0]]['filename']
+            os.replace(filename, filename + '.part')
+            with open(filename + '.part', 'r+b') as part_fh:
+                part_fh.truncate(1000)
+            with open(os.path.join(tmp_dir, dumper.DOWNLOAD_STATE_FILENAME)) as state_fh:
+                state = json.load(state_fh)
+            state[urls[0]]['partial'] = {'etag': state[urls[0]]['etag']}
+            with open(os.path.join(tmp_dir, dumper.DOWNLOAD_STATE_FILENAME), 'w') as state_fh:
+                json.dump(state, state_fh)
+
+            results = download_all(tmp_dir)
+            self.assertTrue(results[urls[0]]['changed'])
+            self.assertIn(('/HumanDO.obo', 206, len(files['/HumanDO.obo']) - 1000),
+                          MockReleaseHandler.responses)
+
+            # No limit applies to this host by default
+            self.assertIsNone(dumper.get_daily_limit(urls[0]))
+            self.assertEqual(
+                dumper.get_daily_limit('https://data.omim.org/downloads/x/genemap2.txt'),
+                dumper.DAILY_REQUEST_LIMITS['omim.org']
+            )
+
+            # Each URL has been requested 3 times today
+            results = download_all(tmp_dir, daily_limits={'127.0.0.1': 3})
+            self.assertFalse(any(result['changed'] for result in results.values()))
+            self.assertEqual(MockReleaseHandler.responses, [])
+
+        server.shutdown()
+        server.server_close()
+
 
 # Test harness
 if __name__ == '__main__':
@@ -5,38 +5,120 @@ def get_release(self):
     """
     Return a string that combines the release dates of both "HumanDO.obo"
     and "genemap2.txt" files.
+
+    Only the header of each file is downloaded: an HTTP Range request asks
+    for the first bytes, and the stream is closed as soon as the release
+    line is found. Both files are probed concurrently. The ETag and
+    Last-Modified headers of the last answer are cached in the dumper's
+    root folder and sent back as conditional headers, so an unchanged file
+    is answered with "304 Not Modified" and its cached release string.
+
+    manifest.json no longer uses this function: its dumper class,
+    `dumper.DiseaseOntologyDumper`, reads the release from the downloaded
+    files instead (see `dumper.get_file_release()`). It is kept to check
+    the current release without downloading the files (see the test
+    harness below), and for a manifest that uses the default dumper of
+    Biothings SDK with `"release": "version:get_release"`. Biothings SDK
+    copies such a function into the dumper class it generates, so it must
+    not depend on anything else in this module.
     """
 
+    import json
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+
     import requests
 
-    # Get release date of "HumanDO.obo" data file:
     obo_url = "https://raw.githubusercontent.com/DiseaseOntology/HumanDiseaseOntology/main/src/ontology/HumanDO.obo"
-    obo_resp = requests.get(obo_url)
-    obo_text_lines = obo_resp.text.strip('\n').split('\n')
-    obo_release = ""
+    genemap2_url = "https://raw.githubusercontent.com/greenelab/disease_ontology_geneset/master/data/latest/genemap2.txt"
+
+    # Prefer the "data_url" list of the dumper (see "manifest.json")
+    for url in getattr(self, "SRC_URLS", None) or []:
+        if url.endswith("HumanDO.obo"):
+            obo_url = url
+        elif url.endswith("genemap2.txt"):
+            genemap2_url = url
+
+    header_bytes = 65536  # Both release lines are within the first few lines
+
+    cache = {}
+    cache_filename = None
+    if getattr(self, "src_root_folder", None):
+        cache_filename = os.path.join(self.src_root_folder, "release_cache.json")
+        if os.path.exists(cache_filename):
+            with open(cache_filename) as cache_fh:
+                cache = json.load(cache_fh)
+
+    session = requests.Session()
+
+    def probe_release(url, find_release):
+        """
+        Return the cache entry (ETag, Last-Modified and release string) of
+        `url`. `find_release(line)` returns the release string found in a
+        line, "" when the header is over, or None to keep reading.
+        """
+        headers = {"Range": "bytes=0-%d" % (header_bytes - 1)}
+        cached = cache.get(url)
+        if cached:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        with session.get(url, headers=headers, stream=True, timeout=60) as resp:
+            if resp.status_code == 304 and cached:
+                return cached
+            resp.raise_for_status()
+            resp.encoding = resp.encoding or "utf-8"
+
+            release = ""
+            for line in resp.iter_lines(decode_unicode=True):
+                release = find_release(line)
+                if release is not None:
+                    break
+
+            return {
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+                "release": release or "",
+            }
 
     # Find the line that is in the following format:
     # "data-version: doid/releases/YYYY-MM-DD/doid-non-classified.obo"
     # and extract "YYYY-MM-DD" part as release string in "HumanDO.obo":
-    for line in obo_text_lines:
+    def find_obo_release(line):
         if line.startswith("data-version: "):
             full_version = line.strip().split(' ')[1]
-            obo_release = full_version.split('/')[2]
-            break
-
-    # Get release date of "genemap2.txt" data file:
-    genemap2_url = "https://raw.githubusercontent.com/greenelab/disease_ontology_geneset/master/data/latest/genemap2.txt"
-    genemap2_resp = requests.get(genemap2_url)
-    genemap2_text_lines = genemap2_resp.text.strip('\n').split('\n')
-    genemap2_release = ""
+            return full_version.split('/')[2]
+        if line.startswith("[Term]"):
+            return ""
+        return None
 
     # Find the line that is in the following format:
     # "# Genearated: YYYY-MM-DD"
     # and extract "YYYY-MM-DD" part as the release string in "genemap2.txt":
-    for line in genemap2_text_lines:
+    def find_genemap2_release(line):
         if line.startswith("# Generated: "):
-            genemap2_release = line.strip().split(': ')[1]
-            break
+            return line.strip().split(': ')[1]
+        if line and not line.startswith("#"):
+            return ""
+        return None
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        obo_future = executor.submit(probe_release, obo_url, find_obo_release)
+        genemap2_future = executor.submit(
+            probe_release, genemap2_url, find_genemap2_release
+        )
+        cache[obo_url] = obo_future.result()
+        cache[genemap2_url] = genemap2_future.result()
+    session.close()
+
+    if cache_filename:
+        with open(cache_filename, "w") as cache_fh:
+            json.dump(cache, cache_fh, indent=2)
+
+    obo_release = cache[obo_url]["release"]
+    genemap2_release = cache[genemap2_url]["release"]
 
     # Return a string that combines both release dates
     return "obo-" + obo_release + "_" + "genemap2-" + genemap2_release